@@ -46,6 +46,7 @@ setup(name="simple-virtual-machine",
       cmdclass={'test': PyTest},
 
       install_requires=['docopt'],
+      extras_require={'batch': ['numpy']},
       entry_points={
         'console_scripts':
             ['simple-virtual-machine=simplevirtualmachine:main']
@@ -1,30 +1,15 @@
 '''
 simple-virtual-machine: Main module
-'''
-
-import logging
-import logging.config
 
-logging.basicConfig(level=logging.INFO,
-                    datefmt='%y-%m-%d %H:%M:%S',
-                    format='%(asctime)s %(name)-12s %(funcName)s %(filename)s:%(lineno)d %(levelname)-8s %(message)s')
-                    
-
-def main():
-    from docopt import docopt
-    usage = """A Simple Virtual Machine
+Importing the package does not configure logging; the command line entry
+point does.
+'''
 
-Usage:
-  simple-vritual-machine (-h | --help)
-  simple-vritual-machine --version
 
-Options:
-  -h --help     Show this screen.
-  --version     Show version.
+def main(argv=None):
+    from simplevirtualmachine.cli import main
+    return main(argv)
 
-"""
-    arguments = docopt(usage, version='simple version machien 1.0')
-    print arguments
 
 if __name__ == '__main__':
     main()
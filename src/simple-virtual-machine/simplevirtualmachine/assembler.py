@@ -0,0 +1,279 @@
+'''
+simple-virtual-machine: text assembler and disassembler.
+
+Assembly (``.svm``) source has one instruction per line::
+
+    ; factorial -- comments start with ';' or '#'
+    .globals result          ; names for data addresses 0, 1, ...
+    .entry main              ; start ip, defaults to 0
+    fact:   LOAD -3
+            ICONST 2
+            ILT
+            BRF recurse
+            ICONST 1
+            RET
+    recurse:
+            LOAD -3
+            LOAD -3
+            ICONST 1
+            ISUB
+            CALL fact, 1
+            IMUL
+            RET
+    main:   ICONST 10
+            CALL fact, 1
+            GSTORE result
+            HALT
+
+Mnemonics are case-insensitive and operands may be separated by commas or
+spaces.  BR/BRT/BRF/CALL/TCALL targets may be labels, data addresses
+(of GLOAD/GSTORE and the bulk instructions, e.g. ``VADD sum, xs, ys, 8``)
+may be global names, and ``.word n`` emits a raw code slot.
+
+:func:`disassemble` produces source that assembles back to the same code.
+:func:`assemble_file` caches assembled programs as binary bytecode files
+keyed by a hash of the source, so unchanged programs are never assembled
+twice.
+'''
+
+import collections
+import errno
+import hashlib
+import os
+import re
+import tempfile
+
+from simplevirtualmachine import binfile
+from simplevirtualmachine.bulk import BULK
+from simplevirtualmachine.bytecodes import BR, BRT, BRF, CALL, TCALL, GLOAD, GSTORE, \
+    Bytecode
+from simplevirtualmachine.trace import format_instruction
+
+# bump when the assembler output for a given source may change
+CACHE_VERSION = 1
+
+CACHE_DIR = '__svmcache__'
+
+BRANCHES = (BR, BRT, BRF, CALL, TCALL)
+# bytecode -> how many leading operands are data addresses
+GLOBAL_ACCESS = {GLOAD: 1, GSTORE: 1}
+GLOBAL_ACCESS.update((bytecode, bytecode.operands_read - 1) for bytecode in BULK)
+
+_LABEL = re.compile(r'^([A-Za-z_][\w.]*):')
+_NAME = re.compile(r'^[A-Za-z_][\w.]*$')
+
+
+class AssemblyError(Exception):
+    """The assembly source is invalid."""
+
+    def __init__(self, message, line=None):
+        super(AssemblyError, self).__init__(message if line is None
+                                            else "line {}: {}".format(line, message))
+        self.line = line
+
+
+class Assembly(collections.namedtuple('Assembly', 'code entry labels globals')):
+    """The result of assembling source: code tuple, entry ip and symbols."""
+    __slots__ = ()
+
+    def vm(self, **kwargs):
+        '''Return a VM running this program from its entry point.'''
+        from simplevirtualmachine.vm import VM
+
+        kwargs.setdefault('start_ip', self.entry)
+        return VM(*self.code, **kwargs)
+
+
+def _mnemonics():
+    return dict((bytecode.name, bytecode) for bytecode in Bytecode.opcodes.values())
+
+
+def _parse_int(token):
+    try:
+        return int(token, 0)
+    except ValueError:
+        return None
+
+
+def assemble(text):
+    '''Assemble source text into an :class:`Assembly`.
+
+    >>> program = assemble("ICONST 4\\nloop: BR loop")
+    >>> program.labels['loop'], program.code[3]
+    (2, 2)
+    '''
+    mnemonics = _mnemonics()
+    labels = {}
+    global_names = collections.OrderedDict()
+    entry = None
+    slots = []      # code slots, symbolic operands are patched below
+    fixups = []     # (slot index, 'label' or 'global', line number)
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = re.split(r'[;#]', line, 1)[0].strip()
+
+        match = _LABEL.match(line)
+        while match:
+            name = match.group(1)
+            if name in labels:
+                raise AssemblyError("duplicate label {!r}".format(name), lineno)
+            labels[name] = len(slots)
+            line = line[match.end():].strip()
+            match = _LABEL.match(line)
+        if not line:
+            continue
+
+        tokens = line.replace(',', ' ').split()
+        head, args = tokens[0], tokens[1:]
+
+        if head == '.globals':
+            for name in args:
+                if not _NAME.match(name) or name in global_names:
+                    raise AssemblyError("bad global name {!r}".format(name), lineno)
+                global_names[name] = len(global_names)
+            continue
+        if head == '.entry':
+            if len(args) != 1:
+                raise AssemblyError(".entry takes one label or address", lineno)
+            entry = (args[0], lineno)
+            continue
+        if head == '.word':
+            for arg in args:
+                value = _parse_int(arg)
+                if value is None:
+                    raise AssemblyError("bad .word value {!r}".format(arg), lineno)
+                slots.append(value)
+            continue
+
+        bytecode = mnemonics.get(head.upper())
+        if bytecode is None:
+            raise AssemblyError("unknown instruction {!r}".format(head), lineno)
+        if len(args) != bytecode.operands_read:
+            raise AssemblyError("{} takes {} operand(s), got {}".format(
+                bytecode.name, bytecode.operands_read, len(args)), lineno)
+
+        slots.append(bytecode)
+        for position, arg in enumerate(args):
+            value = _parse_int(arg)
+            if value is None:
+                if position == 0 and bytecode in BRANCHES:
+                    fixups.append((len(slots), 'label', lineno))
+                elif position < GLOBAL_ACCESS.get(bytecode, 0):
+                    fixups.append((len(slots), 'global', lineno))
+                else:
+                    raise AssemblyError("bad operand {!r}".format(arg), lineno)
+                value = arg
+            slots.append(value)
+
+    for slot, kind, lineno in fixups:
+        name = slots[slot]
+        table = labels if kind == 'label' else global_names
+        if name not in table:
+            raise AssemblyError("undefined {} {!r}".format(kind, name), lineno)
+        slots[slot] = table[name]
+
+    start = 0
+    if entry is not None:
+        name, lineno = entry
+        start = _parse_int(name)
+        if start is None:
+            if name not in labels:
+                raise AssemblyError("undefined label {!r}".format(name), lineno)
+            start = labels[name]
+
+    return Assembly(tuple(slots), start, labels, dict(global_names))
+
+
+def disassemble(code, entry=0):
+    '''Return assembly source for code that assembles back to it.
+
+    Each instruction is followed by its ``display_instruction`` listing as
+    a comment.
+
+    >>> from simplevirtualmachine.bytecodes import ICONST, HALT
+    >>> disassemble((ICONST, 4, BR, 0, HALT)).splitlines()[2].split()
+    ['BR', 'L0000', ';', '0002:', 'BR', '(1)', '0']
+    '''
+    starts = set()
+    targets = set([entry])
+    addr = 0
+    while addr < len(code):
+        bytecode = code[addr]
+        starts.add(addr)
+        width = bytecode.operands_read if isinstance(bytecode, Bytecode) else 0
+        if bytecode in BRANCHES and addr + 1 < len(code):
+            targets.add(code[addr + 1])
+        addr += 1 + width
+    targets &= starts
+
+    lines = [".entry L{:04d}".format(entry)] if entry in targets and entry else []
+    addr = 0
+    while addr < len(code):
+        if addr in targets:
+            lines.append("L{:04d}:".format(addr))
+        bytecode = code[addr]
+        if not isinstance(bytecode, Bytecode) or addr + bytecode.operands_read >= len(code):
+            word = bytecode.opcode if isinstance(bytecode, Bytecode) else bytecode
+            lines.append("        .word {}".format(word))
+            addr += 1
+            continue
+        operands = [str(op) for op in code[addr + 1:addr + 1 + bytecode.operands_read]]
+        if bytecode in BRANCHES and code[addr + 1] in targets:
+            operands[0] = "L{:04d}".format(code[addr + 1])
+        text = "        {} {}".format(bytecode.name, ", ".join(operands)).rstrip()
+        lines.append("{:32s}; {}".format(
+            text, " ".join(format_instruction(code, addr).split())))
+        addr += 1 + bytecode.operands_read
+
+    return "\n".join(lines) + "\n"
+
+
+def cache_path(path, source, cache_dir=None):
+    '''Return the cache file for source read from path.'''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR)
+    digest = hashlib.sha1(b"svm-asm-" + str(CACHE_VERSION).encode() + b"\0" + source)
+    return os.path.join(cache_dir, digest.hexdigest() + ".svmb")
+
+
+def assemble_file(path, cache_dir=None, use_cache=True):
+    '''Assemble the .svm file at path, going through the parse cache.
+
+    Returns a :class:`~simplevirtualmachine.binfile.BinaryProgram` mapped
+    from the cache when possible, otherwise an :class:`Assembly` (e.g. for
+    constants that do not fit the binary format).  Both have ``code``,
+    ``entry`` and ``vm()``.
+    '''
+    with open(path, 'rb') as f:
+        source = f.read()
+
+    cached = cache_path(path, source, cache_dir)
+    if use_cache and os.path.exists(cached):
+        try:
+            return binfile.load(cached)
+        except binfile.BinaryFormatError:
+            pass
+
+    assembly = assemble(source.decode('utf-8'))
+    if not use_cache:
+        return assembly
+
+    try:
+        directory = os.path.dirname(cached)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            binfile.dump(assembly.code, tmp, assembly.entry)
+            os.rename(tmp, cached)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    except (OSError, IOError, binfile.BinaryFormatError):
+        return assembly
+
+    return binfile.load(cached)
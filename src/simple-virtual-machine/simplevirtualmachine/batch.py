@@ -0,0 +1,353 @@
+'''
+simple-virtual-machine: run one program over many inputs at once.
+
+:func:`run_batch` executes a code tuple on N lanes in lockstep, SIMT
+style.  Every lane has its own ip, sp and fp; the stack and data memory
+are ``(lanes, cells)`` NumPy arrays, so an IADD or ILT is one vectorised
+operation over all lanes that are at that instruction.  Each step runs
+the instruction with the lowest ip among the live lanes, for every lane
+at that ip; lanes that took the other side of a BRT/BRF wait, masked
+out, until control flow brings them back together.
+
+The input matrix has one row per lane.  By default row i is written to
+data cells ``0..k-1`` of lane i before the run (``inputs_to='data'``);
+with ``inputs_to='stack'`` it is pushed on lane i's stack instead, e.g.
+as the argument of a ``CALL``::
+
+    result = run_batch(code, [[n] for n in range(1000)], start_ip=22,
+                       inputs_to='stack')
+    result.outputs[5]        # PUTS values of lane 5, in order
+
+MEMSET, MEMCPY, VADD, VMUL and VSUM are one NumPy operation over the
+ranges of every lane at the instruction.
+
+Lanes hold 64-bit integers and arithmetic wraps on overflow, as in
+``VM(..., integers='wrap')`` rather than the VM's default unbounded
+integers.
+
+NumPy is an optional dependency (``pip install simple-virtual-machine[batch]``).
+'''
+
+from simplevirtualmachine.bulk import BULK, ranges
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, IEQ, \
+    BR, BRT, BRF, ICONST, LOAD, GLOAD, STORE, GSTORE, PUTS, POP, CALL, RET, \
+    HALT, TCALL, MEMSET, MEMCPY, VADD, VMUL, VSUM, TRUE, FALSE, Bytecode, InvalidBytecodeError
+from simplevirtualmachine.decoder import decode
+from simplevirtualmachine.memory import MemoryOverflowError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_LANE_STACK = 1024
+
+
+class BatchResult(object):
+    """Per-lane results of :func:`run_batch`.
+
+    ``outputs[i]`` lists the values lane i printed with PUTS.  ``values``
+    holds the top of each lane's stack at HALT, where ``has_value`` is
+    True; ``data`` is the final data memory and ``steps`` the number of
+    instructions each lane executed.
+    """
+
+    def __init__(self, outputs, values, has_value, data, steps, sweeps):
+        self.outputs = outputs
+        self.values = values
+        self.has_value = has_value
+        self.data = data
+        self.steps = steps
+        self.sweeps = sweeps
+
+
+class _Lanes(object):
+    """Register and memory arrays of all lanes."""
+
+    def __init__(self, lanes, stack_size, data_size, code=()):
+        # for the operands the records do not hold
+        self.code = code
+        self.stack = numpy.zeros((lanes, stack_size), dtype=numpy.int64)
+        self.data = numpy.zeros((lanes, data_size), dtype=numpy.int64)
+        self.sp = numpy.full(lanes, -1, dtype=numpy.int64)
+        self.fp = numpy.full(lanes, -1, dtype=numpy.int64)
+        self.pc = numpy.zeros(lanes, dtype=numpy.int64)
+        self.puts_lanes = []
+        self.puts_values = []
+
+    def binary(self, idx, op):
+        sp = self.sp[idx]
+        self.stack[idx, sp - 1] = op(self.stack[idx, sp - 1], self.stack[idx, sp])
+        self.sp[idx] = sp - 1
+
+    def push(self, idx, values):
+        sp = self.sp[idx] + 1
+        self.stack[idx, sp] = values
+        self.sp[idx] = sp
+
+    def pop(self, idx):
+        sp = self.sp[idx]
+        self.sp[idx] = sp - 1
+        return self.stack[idx, sp]
+
+
+def _b_iadd(lanes, ins, idx):
+    lanes.binary(idx, numpy.add)
+    lanes.pc[idx] = ins.next
+
+
+def _b_isub(lanes, ins, idx):
+    lanes.binary(idx, numpy.subtract)
+    lanes.pc[idx] = ins.next
+
+
+def _b_imul(lanes, ins, idx):
+    lanes.binary(idx, numpy.multiply)
+    lanes.pc[idx] = ins.next
+
+
+def _b_ilt(lanes, ins, idx):
+    lanes.binary(idx, lambda a, b: (a < b).astype(numpy.int64))
+    lanes.pc[idx] = ins.next
+
+
+def _b_ieq(lanes, ins, idx):
+    lanes.binary(idx, lambda a, b: (a == b).astype(numpy.int64))
+    lanes.pc[idx] = ins.next
+
+
+def _b_br(lanes, ins, idx):
+    lanes.pc[idx] = ins.op1
+
+
+def _b_brt(lanes, ins, idx):
+    lanes.pc[idx] = numpy.where(lanes.pop(idx) == TRUE, ins.op1, ins.next)
+
+
+def _b_brf(lanes, ins, idx):
+    lanes.pc[idx] = numpy.where(lanes.pop(idx) == FALSE, ins.op1, ins.next)
+
+
+def _b_iconst(lanes, ins, idx):
+    lanes.push(idx, ins.op1)
+    lanes.pc[idx] = ins.next
+
+
+def _b_load(lanes, ins, idx):
+    lanes.push(idx, lanes.stack[idx, lanes.fp[idx] + ins.op1])
+    lanes.pc[idx] = ins.next
+
+
+def _b_gload(lanes, ins, idx):
+    lanes.push(idx, lanes.data[idx, ins.op1])
+    lanes.pc[idx] = ins.next
+
+
+def _b_store(lanes, ins, idx):
+    target = lanes.fp[idx] + ins.op1
+    lanes.stack[idx, target] = lanes.pop(idx)
+    lanes.pc[idx] = ins.next
+
+
+def _b_gstore(lanes, ins, idx):
+    lanes.data[idx, ins.op1] = lanes.pop(idx)
+    lanes.pc[idx] = ins.next
+
+
+def _b_puts(lanes, ins, idx):
+    lanes.puts_lanes.append(idx)
+    lanes.puts_values.append(lanes.pop(idx))
+    lanes.pc[idx] = ins.next
+
+
+def _b_pop(lanes, ins, idx):
+    lanes.sp[idx] -= 1
+    lanes.pc[idx] = ins.next
+
+
+def _b_call(lanes, ins, idx):
+    sp = lanes.sp[idx]
+    lanes.stack[idx, sp + 1] = ins.op2
+    lanes.stack[idx, sp + 2] = lanes.fp[idx]
+    # lanes keep return addresses as record indices
+    lanes.stack[idx, sp + 3] = ins.next
+    lanes.sp[idx] = sp + 3
+    lanes.fp[idx] = sp + 3
+    lanes.pc[idx] = ins.op1
+
+
+def _b_tcall(lanes, ins, idx):
+    fp = lanes.fp[idx]
+    entry = fp < 0
+    if entry.any():
+        _b_call(lanes, ins, idx[entry])
+        idx, fp = idx[~entry], fp[~entry]
+    stack = lanes.stack
+    base = fp - 2 - stack[idx, fp - 2]
+    saved_fp = stack[idx, fp - 1]
+    return_ip = stack[idx, fp]
+    sp = lanes.sp[idx]
+    for k in range(ins.op2):
+        stack[idx, base + k] = stack[idx, sp - ins.op2 + 1 + k]
+    top = base + ins.op2
+    stack[idx, top] = ins.op2
+    stack[idx, top + 1] = saved_fp
+    stack[idx, top + 2] = return_ip
+    lanes.sp[idx] = top + 2
+    lanes.fp[idx] = top + 2
+    lanes.pc[idx] = ins.op1
+
+
+def _b_ret(lanes, ins, idx):
+    stack = lanes.stack
+    rvalue = stack[idx, lanes.sp[idx]]
+    fp = lanes.fp[idx]
+    lanes.pc[idx] = stack[idx, fp]
+    lanes.fp[idx] = stack[idx, fp - 1]
+    sp = fp - 2 - stack[idx, fp - 2]
+    stack[idx, sp] = rvalue
+    lanes.sp[idx] = sp
+
+
+def _bulk_operands(lanes, ins):
+    '''Return the operands of a bulk instruction, checking its ranges.'''
+    addr = ins.addr + 1
+    operands = lanes.code[addr:addr + ins.bytecode.operands_read]
+    for start, length in ranges(ins.bytecode, operands):
+        if length < 0 or start < 0 or start + length > lanes.data.shape[1]:
+            raise IndexError("data range out of range")
+    return operands
+
+
+def _b_memset(lanes, ins, idx):
+    dst, n = _bulk_operands(lanes, ins)
+    lanes.data[idx, dst:dst + n] = lanes.pop(idx)[:, None]
+    lanes.pc[idx] = ins.next
+
+
+def _b_memcpy(lanes, ins, idx):
+    dst, src, n = _bulk_operands(lanes, ins)
+    lanes.data[idx, dst:dst + n] = lanes.data[idx, src:src + n]
+    lanes.pc[idx] = ins.next
+
+
+def _b_vadd(lanes, ins, idx):
+    dst, a, b, n = _bulk_operands(lanes, ins)
+    data = lanes.data
+    data[idx, dst:dst + n] = data[idx, a:a + n] + data[idx, b:b + n]
+    lanes.pc[idx] = ins.next
+
+
+def _b_vmul(lanes, ins, idx):
+    dst, a, b, n = _bulk_operands(lanes, ins)
+    data = lanes.data
+    data[idx, dst:dst + n] = data[idx, a:a + n] * data[idx, b:b + n]
+    lanes.pc[idx] = ins.next
+
+
+def _b_vsum(lanes, ins, idx):
+    src, n = _bulk_operands(lanes, ins)
+    lanes.push(idx, lanes.data[idx, src:src + n].sum(axis=1))
+    lanes.pc[idx] = ins.next
+
+
+def _b_invalid(lanes, ins, idx):
+    raise InvalidBytecodeError("Invalid opcode {opcode} at ip = {ip}".format(
+        opcode=ins.bytecode.name, ip=ins.addr))
+
+
+def _build_batch_handlers():
+    '''Map every integer opcode to its lane handler.'''
+    handlers = {
+        IADD: _b_iadd, ISUB: _b_isub, IMUL: _b_imul, ILT: _b_ilt, IEQ: _b_ieq,
+        BR: _b_br, BRT: _b_brt, BRF: _b_brf,
+        ICONST: _b_iconst, LOAD: _b_load, GLOAD: _b_gload,
+        STORE: _b_store, GSTORE: _b_gstore, PUTS: _b_puts, POP: _b_pop,
+        CALL: _b_call, RET: _b_ret, TCALL: _b_tcall,
+        MEMSET: _b_memset, MEMCPY: _b_memcpy, VADD: _b_vadd, VMUL: _b_vmul, VSUM: _b_vsum,
+    }
+    table = [_b_invalid] * (max(Bytecode.opcodes) + 1)
+    for bytecode, handler in handlers.items():
+        table[bytecode.opcode] = handler
+    return table
+
+
+BATCH_HANDLERS = _build_batch_handlers()
+
+
+def _data_cells(code):
+    '''Return one more than the highest data address code uses.'''
+    top = -1
+    addr = 0
+    while addr < len(code):
+        bytecode = code[addr]
+        width = bytecode.operands_read if isinstance(bytecode, Bytecode) else 0
+        if bytecode is GLOAD or bytecode is GSTORE:
+            top = max(top, code[addr + 1])
+        elif bytecode in BULK:
+            for start, length in ranges(bytecode, code[addr + 1:addr + 1 + width]):
+                if length > 0:
+                    top = max(top, start + length - 1)
+        addr += 1 + width
+    return top + 1
+
+
+def run_batch(code, inputs, start_ip=0, inputs_to='data',
+              stack_size=DEFAULT_LANE_STACK, data_size=None):
+    '''Run code once per row of inputs, all rows in lockstep.
+
+    Returns a :class:`BatchResult`.  data_size defaults to what the
+    program's data addresses and the inputs need.
+    '''
+    if numpy is None:
+        raise ImportError("run_batch needs numpy: pip install simple-virtual-machine[batch]")
+    if inputs_to not in ('data', 'stack'):
+        raise ValueError("inputs_to must be 'data' or 'stack'")
+
+    inputs = numpy.asarray(inputs, dtype=numpy.int64)
+    if inputs.ndim == 1:
+        inputs = inputs.reshape(-1, 1)
+    count, width = inputs.shape
+
+    program = decode(code, BATCH_HANDLERS)
+    instrs = program.instructions
+    if data_size is None:
+        data_size = max(_data_cells(code), width if inputs_to == 'data' else 0, 1)
+
+    lanes = _Lanes(count, stack_size, data_size, code)
+    if inputs_to == 'data':
+        lanes.data[:, :width] = inputs
+    else:
+        lanes.stack[:, :width] = inputs
+        lanes.sp[:] = width - 1
+    lanes.pc[:] = program.index_of(start_ip)
+
+    # a lane at pc == halt has stopped
+    halts = numpy.array([instr.bytecode is HALT for instr in instrs] + [True])
+    steps = numpy.zeros(count, dtype=numpy.int64)
+    sweeps = 0
+
+    try:
+        live = numpy.flatnonzero(~halts[lanes.pc])
+        while live.size:
+            pcs = lanes.pc[live]
+            pc = pcs.min()
+            idx = live[pcs == pc]
+            instr = instrs[pc]
+            instr.handler(lanes, instr, idx)
+            steps[idx] += 1
+            sweeps += 1
+            live = live[~halts[lanes.pc[live]]]
+    except IndexError:
+        raise MemoryOverflowError("lane stack or data access out of range "
+                                  "(stack_size {}, data_size {})".format(stack_size, data_size))
+
+    outputs = [[] for _ in range(count)]
+    for idx, values in zip(lanes.puts_lanes, lanes.puts_values):
+        for lane, value in zip(idx.tolist(), values.tolist()):
+            outputs[lane].append(value)
+
+    has_value = lanes.sp >= 0
+    values = lanes.stack[numpy.arange(count), numpy.maximum(lanes.sp, 0)]
+    values = numpy.where(has_value, values, 0)
+    return BatchResult(outputs, values, has_value, lanes.data, steps, sweeps)
@@ -0,0 +1,138 @@
+'''
+simple-virtual-machine: interpreter micro-benchmarks.
+
+Runs a loop-heavy and a call-heavy program on every engine and reports
+instructions/second::
+
+    python -m simplevirtualmachine.bench [iterations]
+
+The full suite, with a workload corpus, JSON results and regression
+checks against a baseline, is :mod:`simplevirtualmachine.bench.suite`.
+'''
+
+import logging
+import math
+import sys
+import time
+
+from simplevirtualmachine.bytecodes import IADD, ISUB, ILT, BR, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, CALL, RET, HALT
+from simplevirtualmachine.vm import VM
+
+
+def loop_program(n):
+    '''The ``test_loop`` counter from the test suite, counting to n.'''
+    return (
+        ICONST, n,             # 0
+        GSTORE, 0,             # 2
+        ICONST, 0,             # 4
+        GSTORE, 1,             # 6
+        GLOAD, 1,              # 8
+        GLOAD, 0,              # 10
+        ILT,                   # 12
+        BRF, 24,               # 13
+        GLOAD, 1,              # 15
+        ICONST, 1,             # 17
+        IADD,                  # 19
+        GSTORE, 1,             # 20
+        BR, 8,                 # 22
+        HALT,                  # 24
+    )
+
+
+def call_program(n):
+    '''Call a one-argument function n times from a counting loop.'''
+    return (
+        # def DEC: ARGS=1, LOCALS=0
+        LOAD, -3,              # 0
+        ICONST, 1,             # 2
+        ISUB,                  # 4
+        RET,                   # 5
+        # MAIN: I = N; WHILE 0 < I: I = DEC(I)
+        ICONST, n,             # 6
+        GSTORE, 0,             # 8
+        ICONST, 0,             # 10
+        GLOAD, 0,              # 12
+        ILT,                   # 14
+        BRF, 26,               # 15
+        GLOAD, 0,              # 17
+        CALL, 0, 1,            # 19
+        GSTORE, 0,             # 22
+        BR, 10,                # 24
+        HALT,                  # 26
+    )
+
+
+WORKLOADS = (
+    ('loop', loop_program, {}),
+    ('call', call_program, {'start_ip': 6}),
+)
+
+
+def count_instructions(code, **kwargs):
+    '''Return the dynamic instruction count of running code once.'''
+    vm = VM(*code, engine='table', **kwargs)
+    vm.run()
+    return vm.steps
+
+
+def timed(func):
+    '''Call func() and return the wall time it took in seconds.'''
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def percentile(values, fraction):
+    '''Return the nearest-rank percentile of values, fraction in (0, 1].
+
+    >>> percentile([5, 1, 4, 2, 3], 0.5)
+    3
+    '''
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(times):
+    '''Return min/median/p99/max of a list of run times.'''
+    return {
+        'min': min(times),
+        'median': percentile(times, 0.5),
+        'p99': percentile(times, 0.99),
+        'max': max(times),
+    }
+
+
+def time_run(code, repeat=3, **kwargs):
+    '''Return the best wall time in seconds of repeat fresh runs of code.'''
+    best = None
+    for _ in range(repeat):
+        vm = VM(*code, **kwargs)
+        elapsed = timed(vm.run)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench(iterations=10000, repeat=3, engines=VM.ENGINES):
+    '''Return a list of (workload, engine, instructions, seconds, ips) rows.'''
+    rows = []
+    for name, program, kwargs in WORKLOADS:
+        code = program(iterations)
+        instructions = count_instructions(code, **kwargs)
+        for engine in engines:
+            seconds = time_run(code, repeat=repeat, engine=engine, **kwargs)
+            rows.append((name, engine, instructions, seconds, instructions / seconds))
+    return rows
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 10000
+
+    logging.disable(logging.INFO)
+    for name, engine, instructions, seconds, ips in bench(iterations):
+        sys.stdout.write("{:6s} {:8s} {:>10d} instr {:8.3f}s {:>12,.0f} instr/s\n".format(
+            name, engine, instructions, seconds, ips))
+
@@ -0,0 +1,4 @@
+from simplevirtualmachine.bench import main
+
+if __name__ == '__main__':
+    main()
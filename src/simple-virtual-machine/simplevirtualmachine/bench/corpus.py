@@ -0,0 +1,94 @@
+'''
+simple-virtual-machine: the benchmark workload corpus.
+
+:func:`corpus` returns one :class:`Workload` per kind of program the VM
+spends its time on, sized so that each runs for millions of instructions
+at ``scale=1``:
+
+* ``loop``: the ``test_loop`` counter to 10**6,
+* ``factorial``: factorial(300) by deep recursion, on big integers,
+* ``fib``: fib(20) by doubly recursive calls,
+* ``call``: a one-argument function called from a counting loop,
+* ``globals``: 16 data cells loaded, incremented and stored per iteration,
+* ``output``: a PUTS per iteration.
+'''
+
+import collections
+
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BR, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, CALL, RET, HALT
+
+
+class Workload(collections.namedtuple('Workload', 'name code start_ip description')):
+    """A benchmark program and where it starts."""
+    __slots__ = ()
+
+
+def repeated(body, times, counter, start):
+    '''Return code that runs body times, placed at address start.
+
+    body is straight-line code; the iterations are counted down in data
+    cell counter.
+
+    >>> code = repeated((ICONST, 1, GSTORE, 0), 3, 1, 0)
+    >>> len(code), code[-1].name
+    (25, 'HALT')
+    '''
+    top = start + 4
+    end = top + 7 + len(body) + 9
+    return (ICONST, times, GSTORE, counter,
+            ICONST, 0, GLOAD, counter, ILT, BRF, end) + tuple(body) + \
+        (GLOAD, counter, ICONST, 1, ISUB, GSTORE, counter, BR, top, HALT)
+
+
+# def FACTORIAL(n): if n < 2: return 1; return n * FACTORIAL(n - 1)
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET)
+
+# def FIB(n): if n < 2: return n; return FIB(n - 1) + FIB(n - 2)
+FIB = (LOAD, -3, ICONST, 2, ILT, BRF, 10, LOAD, -3, RET,
+       LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1,
+       LOAD, -3, ICONST, 2, ISUB, CALL, 0, 1,
+       IADD, RET)
+
+
+def factorial_program(n, times):
+    '''Compute factorial(n) times over; starts at len(FACTORIAL).'''
+    return FACTORIAL + repeated((ICONST, n, CALL, 0, 1, GSTORE, 0), times, 1, len(FACTORIAL))
+
+
+def fib_program(n, times):
+    '''Compute fib(n) times over; starts at len(FIB).'''
+    return FIB + repeated((ICONST, n, CALL, 0, 1, GSTORE, 0), times, 1, len(FIB))
+
+
+def globals_program(n, cells=16):
+    '''Increment data cells 0..cells-1 n times.'''
+    init = []
+    body = []
+    for cell in range(cells):
+        init.extend((ICONST, 0, GSTORE, cell))
+        body.extend((GLOAD, cell, ICONST, 1, IADD, GSTORE, cell))
+    return tuple(init) + repeated(body, n, cells, len(init))
+
+
+def output_program(n):
+    '''PUTS the loop counter n times.'''
+    return repeated((GLOAD, 1, PUTS), n, 1, 0)
+
+
+def corpus(scale=1.0):
+    '''Return the workloads, with their sizes multiplied by scale.'''
+    def size(n):
+        return max(1, int(n * scale))
+
+    return (
+        Workload('loop', loop_program(size(10 ** 6)), 0, "global counter loop"),
+        Workload('factorial', factorial_program(300, size(600)), len(FACTORIAL),
+                 "deep recursion on big integers"),
+        Workload('fib', fib_program(20, size(10)), len(FIB), "doubly recursive calls"),
+        Workload('call', call_program(size(2 * 10 ** 5)), 6, "call-heavy loop"),
+        Workload('globals', globals_program(size(5 * 10 ** 4)), 0, "16 data cells per iteration"),
+        Workload('output', output_program(size(2 * 10 ** 5)), 0, "PUTS per iteration"),
+    )
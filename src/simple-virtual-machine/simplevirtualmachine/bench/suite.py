@@ -0,0 +1,235 @@
+'''
+simple-virtual-machine: reproducible benchmark suite.
+
+:func:`run_suite` runs every workload of
+:mod:`simplevirtualmachine.bench.corpus` on every engine and measures
+
+* the instructions executed,
+* VM construction time and run time, each the best of ``repeat``, and
+  instructions/second,
+* the peak memory allocated while building the VM and running it once,
+  with tracemalloc.  Where tracemalloc is missing (Python 2) it is the
+  growth of the maximum resident set size of a child process that does
+  the same, which counts whole pages; :data:`PEAK_MEMORY` names the
+  method, and is None where neither works (no fork, e.g. Windows).
+
+:func:`save` writes the results as JSON and :func:`compare` checks them
+against a saved baseline; from the command line::
+
+    simple-virtual-machine bench --json new.json --baseline old.json --threshold 0.05
+
+exits with status 1 when a workload got slower, or used more memory, by
+more than the threshold.
+'''
+
+import collections
+import json
+import os
+import platform
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from simplevirtualmachine.bench import timed
+from simplevirtualmachine.bench.corpus import corpus
+from simplevirtualmachine.vm import VM
+
+FORMAT = 'svm-bench'
+VERSION = 1
+
+# a metric more than this fraction over the baseline is a regression
+DEFAULT_THRESHOLD = 0.1
+
+METRICS = ('seconds', 'construct_seconds', 'peak_bytes')
+
+if tracemalloc is not None:
+    PEAK_MEMORY = 'tracemalloc'
+elif resource is not None and hasattr(os, 'fork'):
+    PEAK_MEMORY = 'maxrss'
+else:
+    PEAK_MEMORY = None
+
+# ru_maxrss is in kilobytes, except on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+class Result(collections.namedtuple(
+        'Result', 'workload engine instructions construct_seconds seconds ips peak_bytes')):
+    """The measurements of one workload on one engine."""
+    __slots__ = ()
+
+
+class Regression(collections.namedtuple('Regression', 'workload engine metric baseline current')):
+    """A metric that grew past the threshold."""
+    __slots__ = ()
+
+    @property
+    def change(self):
+        '''The growth as a fraction of the baseline.'''
+        return float(self.current) / self.baseline - 1 if self.baseline else float('inf')
+
+
+def _run(workload, engine):
+    VM(*workload.code, start_ip=workload.start_ip, engine=engine, output='null').run()
+
+
+def peak_memory(workload, engine):
+    '''Return the peak bytes allocated building a VM for workload and
+    running it, measured as :data:`PEAK_MEMORY` says; None when it cannot
+    be measured here or tracemalloc is already tracing.'''
+    if PEAK_MEMORY == 'maxrss':
+        return _peak_rss(workload, engine)
+    if PEAK_MEMORY is None or tracemalloc.is_tracing():
+        return None
+    tracemalloc.start()
+    try:
+        _run(workload, engine)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _peak_rss(workload, engine):
+    '''Return how far running workload raises the maximum resident set
+    size of a forked child, in bytes, or None if the child failed.'''
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child only reports; it never returns into the caller
+        status = 1
+        try:
+            os.close(read)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            _run(workload, engine)
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write, str((after - before) * _MAXRSS_UNIT).encode('ascii'))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write)
+    try:
+        report = os.read(read, 64)
+    finally:
+        os.close(read)
+        os.waitpid(pid, 0)
+    return int(report) if report else None
+
+
+def measure(workload, engine, repeat=3):
+    '''Measure workload on engine; returns a :class:`Result`.'''
+    # first, so that decoding and compiling are part of the peak
+    peak = peak_memory(workload, engine)
+    construct = seconds = None
+    instructions = 0
+    for _ in range(repeat):
+        vms = []
+        elapsed = timed(lambda: vms.append(
+            VM(*workload.code, start_ip=workload.start_ip, engine=engine, output='null')))
+        if construct is None or elapsed < construct:
+            construct = elapsed
+        vm = vms[0]
+        elapsed = timed(vm.run)
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+        instructions = vm.steps
+    return Result(workload.name, engine, instructions, construct, seconds,
+                  instructions / seconds if seconds else float('inf'), peak)
+
+
+def run_suite(scale=1.0, repeat=3, engines=VM.ENGINES, workloads=None):
+    '''Measure every workload (default: the corpus at scale) on engines.'''
+    if workloads is None:
+        workloads = corpus(scale)
+    return [measure(workload, engine, repeat) for workload in workloads for engine in engines]
+
+
+def save(results, path, **info):
+    '''Write results to path as JSON; info is stored alongside them.'''
+    document = {
+        'format': FORMAT,
+        'version': VERSION,
+        'python': platform.python_version(),
+        'peak_memory': PEAK_MEMORY,
+        'info': info,
+        'results': [result._asdict() for result in results],
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=1, sort_keys=True)
+
+
+def load(path):
+    '''Read the results saved by :func:`save`.'''
+    with open(path) as f:
+        document = json.load(f)
+    if not isinstance(document, dict) or document.get('format') != FORMAT:
+        raise ValueError("{}: not a benchmark results file".format(path))
+    if document.get('version') != VERSION:
+        raise ValueError("{}: unsupported results version {!r}".format(
+            path, document.get('version')))
+    return [Result(**dict((str(key), value) for key, value in entry.items()))
+            for entry in document['results']]
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, metrics=METRICS):
+    '''Return the :class:`Regression` list of results against baseline.
+
+    A metric regresses when it is more than threshold (a fraction) above
+    the baseline's value for the same workload and engine.  Workloads
+    or engines missing from either side, and metrics either side could
+    not measure, are skipped.
+
+    >>> old = [Result('loop', 'table', 100, 0.001, 1.0, 100.0, None)]
+    >>> new = [Result('loop', 'table', 100, 0.001, 1.2, 83.3, None)]
+    >>> [(r.metric, round(r.change, 2)) for r in compare(new, old)]
+    [('seconds', 0.2)]
+    >>> compare(new, old, threshold=0.25)
+    []
+    '''
+    before = dict(((result.workload, result.engine), result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = before.get((result.workload, result.engine))
+        if old is None:
+            continue
+        for metric in metrics:
+            current, previous = getattr(result, metric), getattr(old, metric)
+            if current is None or previous is None:
+                continue
+            if current > previous * (1 + threshold):
+                regressions.append(Regression(result.workload, result.engine, metric,
+                                              previous, current))
+    return regressions
+
+
+def format_results(results):
+    '''Return results as a table, one line per workload and engine.'''
+    lines = ["{:10s} {:8s} {:>10s} {:>12s} {:>10s} {:>14s} {:>12s}".format(
+        'WORKLOAD', 'ENGINE', 'INSTR', 'CONSTRUCT', 'SECONDS', 'INSTR/S', 'PEAK')]
+    for result in results:
+        lines.append("{:10s} {:8s} {:>10d} {:>11.6f}s {:>9.3f}s {:>14,.0f} {:>12s}".format(
+            result.workload, result.engine, result.instructions, result.construct_seconds,
+            result.seconds, result.ips,
+            '-' if result.peak_bytes is None else "{:,}".format(result.peak_bytes)))
+    return "\n".join(lines)
+
+
+def describe_peak_memory():
+    '''Return a line saying how the PEAK column was measured.'''
+    if PEAK_MEMORY == 'tracemalloc':
+        return "PEAK: bytes allocated, traced with tracemalloc"
+    if PEAK_MEMORY == 'maxrss':
+        return "PEAK: growth of the maximum resident set size of a child process"
+    return "PEAK: not measured, needs tracemalloc or os.fork"
+
+
+def format_regressions(regressions):
+    return "\n".join("REGRESSION {} {} {}: {:g} -> {:g} ({:+.1%})".format(
+        r.workload, r.engine, r.metric, r.baseline, r.current, r.change) for r in regressions)
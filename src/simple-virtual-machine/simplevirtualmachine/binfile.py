@@ -0,0 +1,189 @@
+'''
+simple-virtual-machine: binary bytecode files.
+
+Layout (all little-endian)::
+
+    header     4s magic "SVM1", H version, H flags, i entry ip,
+               I constant count, I code slot count
+    constants  one int64 per constant
+    code       one int32 per code slot
+
+Opcode slots hold ``Bytecode.opcode``; operand slots hold the operand,
+except ICONST operands, which index the constant section so that code
+slots stay 32 bits wide.
+
+:func:`load` maps the file read-only and checks every opcode against
+``Bytecode.opcodes`` once.  The returned :class:`BinaryProgram` exposes
+the code as a :class:`MappedCode` sequence that reads slots straight from
+the mapping, so processes loading the same file share its pages::
+
+    program = load("prog.svmb")
+    program.vm(engine='decoded').run()
+'''
+
+import mmap
+import struct
+
+from simplevirtualmachine.bytecodes import ICONST, Bytecode, InvalidBytecodeError
+
+MAGIC = b'SVM1'
+VERSION = 1
+HEADER = struct.Struct('<4sHHiII')
+CONSTANT = struct.Struct('<q')
+SLOT = struct.Struct('<i')
+
+# slot kinds, worked out once at load time
+OPERAND = 0
+OPCODE = 1
+CONSTANT_REF = 2
+
+
+class BinaryFormatError(InvalidBytecodeError):
+    """The file is not a valid binary bytecode file."""
+
+
+def dump(code, path, entry=0):
+    '''Write code to path in the binary format.'''
+    constants = []
+    constant_index = {}
+    slots = []
+
+    addr = 0
+    while addr < len(code):
+        bytecode = code[addr]
+        if not isinstance(bytecode, Bytecode):
+            raise BinaryFormatError("expected a bytecode at {}, got {!r}".format(addr, bytecode))
+        end = addr + 1 + bytecode.operands_read
+        if end > len(code):
+            raise BinaryFormatError("{} at {}: missing operands".format(bytecode.name, addr))
+        slots.append(bytecode.opcode)
+        for operand in code[addr + 1:end]:
+            if bytecode is ICONST:
+                if operand not in constant_index:
+                    constant_index[operand] = len(constants)
+                    constants.append(operand)
+                operand = constant_index[operand]
+            slots.append(operand)
+        addr = end
+
+    try:
+        blob = [HEADER.pack(MAGIC, VERSION, 0, entry, len(constants), len(slots))]
+        blob.extend(CONSTANT.pack(value) for value in constants)
+        blob.extend(SLOT.pack(value) for value in slots)
+    except struct.error as e:
+        raise BinaryFormatError("value out of range: {}".format(e))
+
+    with open(path, 'wb') as f:
+        f.write(b''.join(blob))
+
+
+class MappedCode(object):
+    """Read-only code sequence backed by the mapped code section."""
+
+    def __init__(self, buf, offset, kinds, constants_offset):
+        self._buf = buf
+        self._offset = offset
+        self._kinds = kinds
+        self._constants_offset = constants_offset
+
+    def __len__(self):
+        return len(self._kinds)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return tuple(self[i] for i in range(*idx.indices(len(self))))
+        if idx < 0:
+            idx += len(self._kinds)
+        if not 0 <= idx < len(self._kinds):
+            raise IndexError("code address out of range")
+
+        value = SLOT.unpack_from(self._buf, self._offset + 4 * idx)[0]
+        kind = self._kinds[idx]
+        if kind == OPCODE:
+            return Bytecode.opcodes[value]
+        if kind == CONSTANT_REF:
+            return CONSTANT.unpack_from(self._buf, self._constants_offset + 8 * value)[0]
+        return value
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class BinaryProgram(object):
+    """A loaded binary bytecode file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise BinaryFormatError("{}: empty file".format(path))
+
+        try:
+            self._validate()
+        except Exception:
+            self.close()
+            raise
+
+    def _validate(self):
+        buf = self._map
+        if len(buf) < HEADER.size:
+            raise BinaryFormatError("{}: truncated header".format(self.path))
+        magic, version, flags, entry, nconst, nslots = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise BinaryFormatError("{}: not a version {} bytecode file".format(
+                self.path, VERSION))
+        constants_offset = HEADER.size
+        code_offset = constants_offset + CONSTANT.size * nconst
+        if len(buf) != code_offset + SLOT.size * nslots:
+            raise BinaryFormatError("{}: size does not match header".format(self.path))
+
+        slots = struct.unpack_from('<{}i'.format(nslots), buf, code_offset)
+        kinds = bytearray(nslots)
+        addr = 0
+        while addr < nslots:
+            bytecode = Bytecode.opcodes.get(slots[addr])
+            if bytecode is None:
+                raise BinaryFormatError("{}: invalid opcode {} at {}".format(
+                    self.path, slots[addr], addr))
+            end = addr + 1 + bytecode.operands_read
+            if end > nslots:
+                raise BinaryFormatError("{}: {} at {}: missing operands".format(
+                    self.path, bytecode.name, addr))
+            kinds[addr] = OPCODE
+            if bytecode is ICONST:
+                if not 0 <= slots[addr + 1] < nconst:
+                    raise BinaryFormatError("{}: constant {} out of range at {}".format(
+                        self.path, slots[addr + 1], addr))
+                kinds[addr + 1] = CONSTANT_REF
+            addr = end
+
+        if nslots and not (0 <= entry < nslots and kinds[entry] == OPCODE):
+            raise BinaryFormatError("{}: entry {} is not an instruction".format(
+                self.path, entry))
+
+        self.entry = entry
+        self.code = MappedCode(buf, code_offset, kinds, constants_offset)
+
+    def vm(self, **kwargs):
+        '''Return a VM running this program from its entry point.'''
+        from simplevirtualmachine.vm import VM
+
+        kwargs.setdefault('start_ip', self.entry)
+        return VM.from_code(self.code, **kwargs)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load(path):
+    '''Map and validate the binary bytecode file at path.'''
+    return BinaryProgram(path)
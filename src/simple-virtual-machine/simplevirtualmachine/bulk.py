@@ -0,0 +1,171 @@
+'''
+simple-virtual-machine: bulk memory and vector instructions.
+
+Five instructions work on a range of data memory in one step instead of
+a ``GLOAD i; ...; GSTORE i`` loop per cell.  Addresses and the length n
+are operands, like the address of GLOAD::
+
+    MEMSET dst, n         pop v; data[dst:dst+n] = v
+    MEMCPY dst, src, n    data[dst:dst+n] = data[src:src+n]
+    VADD dst, a, b, n     data[dst+i] = data[a+i] + data[b+i] for i < n
+    VMUL dst, a, b, n     data[dst+i] = data[a+i] * data[b+i] for i < n
+    VSUM src, n           push data[src] + ... + data[src+n-1] (0 if n is 0)
+
+Ranges may overlap: an instruction reads its source ranges before it
+writes its destination.  Results follow the VM's integer model, see
+:mod:`simplevirtualmachine.integers` (VSUM wraps or traps its total).
+
+On list memory the instructions run as slice operations.  On array
+memory, with NumPy installed, ranges of at least :data:`NUMPY_MIN_CELLS`
+cells run as NumPy operations on a view of the cells.  NumPy wraps
+int64 results, so under the 'unbounded' and 'trap' models its result is
+only used when the operands are small enough that nothing can have
+overflowed; otherwise the exact slice operation runs.
+'''
+
+import operator
+from array import array
+
+from simplevirtualmachine import memory
+from simplevirtualmachine.bytecodes import MEMSET, MEMCPY, VADD, VMUL, VSUM
+from simplevirtualmachine.integers import INT64_MIN, INT64_MAX
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BULK = (MEMSET, MEMCPY, VADD, VMUL, VSUM)
+
+# shortest range worth a NumPy view
+NUMPY_MIN_CELLS = 64
+
+
+def ranges(bytecode, operands):
+    '''Return the (start, length) data ranges an instruction touches,
+    the destination first.
+
+    >>> ranges(VADD, (8, 0, 4, 4))
+    [(8, 4), (0, 4), (4, 4)]
+    '''
+    return [(addr, operands[-1]) for addr in operands[:-1]]
+
+
+def _reserve(vm, addrs, n):
+    '''Check the ranges of n cells at addrs, growing array memory to hold them.'''
+    if n < 0 or min(addrs) < 0:
+        raise IndexError("data range of {} cell(s) at {} out of range".format(n, min(addrs)))
+    top = max(addrs) + n
+    if top > len(vm.data):
+        if vm.data_written is None:
+            raise IndexError("data address {} out of range".format(top - 1))
+        memory.grow(vm.data, top - 1, vm.data_size, "data", vm.data_written)
+
+
+def _cells(data, values):
+    return values if isinstance(data, list) else array(data.typecode, values)
+
+
+def _written(vm, dst, n):
+    if vm.data_written is not None:
+        vm.data_written[dst:dst + n] = bytearray(b'\x01') * n
+
+
+def _view(vm, n):
+    '''Return a NumPy view of array memory, or None for the slice path.'''
+    if numpy is None or vm.data_written is None or n < NUMPY_MIN_CELLS:
+        return None
+    return numpy.frombuffer(vm.data, dtype=vm.data.typecode)
+
+
+def _magnitude(values):
+    '''Return the largest absolute value in a NumPy array.'''
+    return max(-int(values.min()), int(values.max()))
+
+
+def memset(vm, dst, n, value):
+    '''Set n data cells from dst to value.'''
+    if n:
+        _reserve(vm, (dst,), n)
+        vm.data[dst:dst + n] = _cells(vm.data, [value]) * n
+        _written(vm, dst, n)
+
+
+def memcpy(vm, dst, src, n):
+    '''Copy n data cells from src to dst.'''
+    if n:
+        _reserve(vm, (dst, src), n)
+        data = vm.data
+        data[dst:dst + n] = data[src:src + n]
+        _written(vm, dst, n)
+
+
+def _elementwise(vm, op, dst, a, b, n):
+    if not n:
+        return
+    _reserve(vm, (dst, a, b), n)
+    data = vm.data
+    view = _view(vm, n)
+    if view is not None:
+        x, y = view[a:a + n], view[b:b + n]
+        if op is operator.add:
+            exact = vm.integers == 'wrap' or _magnitude(x) + _magnitude(y) <= INT64_MAX
+        else:
+            exact = vm.integers == 'wrap' or _magnitude(x) * _magnitude(y) <= INT64_MAX
+        if exact:
+            view[dst:dst + n] = x + y if op is operator.add else x * y
+            _written(vm, dst, n)
+            return
+        # the slice assignment below must not find the memory exported
+        del view, x, y
+
+    values = list(map(op, data[a:a + n], data[b:b + n]))
+    normalize = vm.int64
+    if normalize is not None:
+        values = [value if INT64_MIN <= value <= INT64_MAX else normalize(value)
+                  for value in values]
+    data[dst:dst + n] = _cells(data, values)
+    _written(vm, dst, n)
+
+
+def vadd(vm, dst, a, b, n):
+    '''Add n data cells from a and b into the cells from dst.'''
+    _elementwise(vm, operator.add, dst, a, b, n)
+
+
+def vmul(vm, dst, a, b, n):
+    '''Multiply n data cells from a and b into the cells from dst.'''
+    _elementwise(vm, operator.mul, dst, a, b, n)
+
+
+def vsum(vm, src, n):
+    '''Return the sum of n data cells from src.'''
+    if not n:
+        return 0
+    _reserve(vm, (src,), n)
+    view = _view(vm, n)
+    if view is not None:
+        values = view[src:src + n]
+        if vm.integers == 'wrap' or _magnitude(values) * n <= INT64_MAX:
+            return int(values.sum())
+    total = sum(vm.data[src:src + n])
+    if vm.int64 is not None and not INT64_MIN <= total <= INT64_MAX:
+        total = vm.int64(total)
+    return total
+
+
+FUNCTIONS = {MEMSET: memset, MEMCPY: memcpy, VADD: vadd, VMUL: vmul, VSUM: vsum}
+
+
+def execute(vm, bytecode, operands):
+    '''Run a bulk instruction on vm: MEMSET pops its value and VSUM pushes
+    the sum.  Like the other handlers, it writes sp last.'''
+    if bytecode is MEMSET:
+        memset(vm, operands[0], operands[1], vm.stack[vm.sp])
+        vm.sp -= 1
+    elif bytecode is VSUM:
+        sp = vm.sp + 1
+        vm.stack[sp] = vsum(vm, operands[0], operands[1])
+        vm.sp = sp
+    else:
+        FUNCTIONS[bytecode](vm, *operands)
@@ -1,5 +1,10 @@
 import logging
 
+# values pushed by ILT/IEQ and tested by BRT/BRF
+TRUE = 1
+FALSE = 0
+
+
 class InvalidBytecodeError(Exception):
     def __init__(self, bytecode):
         self.bytecode = bytecode
@@ -9,13 +14,19 @@ class InvalidBytecodeError(Exception):
 
 
 class Bytecode(object):
-    """ A bytecode in our simple virtual machine."""
+    """ A bytecode in our simple virtual machine.
+
+    ``operand_count`` is the declared operand count; ``operands_read`` is how
+    many code slots the interpreter actually consumes after the opcode (they
+    only differ for POP).
+    """
     opcodes = {}
 
-    def __init__(self, name, opcode, operand_count=0):
+    def __init__(self, name, opcode, operand_count=0, operands_read=None):
         self.name = name
         self.opcode = opcode
         self.operand_count = operand_count
+        self.operands_read = operand_count if operands_read is None else operands_read
         self.logger = logging.getLogger(__name__)
         Bytecode.opcodes[self.opcode] = self
 
@@ -23,6 +34,10 @@ class Bytecode(object):
         return "Bytecode name: {}\topcode: {:02d}\toperand_count: {:02d}".format(
             self.name.ljust(10), self.opcode, self.operand_count)
 
+    def __reduce__(self):
+        # unpickle to the registered instance so `is` comparisons hold
+        return _registered, (self.opcode,)
+
     def dump_bytecode(self):
         return "{} ({})".format(self.name, self.operand_count)
 
@@ -31,6 +46,10 @@ class Bytecode(object):
         return cls.opcodes[opcode]
 
 
+def _registered(opcode):
+    return Bytecode.opcodes[opcode]
+
+
 INVALID = Bytecode("INVALID", 0)
 IADD = Bytecode("IADD", 1)
 ISUB = Bytecode("ISUB", 2)
@@ -46,7 +65,15 @@ GLOAD = Bytecode("GLOAD", 11, 1)
 STORE = Bytecode("STORE", 12, 1)
 GSTORE = Bytecode("GSTORE", 13, 1)
 PUTS = Bytecode("PUTS", 14)
-POP = Bytecode("POP", 15, 1)
+POP = Bytecode("POP", 15, 1, operands_read=0)
 CALL = Bytecode("CALL", 16, 2)
 RET = Bytecode("RET", 17)
 HALT = Bytecode("HALT", 18)
+# tail call: CALL that replaces the current frame
+TCALL = Bytecode("TCALL", 19, 2)
+# bulk memory and vector operations on data memory, see simplevirtualmachine.bulk
+MEMSET = Bytecode("MEMSET", 20, 2)
+MEMCPY = Bytecode("MEMCPY", 21, 3)
+VADD = Bytecode("VADD", 22, 4)
+VMUL = Bytecode("VMUL", 23, 4)
+VSUM = Bytecode("VSUM", 24, 2)
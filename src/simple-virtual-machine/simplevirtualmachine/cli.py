@@ -0,0 +1,149 @@
+'''
+simple-virtual-machine: command line interface.
+
+Usage:
+  simple-virtual-machine run <program> [options]
+  simple-virtual-machine bench [options]
+  simple-virtual-machine (-h | --help)
+  simple-virtual-machine --version
+
+Options:
+  -h --help           Show this screen.
+  --version           Show version.
+  --engine=<engine>   Interpreter engine: switch, table, decoded or compiled
+                      [default: decoded].
+  --memory=<memory>   Memory backend: list or array [default: list].
+  --integers=<model>  Integer model: unbounded, wrap or trap
+                      [default: unbounded].
+  --fuse              Fuse common instruction sequences (decoded engine).
+  --profile           Print per-opcode, per-address and per-function counts
+                      and time after the run.
+  --folded=<file>     With --profile, also write folded call stacks to file.
+  --bench=<n>         Run the program n times and report instructions/sec.
+  --scale=<x>         bench: multiply the workload sizes by x [default: 1.0].
+  --repeat=<n>        bench: best of n runs [default: 3].
+  --engines=<list>    bench: comma-separated engines
+                      [default: switch,table,decoded,compiled].
+  --json=<file>       bench: write the results to file as JSON.
+  --baseline=<file>   bench: compare with results saved by --json, exit 1
+                      on a regression.
+  --threshold=<x>     bench: allowed growth over the baseline, as a
+                      fraction [default: 0.1].
+  -v --verbose        Log at INFO level.
+
+<program> is a .svm assembly file (assembled through the parse cache) or a
+.svmb binary bytecode file.  ``bench`` runs the benchmark suite of
+simplevirtualmachine.bench.suite.
+'''
+
+import logging
+import sys
+
+from simplevirtualmachine import bench
+from simplevirtualmachine.assembler import assemble_file
+from simplevirtualmachine.binfile import load
+from simplevirtualmachine.config import ENGINES
+from simplevirtualmachine.profiler import Profiler
+
+VERSION = 'simple-virtual-machine 0.2'
+
+
+def load_program(path):
+    '''Return the program at path; .svmb files are binary, others assembly.'''
+    if path.endswith('.svmb'):
+        return load(path)
+    return assemble_file(path)
+
+
+def run(program, **kwargs):
+    '''Run program once; returns the VM.'''
+    vm = program.vm(**kwargs)
+    vm.run()
+    return vm
+
+
+def profile(program, out=None, folded=None, **kwargs):
+    '''Run program once under a Profiler and print its report.
+
+    folded is an optional path for the folded call stacks.
+    '''
+    out = out or sys.stdout
+    labels = getattr(program, 'labels', None) or {}
+    profiler = Profiler(names=dict((addr, name) for name, addr in labels.items()))
+    vm = program.vm(trace=profiler, **kwargs)
+    profiler.start()
+    vm.run()
+    out.write(profiler.report() + "\n")
+    if folded:
+        with open(folded, 'w') as f:
+            f.write(profiler.folded())
+    return vm
+
+
+def benchmark(program, runs, out=None, **kwargs):
+    '''Run program runs times with its output discarded; print the stats.'''
+    out = out or sys.stdout
+    times = []
+    steps = 0
+    for _ in range(runs):
+        vm = program.vm(output='null', **kwargs)
+        seconds = bench.timed(vm.run)
+        times.append(seconds)
+        steps = vm.steps
+
+    stats = bench.summarize(times)
+    out.write("{} runs, {} instructions per run\n".format(runs, steps))
+    for label in ('min', 'median', 'p99'):
+        seconds = stats[label]
+        out.write("{:6s} {:10.6f}s {:>14,.0f} instr/s\n".format(
+            label, seconds, steps / seconds if seconds else float('inf')))
+    return stats
+
+
+def bench_suite(scale=1.0, repeat=3, engines=ENGINES, json_path=None, baseline=None,
+                threshold=0.1, out=None):
+    '''Run the benchmark suite and print the results; returns the exit
+    status, 1 if a result regressed against baseline.'''
+    from simplevirtualmachine.bench import suite
+
+    out = out or sys.stdout
+    results = suite.run_suite(scale, repeat, engines)
+    out.write(suite.format_results(results) + "\n")
+    out.write(suite.describe_peak_memory() + "\n")
+    if json_path:
+        suite.save(results, json_path, scale=scale, repeat=repeat)
+    if baseline:
+        regressions = suite.compare(results, suite.load(baseline), threshold)
+        if regressions:
+            out.write(suite.format_regressions(regressions) + "\n")
+            return 1
+    return 0
+
+
+def main(argv=None):
+    from docopt import docopt
+
+    arguments = docopt(__doc__, argv=argv, version=VERSION)
+
+    logging.basicConfig(level=logging.INFO if arguments['--verbose'] else logging.WARNING,
+                        datefmt='%y-%m-%d %H:%M:%S',
+                        format='%(asctime)s %(name)-12s %(funcName)s %(filename)s:%(lineno)d '
+                               '%(levelname)-8s %(message)s')
+
+    if arguments['bench']:
+        logging.disable(logging.INFO)
+        return bench_suite(float(arguments['--scale']), int(arguments['--repeat']),
+                           arguments['--engines'].split(','), arguments['--json'],
+                           arguments['--baseline'], float(arguments['--threshold']))
+
+    kwargs = {'engine': arguments['--engine'], 'memory': arguments['--memory'],
+              'integers': arguments['--integers'], 'fuse': arguments['--fuse']}
+    program = load_program(arguments['<program>'])
+
+    if arguments['--profile']:
+        profile(program, folded=arguments['--folded'], **kwargs)
+    elif arguments['--bench']:
+        benchmark(program, int(arguments['--bench']), **kwargs)
+    else:
+        run(program, **kwargs)
+    return 0
@@ -0,0 +1,409 @@
+'''
+simple-virtual-machine: compile basic blocks to Python functions.
+
+``VM(..., engine='compiled')`` runs straight-line runs of code as
+generated Python functions instead of one handler call per instruction.
+A block starts at any address control reaches and ends at the first BR,
+BRT, BRF, CALL, TCALL, RET or HALT; blocks are compiled on first entry.
+
+Inside a block the operand stack is modelled with local variables: a
+value pushed by ICONST, GLOAD, LOAD or arithmetic stays in a local until
+it is consumed, and only what is still on the stack when the block ends
+(or before a LOAD, STORE or CALL, which may touch stack memory directly)
+is written back.  The block for the ``test_loop`` condition::
+
+    GLOAD 1; GLOAD 0; ILT; BRF 24
+
+becomes::
+
+    def block_0008(vm):
+        data = vm.data
+        t0 = data[1]
+        t1 = data[0]
+        t2 = 1 if t0 < t1 else 0
+        return 24 if t2 == 0 else 15
+
+MEMSET, MEMCPY, VADD, VMUL and VSUM compile to calls of the functions
+in :mod:`simplevirtualmachine.bulk`, with MEMSET's value and VSUM's sum
+kept in locals like any other stack value.
+
+Under the int64 integer models each IADD, ISUB and IMUL result is
+checked against the int64 range inline and wrapped or trapped only when
+it is out of range, see :mod:`simplevirtualmachine.integers`.  With
+array memory the same check covers the 'unbounded' model, and VSUM
+results and ICONST operands too: a value kept in a local raises
+OverflowError where the other engines would fail to store it in a cell.
+
+Compiled programs are kept in an LRU cache keyed by the code, memory
+kind and integer model, so VMs running the same code share them; see
+:func:`cache_info`.
+
+If an instruction raises in the middle of a block, registers are left as
+they were at the start of the block.
+
+For a VM with memoization, CALLs to the pure functions in ``pure`` ask
+the VM's memo cache first and RETs store results in it, see
+:mod:`simplevirtualmachine.memo`.
+'''
+
+import collections
+import re
+
+from simplevirtualmachine import bulk, memory
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, IEQ, BR, BRT, BRF, \
+    ICONST, LOAD, GLOAD, STORE, GSTORE, PUTS, POP, CALL, RET, HALT, TCALL, MEMSET, VSUM, \
+    TRUE, FALSE, Bytecode, InvalidBytecodeError
+from simplevirtualmachine.decoder import DecodeError
+from simplevirtualmachine.integers import ARITHMETIC, INT64_MIN, INT64_MAX, normalizer
+
+# compiled programs kept by compiled_program()
+CACHE_SIZE = 32
+
+_BINARY = {IADD: "{} + {}", ISUB: "{} - {}", IMUL: "{} * {}",
+           ILT: "{} if {{}} < {{}} else {}".format(TRUE, FALSE),
+           IEQ: "{} if {{}} == {{}} else {}".format(TRUE, FALSE)}
+
+_ENDS = (BR, BRT, BRF, CALL, TCALL, RET, HALT)
+
+# block locals, in the order the prologue loads them
+_LOCALS = (('stack', 'vm.stack'), ('sp', 'vm.sp'), ('fp', 'vm.fp'), ('data', 'vm.data'),
+           ('written', 'vm.data_written'), ('write', 'vm.output.write'))
+_NAME = re.compile(r'(?<![.\w])(stack|sp|fp|data|written|write)\b')
+
+
+def _offset(rel, register="sp"):
+    if rel > 0:
+        return "{} + {}".format(register, rel)
+    if rel < 0:
+        return "{} - {}".format(register, -rel)
+    return register
+
+
+class _Block(object):
+    """Source generator for one block, tracking the modelled stack."""
+
+    def __init__(self, code, start, tracked, pure=frozenset(), integers='unbounded'):
+        self.code = code
+        self.start = start
+        self.tracked = tracked
+        self.pure = pure
+        # values must fit in 64 bits, for an int64 model or array cells
+        self.int64 = integers != 'unbounded' or tracked
+        self.body = []
+        self.values = []    # expressions on the stack above memory
+        self.rel = 0        # memory stack top relative to sp on entry
+        self.top = 0        # highest rel written to memory
+        self.temps = 0
+        self.cells = -1     # highest data address used
+        self.steps = 0
+
+    def emit(self, line):
+        self.body.append("    " + line)
+
+    def temp(self, expression):
+        name = "t{}".format(self.temps)
+        self.temps += 1
+        self.emit("{} = {}".format(name, expression))
+        return name
+
+    def push(self, expression):
+        self.values.append(expression)
+
+    def pop(self):
+        if self.values:
+            return self.values.pop()
+        value = self.temp("stack[{}]".format(_offset(self.rel)))
+        self.rel -= 1
+        return value
+
+    def spill(self):
+        '''Write the modelled values to stack memory.'''
+        for value in self.values:
+            self.rel += 1
+            self.emit("stack[{}] = {}".format(_offset(self.rel), value))
+        self.top = max(self.top, self.rel)
+        self.values = []
+
+    def commit(self):
+        self.spill()
+        if self.rel:
+            self.emit("vm.sp = {}".format(_offset(self.rel)))
+
+    def build(self):
+        code = self.code
+        addr = self.start
+        while True:
+            bytecode = code[addr] if addr < len(code) else None
+            if not isinstance(bytecode, Bytecode) or bytecode not in _GENERATORS:
+                if addr != self.start:
+                    # end the block here; the fault gets a block of its own
+                    self.commit()
+                    self.emit("return {}".format(addr))
+                elif addr >= len(code):
+                    self.emit("raise IndexError('code address {} out of range')".format(addr))
+                else:
+                    self.steps += 1
+                    self.emit("raise InvalidBytecodeError('Invalid opcode {{}} at ip = {}'"
+                              ".format(vm.code[{}]))".format(addr, addr))
+                break
+            width = bytecode.operands_read
+            if addr + width >= len(code):
+                raise DecodeError("{} at {} is missing operands".format(bytecode.name, addr))
+            operands = code[addr + 1:addr + 1 + width]
+            self.emit("# {:04d}: {} {}".format(
+                addr, bytecode.name, " ".join(str(op) for op in operands)).rstrip())
+            next_addr = addr + 1 + width
+            if bytecode is HALT:
+                self.commit()
+                self.emit("vm.ip = {}".format(addr))
+                self.emit("return None")
+                break
+            self.steps += 1
+            _GENERATORS[bytecode](self, bytecode, operands, next_addr)
+            if bytecode in _ENDS:
+                break
+            addr = next_addr
+
+        checks = []
+        if self.tracked:
+            # array memory: grow before the block so it never reruns
+            if self.top > 0:
+                checks.append("    if sp + {0} >= len(stack):\n"
+                              "        memory.grow(stack, sp + {0}, vm.stack_size, 'stack')".format(
+                                  self.top))
+            if self.cells >= 0:
+                checks.append("    if {0} >= len(data):\n"
+                              "        memory.grow(data, {0}, vm.data_size, 'data', written)"
+                              .format(self.cells))
+        used = set(_NAME.findall("\n".join(checks + self.body)))
+        head = ["def block_{:04d}(vm):".format(self.start)]
+        head.extend("    {} = {}".format(name, source) for name, source in _LOCALS if name in used)
+        return "\n".join(head + checks + self.body) + "\n"
+
+
+def _binary(block, bytecode, operands, next_addr):
+    b = block.pop()
+    a = block.pop()
+    value = block.temp(_BINARY[bytecode].format(a, b))
+    if bytecode in ARITHMETIC:
+        _check(block, value)
+    block.push(value)
+
+
+def _check(block, value):
+    if block.int64:
+        block.emit("if not {} <= {} <= {}:".format(INT64_MIN, value, INT64_MAX))
+        block.emit("    {0} = int64({0})".format(value))
+
+
+def _branch(block, bytecode, operands, next_addr):
+    target = operands[0]
+    if bytecode is BR:
+        block.commit()
+        block.emit("return {}".format(target))
+        return
+    value = block.pop()
+    block.commit()
+    block.emit("return {} if {} == {} else {}".format(
+        target, value, TRUE if bytecode is BRT else FALSE, next_addr))
+
+
+def _iconst(block, bytecode, operands, next_addr):
+    value = operands[0]
+    if block.int64 and not INT64_MIN <= value <= INT64_MAX:
+        block.push(block.temp("int64({!r})".format(value)))
+    else:
+        block.push(repr(value))
+
+
+def _load(block, bytecode, operands, next_addr):
+    block.spill()
+    block.push(block.temp("stack[{}]".format(_offset(operands[0], "fp"))))
+
+
+def _store(block, bytecode, operands, next_addr):
+    value = block.pop()
+    block.spill()
+    block.emit("stack[{}] = {}".format(_offset(operands[0], "fp"), value))
+
+
+def _gload(block, bytecode, operands, next_addr):
+    block.cells = max(block.cells, operands[0])
+    block.push(block.temp("data[{}]".format(operands[0])))
+
+
+def _gstore(block, bytecode, operands, next_addr):
+    block.cells = max(block.cells, operands[0])
+    block.emit("data[{}] = {}".format(operands[0], block.pop()))
+    if block.tracked:
+        block.emit("written[{}] = 1".format(operands[0]))
+
+
+def _puts(block, bytecode, operands, next_addr):
+    block.emit("write({})".format(block.pop()))
+
+
+def _pop(block, bytecode, operands, next_addr):
+    block.pop()
+
+
+def _bulk(block, bytecode, operands, next_addr):
+    args = ", ".join(str(op) for op in operands)
+    if bytecode is MEMSET:
+        block.emit("bulk.memset(vm, {}, {})".format(args, block.pop()))
+    elif bytecode is VSUM:
+        value = block.temp("bulk.vsum(vm, {})".format(args))
+        _check(block, value)
+        block.push(value)
+    else:
+        block.emit("bulk.{}(vm, {})".format(bytecode.name.lower(), args))
+
+
+def _call(block, bytecode, operands, next_addr):
+    target, nargs = operands
+    block.spill()
+    rel = block.rel
+    if target in block.pure:
+        block.commit()
+        block.emit("if vm.memo_call({}, {}):".format(target, nargs))
+        block.emit("    return {}".format(next_addr))
+    block.emit("stack[{}] = {}".format(_offset(rel + 1), nargs))
+    block.emit("stack[{}] = vm.fp".format(_offset(rel + 2)))
+    block.emit("stack[{}] = {}".format(_offset(rel + 3), next_addr))
+    block.emit("vm.sp = vm.fp = {}".format(_offset(rel + 3)))
+    block.top = max(block.top, rel + 3)
+    block.emit("return {}".format(target))
+
+
+def _tcall(block, bytecode, operands, next_addr):
+    target, nargs = operands
+    block.spill()
+    rel = block.rel
+    block.top = max(block.top, rel + 3)
+    # the entry frame has no frame to replace
+    block.emit("if fp < 0:")
+    block.emit("    stack[{}] = {}".format(_offset(rel + 1), nargs))
+    block.emit("    stack[{}] = fp".format(_offset(rel + 2)))
+    block.emit("    stack[{}] = {}".format(_offset(rel + 3), next_addr))
+    block.emit("    vm.sp = vm.fp = {}".format(_offset(rel + 3)))
+    block.emit("    return {}".format(target))
+    block.emit("base = fp - 2 - stack[fp - 2]")
+    block.emit("saved_fp = stack[fp - 1]")
+    block.emit("return_ip = stack[fp]")
+    if nargs:
+        block.emit("stack[base:base + {}] = stack[{}:{}]".format(
+            nargs, _offset(rel - nargs + 1), _offset(rel + 1)))
+    block.emit("stack[base + {}] = {}".format(nargs, nargs))
+    block.emit("stack[base + {}] = saved_fp".format(nargs + 1))
+    block.emit("stack[base + {}] = return_ip".format(nargs + 2))
+    block.emit("vm.sp = vm.fp = base + {}".format(nargs + 2))
+    if block.pure:
+        block.emit("vm.memo_tail(fp, base + {})".format(nargs + 2))
+    block.emit("return {}".format(target))
+
+
+def _ret(block, bytecode, operands, next_addr):
+    value = block.pop()
+    block.spill()
+    if block.pure:
+        block.emit("vm.memo_return({})".format(value))
+    block.emit("ip = stack[fp]")
+    block.emit("vm.fp = stack[fp - 1]")
+    block.emit("sp = fp - 2 - stack[fp - 2]")
+    block.emit("stack[sp] = {}".format(value))
+    block.emit("vm.sp = sp")
+    block.emit("return ip")
+
+
+_GENERATORS = {ICONST: _iconst, LOAD: _load, STORE: _store, GLOAD: _gload,
+               GSTORE: _gstore, PUTS: _puts, POP: _pop, CALL: _call, TCALL: _tcall, RET: _ret,
+               HALT: None}
+_GENERATORS.update((bytecode, _binary) for bytecode in _BINARY)
+_GENERATORS.update((bytecode, _branch) for bytecode in (BR, BRT, BRF))
+_GENERATORS.update((bytecode, _bulk) for bytecode in bulk.BULK)
+
+
+def block_source(code, start, tracked=False, pure=frozenset(), integers='unbounded'):
+    '''Return the Python source of the block starting at start.'''
+    return _Block(code, start, tracked, pure, integers).build()
+
+
+class _Blocks(dict):
+    """Compiled blocks by start address, compiled on first lookup."""
+
+    def __init__(self, program):
+        super(_Blocks, self).__init__()
+        self.program = program
+
+    def __missing__(self, addr):
+        function = self.program.compile_block(addr)
+        self[addr] = function
+        return function
+
+
+class CompiledProgram(object):
+    """Code compiled block by block; ``blocks[addr]`` is the function for
+    the block starting at addr.
+
+    Each function takes the VM, runs the block and returns the next ip,
+    or None at HALT; its ``steps`` attribute is the number of instructions
+    it executes.
+    """
+
+    def __init__(self, code, tracked=False, pure=frozenset(), integers='unbounded'):
+        self.code = code
+        self.tracked = tracked
+        self.pure = pure
+        self.integers = integers
+        # array cells hold int64 whatever the model
+        self.int64 = normalizer(integers) or (memory.cell if tracked else None)
+        self.sources = {}
+        self.blocks = _Blocks(self)
+
+    def compile_block(self, addr):
+        block = _Block(self.code, addr, self.tracked, self.pure, self.integers)
+        source = block.build()
+        namespace = {'InvalidBytecodeError': InvalidBytecodeError, 'memory': memory,
+                     'bulk': bulk, 'int64': self.int64}
+        exec(compile(source, "<svm block {:04d}>".format(addr), "exec"), namespace)
+        function = namespace["block_{:04d}".format(addr)]
+        function.steps = block.steps
+        self.sources[addr] = source
+        return function
+
+
+_cache = collections.OrderedDict()
+_stats = {'hits': 0, 'misses': 0}
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses size maxsize')
+
+
+def compiled_program(code, tracked=False, pure=frozenset(), integers='unbounded'):
+    '''Return the CompiledProgram for code, from the LRU cache if possible.
+
+    tracked selects code for array memory, which also grows memory and
+    marks written data cells; pure is the set of CALL targets to memoize
+    and integers the integer model.
+    '''
+    key = (tuple(code), tracked, frozenset(pure), integers)
+    program = _cache.pop(key, None)
+    if program is None:
+        _stats['misses'] += 1
+        program = CompiledProgram(key[0], tracked, key[2], integers)
+        if len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _stats['hits'] += 1
+    _cache[key] = program
+    return program
+
+
+def cache_info():
+    '''Return the compiled-program cache statistics.'''
+    return CacheInfo(_stats['hits'], _stats['misses'], len(_cache), CACHE_SIZE)
+
+
+def clear_cache():
+    '''Drop all compiled programs and reset the statistics.'''
+    _cache.clear()
+    _stats['hits'] = _stats['misses'] = 0
@@ -0,0 +1,93 @@
+'''
+simple-virtual-machine: per-instance VM configuration.
+
+A :class:`VMConfig` is immutable, so one instance can be shared by any
+number of VMs (and threads) without one VM's settings leaking into the
+next::
+
+    small = VMConfig(stack_size=256, engine='decoded', memory='array')
+    vms = [VM(*code, config=small) for code in programs]
+
+Keyword arguments given to ``VM`` override the matching config fields
+for that VM only.
+'''
+
+import collections
+
+from simplevirtualmachine.integers import MODELS as INTEGERS
+
+DEFAULT_STACK_SIZE = 10000
+
+ENGINES = ('switch', 'table', 'decoded', 'compiled')
+MEMORIES = ('list', 'array')
+
+_FIELDS = ('stack_size', 'data_size', 'start_ip', 'engine', 'memory', 'trace', 'fuse',
+           'output', 'verify', 'optimize', 'memoize', 'integers')
+
+
+class VMConfig(collections.namedtuple('VMConfig', _FIELDS)):
+    """Immutable VM settings.
+
+    ``stack_size`` and ``data_size`` are the number of stack and data cells
+    (the caps when memory is 'array'); data_size defaults to stack_size.
+    ``trace`` is the value passed to
+    :func:`simplevirtualmachine.trace.make_tracer`, so an int gives every
+    VM its own ring buffer.  ``fuse`` turns on superinstruction fusion
+    (decoded engine only).  ``output`` is the value passed to
+    :func:`simplevirtualmachine.output.make_sink`; the default gives every
+    VM its own buffered stdout sink.  ``verify`` checks the code with
+    :func:`simplevirtualmachine.verifier.verify` when the VM is built.
+    ``optimize`` is the :func:`simplevirtualmachine.optimizer.optimize`
+    level the code is rewritten with first (0: off).  ``memoize`` is the
+    value passed to :func:`simplevirtualmachine.memo.make_cache`, so an
+    int gives every VM its own cache of that size.  ``integers`` is the
+    integer model, see :mod:`simplevirtualmachine.integers`.
+
+    >>> config = VMConfig(stack_size=100)
+    >>> config.data_size, config.engine
+    (100, 'switch')
+    >>> config.replace(engine='table').engine
+    'table'
+    """
+    __slots__ = ()
+
+    def __new__(cls, stack_size=DEFAULT_STACK_SIZE, data_size=None, start_ip=0,
+                engine='switch', memory='list', trace=None, fuse=False, output=None,
+                verify=False, optimize=0, memoize=None, integers='unbounded'):
+        if data_size is None:
+            data_size = stack_size
+        if engine not in ENGINES:
+            raise ValueError("unknown engine {!r}, expected one of {}".format(
+                engine, ", ".join(ENGINES)))
+        if memory not in MEMORIES:
+            raise ValueError("unknown memory {!r}, expected one of {}".format(
+                memory, ", ".join(MEMORIES)))
+        if integers not in INTEGERS:
+            raise ValueError("unknown integers {!r}, expected one of {}".format(
+                integers, ", ".join(INTEGERS)))
+        if memory == 'array' and engine == 'switch':
+            raise ValueError("memory='array' needs the 'table', 'decoded' or 'compiled' engine")
+        if fuse and engine != 'decoded':
+            raise ValueError("fuse=True needs the 'decoded' engine")
+        if optimize not in (0, 1, 2):
+            raise ValueError("optimize must be 0, 1 or 2")
+        if stack_size < 1 or data_size < 0:
+            raise ValueError("stack_size must be positive and data_size not negative")
+        return super(VMConfig, cls).__new__(cls, stack_size, data_size, start_ip,
+                                            engine, memory, trace, fuse, output, verify,
+                                            optimize, memoize, integers)
+
+    def replace(self, **changes):
+        '''Return a copy with the given fields changed, validated again.'''
+        unknown = set(changes) - set(self._fields)
+        if unknown:
+            raise TypeError("unknown VM setting(s): {}".format(", ".join(sorted(unknown))))
+        if 'stack_size' in changes and 'data_size' not in changes \
+                and self.data_size == self.stack_size:
+            changes['data_size'] = None
+        fields = self._asdict()
+        fields.update(changes)
+        return VMConfig(**fields)
+
+
+DEFAULT_CONFIG = VMConfig()
@@ -0,0 +1,120 @@
+'''
+simple-virtual-machine: load-time decoding of code tuples.
+
+:func:`decode` walks a code tuple once and turns it into a list of
+:class:`Instruction` records, each carrying its handler and its operands
+already fetched.  Branch and CALL targets are remapped from code addresses
+to record indices, so a target that does not start an instruction is
+rejected here rather than misbehaving at run time.
+'''
+
+from simplevirtualmachine.bytecodes import INVALID, BR, BRT, BRF, CALL, TCALL, \
+    Bytecode, InvalidBytecodeError
+
+BRANCHES = (BR, BRT, BRF, CALL, TCALL)
+
+
+class DecodeError(InvalidBytecodeError):
+    """The code tuple cannot be decoded into instructions."""
+
+
+class Instruction(object):
+    """One decoded instruction.
+
+    ``op1``/``op2`` hold the operands; for BR/BRT/BRF/CALL/TCALL ``op1`` is the
+    index of the target record.  ``next`` is the index of the following
+    record.
+    """
+    __slots__ = ('addr', 'bytecode', 'handler', 'op1', 'op2', 'next')
+
+    def __init__(self, addr, bytecode, handler, op1=None, op2=None, next=None):
+        self.addr = addr
+        self.bytecode = bytecode
+        self.handler = handler
+        self.op1 = op1
+        self.op2 = op2
+        self.next = next
+
+    def __repr__(self):
+        return "Instruction({}, {}, {!r}, {!r})".format(
+            self.addr, self.bytecode.name, self.op1, self.op2)
+
+
+class Program(object):
+    """A decoded code tuple.
+
+    ``index[addr]`` is the record index of the instruction that starts at
+    code address addr, or None when addr is inside an instruction.
+    ``fusions`` counts the superinstructions built by
+    :func:`simplevirtualmachine.fusion.fuse`.
+    """
+
+    def __init__(self, code, instructions, index, fusions=None):
+        self.code = code
+        self.instructions = instructions
+        self.index = index
+        self.fusions = fusions if fusions is not None else {}
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def end_of(self, pc):
+        '''Return the code address just past record pc.'''
+        if pc + 1 < len(self.instructions):
+            return self.instructions[pc + 1].addr
+        return len(self.code)
+
+    def index_of(self, addr):
+        '''Return the record index for code address addr.
+
+        Raises DecodeError when addr does not start an instruction.
+        '''
+        if 0 <= addr < len(self.index) and self.index[addr] is not None:
+            return self.index[addr]
+        raise DecodeError("address {} is not an instruction boundary".format(addr))
+
+
+def decode(code, handlers):
+    '''Decode code into a Program.
+
+    handlers is a sequence indexed by integer opcode; entries for unknown
+    opcodes should be the invalid-opcode handler.  Non-bytecode values found
+    where an instruction should start decode as INVALID, which fails only if
+    it is executed, exactly like the interpreter loop.
+
+    >>> from simplevirtualmachine.bytecodes import ICONST, BR, HALT
+    >>> decode((ICONST, 1, BR, 0, HALT), [None] * 32).instructions[1]
+    Instruction(2, BR, 0, None)
+    >>> decode((BR, 1, HALT), [None] * 32)
+    Traceback (most recent call last):
+    ...
+    DecodeError: 'BR at 0: target 1 is not an instruction boundary'
+    '''
+    instructions = []
+    index = [None] * len(code)
+
+    addr = 0
+    while addr < len(code):
+        bytecode = code[addr]
+        if not isinstance(bytecode, Bytecode) or bytecode.opcode >= len(handlers):
+            bytecode = INVALID
+        end = addr + 1 + bytecode.operands_read
+        if end > len(code):
+            raise DecodeError("{} at {}: missing operands".format(bytecode.name, addr))
+        operands = tuple(code[addr + 1:end]) + (None, None)
+
+        index[addr] = len(instructions)
+        instructions.append(Instruction(addr, bytecode, handlers[bytecode.opcode],
+                                        operands[0], operands[1], len(instructions) + 1))
+        addr = end
+
+    for instr in instructions:
+        if instr.bytecode in BRANCHES:
+            target = instr.op1
+            if not (isinstance(target, int) and 0 <= target < len(code)) \
+                    or index[target] is None:
+                raise DecodeError("{} at {}: target {} is not an instruction boundary".format(
+                    instr.bytecode.name, instr.addr, target))
+            instr.op1 = index[target]
+
+    return Program(code, instructions, index)
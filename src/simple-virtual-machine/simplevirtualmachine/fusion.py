@@ -0,0 +1,246 @@
+'''
+simple-virtual-machine: superinstruction fusion.
+
+:func:`fuse` rewrites a decoded :class:`~simplevirtualmachine.decoder.Program`
+so that common instruction sequences run as one record with a specialised
+handler, e.g. ``GLOAD a; GLOAD b; ILT; BRF t`` becomes a single
+compare-and-branch that never touches the stack.  Enable it with
+``VM(..., engine='decoded', fuse=True)``.
+
+A sequence is only fused when no branch, CALL return or the start address
+lands inside it, and branch targets are remapped to the fused records.
+Fused handlers write memory last, like the plain ones, so array memory
+growth can rerun them.  Their arithmetic follows the VM's integer model,
+see :mod:`simplevirtualmachine.integers`.
+
+:func:`report` runs a program with and without fusion and returns which
+fusions fired and the dynamic instruction counts.
+'''
+
+import collections
+import operator
+
+from simplevirtualmachine.bytecodes import ILT, IEQ, \
+    BR, BRT, BRF, ICONST, LOAD, GLOAD, GSTORE, CALL, TCALL, TRUE, FALSE
+from simplevirtualmachine.decoder import Instruction, Program
+from simplevirtualmachine.integers import ARITHMETIC, arithmetic
+
+COMPARE = {ILT: operator.lt, IEQ: operator.eq}
+BINARY = dict(ARITHMETIC)
+BINARY.update({
+    ILT: lambda a, b: TRUE if a < b else FALSE,
+    IEQ: lambda a, b: TRUE if a == b else FALSE,
+})
+JUMPS = {BRT: True, BRF: False}
+
+
+def operations(integers='unbounded'):
+    '''Return :data:`BINARY` with the arithmetic of integer model integers.'''
+    ops = dict(BINARY)
+    ops.update(arithmetic(integers))
+    return ops
+
+
+class Superinstruction(object):
+    """Stands in for the bytecode of a fused record."""
+
+    def __init__(self, name, components):
+        self.name = name
+        self.components = components
+
+    def __repr__(self):
+        return "Superinstruction({})".format(self.name)
+
+
+def _const_op(op, k):
+    def handler(vm, ins):
+        stack = vm.stack
+        stack[vm.sp] = op(stack[vm.sp], k)
+        return ins.next
+    return handler
+
+
+def _cmp_branch(cmp, jump_if, target):
+    def handler(vm, ins):
+        stack = vm.stack
+        sp = vm.sp
+        taken = cmp(stack[sp - 1], stack[sp]) == jump_if
+        vm.sp = sp - 2
+        return target if taken else ins.next
+    return handler
+
+
+def _load_const_cmp_branch(offset, k, cmp, jump_if, target):
+    def handler(vm, ins):
+        if cmp(vm.stack[vm.fp + offset], k) == jump_if:
+            return target
+        return ins.next
+    return handler
+
+
+def _gload_const_cmp_branch(addr, k, cmp, jump_if, target):
+    def handler(vm, ins):
+        if cmp(vm.data[addr], k) == jump_if:
+            return target
+        return ins.next
+    return handler
+
+
+def _gload_gload_cmp_branch(a, b, cmp, jump_if, target):
+    def handler(vm, ins):
+        data = vm.data
+        if cmp(data[a], data[b]) == jump_if:
+            return target
+        return ins.next
+    return handler
+
+
+def _gload_gload_op(a, b, op):
+    def handler(vm, ins):
+        data = vm.data
+        sp = vm.sp + 1
+        vm.stack[sp] = op(data[a], data[b])
+        vm.sp = sp
+        return ins.next
+    return handler
+
+
+def _load_load_op(a, b, op):
+    def handler(vm, ins):
+        stack = vm.stack
+        fp = vm.fp
+        sp = vm.sp + 1
+        stack[sp] = op(stack[fp + a], stack[fp + b])
+        vm.sp = sp
+        return ins.next
+    return handler
+
+
+def _gload_const_op_gstore(a, k, op, b):
+    def handler(vm, ins):
+        data = vm.data
+        data[b] = op(data[a], k)
+        if vm.data_written is not None:
+            vm.data_written[b] = 1
+        return ins.next
+    return handler
+
+
+# (name, component bytecode choices, factory(records, remap, ops) -> handler),
+# longest first so that the widest match wins.
+PATTERNS = (
+    ('GLOAD_ICONST_OP_GSTORE', (GLOAD, ICONST, ARITHMETIC, GSTORE),
+     lambda r, t, ops: _gload_const_op_gstore(r[0].op1, r[1].op1,
+                                              ops[r[2].bytecode], r[3].op1)),
+    ('LOAD_ICONST_CMP_BRANCH', (LOAD, ICONST, COMPARE, JUMPS),
+     lambda r, t, ops: _load_const_cmp_branch(r[0].op1, r[1].op1, COMPARE[r[2].bytecode],
+                                              JUMPS[r[3].bytecode], t(r[3].op1))),
+    ('GLOAD_ICONST_CMP_BRANCH', (GLOAD, ICONST, COMPARE, JUMPS),
+     lambda r, t, ops: _gload_const_cmp_branch(r[0].op1, r[1].op1, COMPARE[r[2].bytecode],
+                                               JUMPS[r[3].bytecode], t(r[3].op1))),
+    ('GLOAD_GLOAD_CMP_BRANCH', (GLOAD, GLOAD, COMPARE, JUMPS),
+     lambda r, t, ops: _gload_gload_cmp_branch(r[0].op1, r[1].op1, COMPARE[r[2].bytecode],
+                                               JUMPS[r[3].bytecode], t(r[3].op1))),
+    ('GLOAD_GLOAD_OP', (GLOAD, GLOAD, BINARY),
+     lambda r, t, ops: _gload_gload_op(r[0].op1, r[1].op1, ops[r[2].bytecode])),
+    ('LOAD_LOAD_OP', (LOAD, LOAD, BINARY),
+     lambda r, t, ops: _load_load_op(r[0].op1, r[1].op1, ops[r[2].bytecode])),
+    ('ICONST_OP', (ICONST, ARITHMETIC),
+     lambda r, t, ops: _const_op(ops[r[1].bytecode], r[0].op1)),
+    ('CMP_BRANCH', (COMPARE, JUMPS),
+     lambda r, t, ops: _cmp_branch(COMPARE[r[0].bytecode], JUMPS[r[1].bytecode],
+                                   t(r[1].op1))),
+)
+
+
+def _matches(choices, records):
+    for choice, record in zip(choices, records):
+        if isinstance(choice, dict):
+            if record.bytecode not in choice:
+                return False
+        elif record.bytecode is not choice:
+            return False
+    return True
+
+
+def fuse(program, start_ip=0, integers='unbounded'):
+    '''Return a fused copy of program, with the arithmetic of integer
+    model integers.
+
+    The copy's ``fusions`` maps each pattern name to the number of sites
+    fused.
+    '''
+    instrs = program.instructions
+    code = program.code
+    ops = operations(integers)
+
+    # records that something can jump to must stay record boundaries
+    entries = set()
+    if 0 <= start_ip < len(code) and program.index[start_ip] is not None:
+        entries.add(program.index[start_ip])
+    for instr in instrs:
+        if instr.bytecode in (BR, BRT, BRF, CALL, TCALL):
+            entries.add(instr.op1)
+        if instr.bytecode is CALL or instr.bytecode is TCALL:
+            entries.add(instr.next)
+
+    # pick the groups first so targets can be remapped while building
+    groups = []
+    i = 0
+    while i < len(instrs):
+        for name, choices, factory in PATTERNS:
+            group = instrs[i:i + len(choices)]
+            if len(group) == len(choices) and _matches(choices, group) \
+                    and not any(i + j in entries for j in range(1, len(choices))):
+                groups.append((i, name, group, factory))
+                i += len(choices)
+                break
+        else:
+            groups.append((i, None, instrs[i:i + 1], None))
+            i += 1
+
+    remap = {}
+    for new, group in enumerate(groups):
+        remap[group[0]] = new
+
+    fused = []
+    index = [None] * len(code)
+    fusions = collections.Counter()
+    for new, (old, name, group, factory) in enumerate(groups):
+        first = group[0]
+        if name is None:
+            instr = Instruction(first.addr, first.bytecode, first.handler,
+                                first.op1, first.op2, new + 1)
+            if first.bytecode in (BR, BRT, BRF, CALL, TCALL):
+                instr.op1 = remap[first.op1]
+        else:
+            fusions[name] += 1
+            handler = factory(group, remap.__getitem__, ops)
+            instr = Instruction(first.addr, Superinstruction(name, group),
+                                handler, next=new + 1)
+        index[first.addr] = new
+        fused.append(instr)
+
+    return Program(code, fused, index, fusions)
+
+
+def report(code, **kwargs):
+    '''Run code with and without fusion on the decoded engine.
+
+    Returns a dict with the fusions that fired and the dynamic instruction
+    count of each run.  Extra keyword arguments go to VM.
+    '''
+    from simplevirtualmachine.vm import VM
+
+    kwargs['engine'] = 'decoded'
+    plain = VM(*code, fuse=False, **kwargs)
+    plain.run()
+    fused = VM(*code, fuse=True, **kwargs)
+    fused.run()
+
+    return {
+        'fusions': dict(fused.program.fusions),
+        'instructions': plain.steps,
+        'dispatches': fused.steps,
+        'reduction': 1.0 - float(fused.steps) / plain.steps if plain.steps else 0.0,
+    }
@@ -0,0 +1,106 @@
+'''
+simple-virtual-machine: integer models.
+
+``VM(..., integers=model)`` selects what IADD, ISUB and IMUL do with a
+result that does not fit in 64 bits:
+
+* ``'unbounded'`` (default) -- Python integers, promoted to bignums as
+  needed, so ``factorial(100)`` has 158 digits.
+* ``'wrap'`` -- two's complement int64: results wrap modulo 2**64, as in
+  C, NumPy and :func:`~simplevirtualmachine.batch.run_batch`.
+* ``'trap'`` -- int64 that raises :class:`IntegerOverflowError` instead.
+
+ILT and IEQ push TRUE and FALSE under every model.  Under the int64
+models ICONST operands must fit in 64 bits too (the VM checks them when
+it is built), so every value a program computes fits a 64-bit cell of
+``memory='array'``, and arithmetic costs the same whatever the data.
+
+Every engine tests a result against the int64 range inline and only
+calls :func:`wrap` or :func:`trap` when it is out of range, so the
+models cost one comparison per operation.
+'''
+
+import operator
+
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ICONST
+
+MODELS = ('unbounded', 'wrap', 'trap')
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+_MASK = 2 ** 64 - 1
+
+ARITHMETIC = {IADD: operator.add, ISUB: operator.sub, IMUL: operator.mul}
+
+
+class IntegerOverflowError(OverflowError):
+    """An int64 result or constant is out of range under the 'trap' model."""
+
+
+def wrap(value):
+    '''Return value wrapped to a signed 64-bit integer.
+
+    >>> wrap(INT64_MAX + 1) == INT64_MIN, wrap(-1), wrap(2 ** 64 + 5)
+    (True, -1, 5)
+    '''
+    if INT64_MIN <= value <= INT64_MAX:
+        return value
+    # int() turns a Python 2 long back into an int
+    return int(((value - INT64_MIN) & _MASK) + INT64_MIN)
+
+
+def trap(value):
+    '''Return value, or raise IntegerOverflowError if it needs more than 64 bits.
+
+    >>> trap(INT64_MAX + 1)
+    Traceback (most recent call last):
+    ...
+    IntegerOverflowError: integer overflow: 9223372036854775808 does not fit in 64 bits
+    '''
+    if INT64_MIN <= value <= INT64_MAX:
+        return value
+    raise IntegerOverflowError("integer overflow: {} does not fit in 64 bits".format(value))
+
+
+def normalizer(model):
+    '''Return :func:`wrap` or :func:`trap` for model, None for 'unbounded'.'''
+    if model not in MODELS:
+        raise ValueError("unknown integer model {!r}, expected one of {}".format(
+            model, ", ".join(MODELS)))
+    return {'unbounded': None, 'wrap': wrap, 'trap': trap}[model]
+
+
+def _checked(op, normalize):
+    def checked(a, b):
+        value = op(a, b)
+        if INT64_MIN <= value <= INT64_MAX:
+            return value
+        return normalize(value)
+    return checked
+
+
+def arithmetic(model):
+    '''Return {bytecode: function(a, b)} for IADD, ISUB and IMUL under model.
+
+    >>> arithmetic('wrap')[IMUL](2 ** 62, 4)
+    0
+    '''
+    normalize = normalizer(model)
+    if normalize is None:
+        return dict(ARITHMETIC)
+    return dict((bytecode, _checked(op, normalize)) for bytecode, op in ARITHMETIC.items())
+
+
+def check_constants(code):
+    '''Raise IntegerOverflowError for an ICONST operand outside int64.'''
+    addr = 0
+    end = len(code)
+    while addr < end:
+        bytecode = code[addr]
+        if bytecode is ICONST and addr + 1 < end:
+            value = code[addr + 1]
+            if not INT64_MIN <= value <= INT64_MAX:
+                raise IntegerOverflowError("ICONST {} at {} does not fit in 64 bits".format(
+                    value, addr))
+        addr += 1 + getattr(bytecode, 'operands_read', 0)
@@ -0,0 +1,151 @@
+'''
+simple-virtual-machine: memoization of pure functions.
+
+A function -- the code reached from a CALL target up to its RETs -- is
+pure when it never touches data memory (GLOAD, GSTORE or a bulk
+instruction), never runs PUTS or HALT and only calls pure functions.
+The verifier already guarantees that its LOAD and STORE offsets stay
+inside its own frame, so its result depends on nothing but its
+arguments.  :func:`pure_functions` finds them.
+
+With ``VM(..., memoize=size)`` a CALL to a pure function first looks up
+``(target, arguments)`` in a :class:`MemoCache`; on a hit the arguments
+are replaced by the cached result and no frame is built.  On a miss the
+call runs as usual and its RET stores the result::
+
+    vm = VM(*fib, start_ip=main, memoize=1000)
+    vm.run()
+    vm.memo.info()      # MemoInfo(hits=..., misses=..., ...)
+
+Code that fails verification has no pure functions, so memoization then
+does nothing.  Calls answered from the cache count as one step.  A TCALL
+is never looked up, but the result it returns is stored for the call
+whose frame it replaced.
+'''
+
+import collections
+
+from simplevirtualmachine.bulk import BULK
+from simplevirtualmachine.bytecodes import GLOAD, GSTORE, PUTS, HALT
+from simplevirtualmachine.verifier import verify, VerifyError
+
+DEFAULT_MEMO_SIZE = 1024
+
+POLICIES = ('lru', 'fifo')
+
+_IMPURE = (GLOAD, GSTORE, PUTS, HALT) + BULK
+
+MemoInfo = collections.namedtuple('MemoInfo', 'hits misses evictions size maxsize')
+
+
+class MemoCache(object):
+    """Bounded map of ``(target, arguments)`` to function results.
+
+    When full, the least recently used entry is evicted ('lru') or the
+    oldest one ('fifo').  A cache may be shared by VMs running the same
+    code, never by VMs running different code.
+
+    >>> cache = MemoCache(2)
+    >>> cache.put((0, (1,)), 1); cache.put((0, (2,)), 2)
+    >>> cache.get((0, (1,)))
+    1
+    >>> cache.put((0, (3,)), 6)
+    >>> sorted(cache.entries)
+    [(0, (1,)), (0, (3,))]
+    >>> cache.info()
+    MemoInfo(hits=1, misses=0, evictions=1, size=2, maxsize=2)
+    """
+
+    def __init__(self, maxsize=DEFAULT_MEMO_SIZE, policy='lru'):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if policy not in POLICIES:
+            raise ValueError("unknown policy {!r}, expected one of {}".format(
+                policy, ", ".join(POLICIES)))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''Return the cached result for key, counting a hit or a miss.'''
+        entries = self.entries
+        if key in entries:
+            self.hits += 1
+            if self.policy == 'lru':
+                value = entries.pop(key)
+                entries[key] = value
+                return value
+            return entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        entries = self.entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+        entries[key] = value
+
+    def info(self):
+        return MemoInfo(self.hits, self.misses, self.evictions, len(self.entries), self.maxsize)
+
+    def clear(self):
+        '''Drop all entries and reset the counters.'''
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+def make_cache(memoize):
+    '''Build the cache for a ``memoize`` setting, or None for off.
+
+    0, None and False are off, True is a cache of DEFAULT_MEMO_SIZE and
+    an int a cache of that size; MemoCache instances are used as they are.
+    '''
+    if memoize is None or memoize is False or memoize == 0:
+        return None
+    if isinstance(memoize, MemoCache):
+        return memoize
+    if memoize is True:
+        return MemoCache()
+    if isinstance(memoize, int):
+        return MemoCache(memoize)
+    raise ValueError("unsupported memoize value {!r}".format(memoize))
+
+
+def pure_functions(code, entry=0, verified=None):
+    '''Return the frozenset of CALL targets in code that are pure.
+
+    verified is the code's :class:`~simplevirtualmachine.verifier.Verified`
+    form when the caller already has it.
+
+    >>> from simplevirtualmachine.bench import call_program
+    >>> sorted(pure_functions(call_program(5), entry=6))
+    [0]
+    '''
+    if verified is None:
+        try:
+            verified = verify(code, entry)
+        except VerifyError:
+            return frozenset()
+
+    functions = verified.functions
+    pure = set()
+    for target, function in functions.items():
+        if target is not None and not any(
+                verified.instructions[addr][0] in _IMPURE for addr in function.depths):
+            pure.add(target)
+
+    # a function calling an impure one is impure; recursion stays pure
+    changed = True
+    while changed:
+        changed = False
+        for target in list(pure):
+            if any(callee not in pure for _, _, callee in functions[target].calls):
+                pure.discard(target)
+                changed = True
+    return frozenset(pure)
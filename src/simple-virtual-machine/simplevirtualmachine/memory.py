@@ -0,0 +1,77 @@
+'''
+simple-virtual-machine: integer-typed, lazily grown memory.
+
+With ``VM(..., memory='array')`` the stack and data memory start empty as
+64-bit integer arrays and are grown in chunks, up to ``stack_size`` and
+``data_size`` cells, when an instruction first touches a cell past the
+end.  Going past the cap raises :class:`MemoryOverflowError`.
+
+Array cells hold machine integers only: reading a data cell that was
+never written gives 0 rather than None, and storing a value outside the
+64-bit range raises OverflowError.
+'''
+
+from array import array
+
+from simplevirtualmachine.integers import INT64_MIN, INT64_MAX
+
+try:
+    array('q')
+    WORD = 'q'
+except ValueError:
+    # Python 2 has no 'q'; 'l' is 64 bits on LP64 platforms.
+    WORD = 'l'
+
+CHUNK = 64
+
+
+class MemoryOverflowError(Exception):
+    """An access went past the configured size of stack or data memory."""
+
+
+def cell(value):
+    '''Return value, or raise OverflowError if an array cell cannot hold it.
+
+    >>> cell(-2 ** 63) == -2 ** 63
+    True
+    >>> cell(2 ** 63)
+    Traceback (most recent call last):
+    ...
+    OverflowError: 9223372036854775808 does not fit in a 64-bit memory cell
+    '''
+    if INT64_MIN <= value <= INT64_MAX:
+        return value
+    raise OverflowError("{} does not fit in a 64-bit memory cell".format(value))
+
+
+def allocate(size=0):
+    '''Return a new integer memory of size zeroed cells.'''
+    return array(WORD, [0]) * size
+
+
+def grow(cells, index, limit, name, written=None):
+    '''Grow cells in place so that cells[index] exists.
+
+    The new length is at least double the old one, rounded up to CHUNK
+    cells and never more than limit.  written, when given, is a bytearray
+    of per-cell flags grown alongside.
+
+    >>> cells = allocate()
+    >>> grow(cells, 10, 1000, "stack")
+    >>> len(cells)
+    64
+    >>> grow(cells, 1000, 1000, "stack")
+    Traceback (most recent call last):
+    ...
+    MemoryOverflowError: stack address 1000 exceeds stack size 1000
+    '''
+    if index >= limit:
+        raise MemoryOverflowError("{} address {} exceeds {} size {}".format(
+            name, index, name, limit))
+
+    size = max(len(cells) * 2, index + 1, CHUNK)
+    size = min((size + CHUNK - 1) // CHUNK * CHUNK, limit)
+    extra = size - len(cells)
+    cells.extend(array(WORD, [0]) * extra)
+    if written is not None:
+        written.extend(bytearray(extra))
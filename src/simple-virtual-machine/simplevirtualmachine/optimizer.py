@@ -0,0 +1,333 @@
+'''
+simple-virtual-machine: static code optimizer.
+
+:func:`optimize` rewrites a code tuple into an equivalent, usually
+shorter one and returns it with a map from old to new addresses.  The
+passes are
+
+* constant folding: ``ICONST a; ICONST b; IADD`` becomes ``ICONST a+b``,
+  likewise for ISUB, IMUL, ILT and IEQ, in the integer model the code
+  runs under (a sum that would trap is left for run time),
+* constant branches: ``ICONST c; BRT t`` becomes ``BR t`` or nothing,
+  depending on c (BRF likewise),
+* jump threading: a branch to a ``BR u`` goes straight to u, a BR to a
+  RET or HALT becomes that instruction, and a branch to the next
+  instruction is dropped (BRT/BRF become POP),
+* dead code: instructions unreachable from the entry point are removed,
+  as are ``ICONST c; POP`` and ``GLOAD x; POP``,
+* tail calls: ``CALL t, n; RET`` in a function becomes ``TCALL t, n;
+  RET``, which reuses the caller's frame (not in code the entry frame
+  runs, where TCALL is a plain CALL),
+* store-load forwarding (level 2): within a basic block, a ``GLOAD x``
+  after ``ICONST c; GSTORE x`` becomes ``ICONST c``, and ``GLOAD x;
+  GSTORE x`` is removed.  There is no DUP, so a stored value that is not
+  a constant is still loaded from memory, and a bulk instruction such as
+  MEMSET forgets every constant known so far.
+
+Rewrites never look across a basic-block boundary: no instruction folded
+away or into another is a branch target, a CALL return address or the
+entry point.  Level 1 runs each pass once; level 2 adds forwarding and
+repeats all passes until nothing changes.  ``VM(..., optimize=level)``
+runs the VM on the optimized code::
+
+    >>> from simplevirtualmachine.bytecodes import ICONST, IADD, PUTS, HALT
+    >>> code = optimize((ICONST, 2, ICONST, 3, IADD, PUTS, HALT)).code
+    >>> [getattr(slot, 'name', slot) for slot in code]
+    ['ICONST', 5, 'PUTS', 'HALT']
+'''
+
+import collections
+
+from simplevirtualmachine.bulk import BULK
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, IEQ, BR, BRT, BRF, \
+    ICONST, GLOAD, GSTORE, POP, CALL, RET, HALT, TCALL, TRUE, FALSE
+from simplevirtualmachine.fusion import operations
+from simplevirtualmachine.integers import IntegerOverflowError
+from simplevirtualmachine.verifier import decode_reachable
+
+LEVELS = (0, 1, 2)
+
+_FOLDABLE = (IADD, ISUB, IMUL, ILT, IEQ)
+_JUMPS = (BR, BRT, BRF)
+_ENDS = (BR, RET, HALT)
+_CALLS = (CALL, TCALL)
+
+
+class Optimized(collections.namedtuple('Optimized', 'code entry remap stats')):
+    """The result of :func:`optimize`.
+
+    ``remap`` maps every reachable instruction address of the original
+    code to its address in ``code``; an instruction that was removed maps
+    to the next one kept.  ``stats`` counts the rewrites by pass.
+    """
+    __slots__ = ()
+
+
+class _Instruction(object):
+    """An instruction being rewritten; branch and CALL targets stay
+    original addresses until the code is emitted."""
+    __slots__ = ('addr', 'bytecode', 'operands')
+
+    def __init__(self, addr, bytecode, operands):
+        self.addr = addr
+        self.bytecode = bytecode
+        self.operands = list(operands)
+
+    def __repr__(self):
+        return "{}:{}{}".format(self.addr, self.bytecode.name, self.operands)
+
+
+class _Optimizer(object):
+
+    def __init__(self, code, entries, integers='unbounded'):
+        self.entries = entries
+        self.ops = operations(integers)
+        decoded = decode_reachable(code, entries)
+        self.addrs = sorted(decoded)
+        self.instructions = [_Instruction(addr, decoded[addr][0], decoded[addr][1])
+                             for addr in self.addrs]
+        self.stats = collections.Counter()
+        self.orphaned = False
+
+    def resolve(self, addr):
+        '''Return the kept instruction that original address addr now runs.'''
+        return self.alive.get(addr, addr)
+
+    def relink(self):
+        '''Point targets at kept instructions and recompute the leaders.'''
+        instructions = self.instructions
+        kept = set(ins.addr for ins in instructions)
+        alive = {}
+        following = None
+        # removed addresses fall through to the next kept instruction
+        for addr in reversed(self.addrs):
+            if addr in kept:
+                following = addr
+            alive[addr] = following
+        self.alive = alive
+        self.by_addr = dict((ins.addr, ins) for ins in instructions)
+
+        leaders = set(self.resolve(entry) for entry in self.entries)
+        for index, ins in enumerate(instructions):
+            if ins.bytecode in _JUMPS or ins.bytecode in _CALLS:
+                ins.operands[0] = self.resolve(ins.operands[0])
+                leaders.add(ins.operands[0])
+            if ins.bytecode in _CALLS and index + 1 < len(instructions):
+                leaders.add(instructions[index + 1].addr)
+        self.leaders = leaders
+
+    def peephole(self, forward):
+        '''Fold constants and constant branches, drop dead pushes.'''
+        leaders = self.leaders
+        self.orphaned = False
+        out = []
+        for ins in self.instructions:
+            if self.orphaned:
+                # a deleted branch target now lands here
+                leaders.add(ins.addr)
+                self.orphaned = False
+            out.append(ins)
+            while self._rewrite(out, leaders, forward):
+                pass
+        changed = len(out) != len(self.instructions)
+        self.instructions = out
+        return changed
+
+    def _rewrite(self, out, leaders, forward):
+        '''Rewrite the tail of out once; True if it changed.'''
+        if len(out) < 2 or out[-1].addr in leaders:
+            return False
+        last, prev = out[-1], out[-2]
+        bytecode = last.bytecode
+        if bytecode in _FOLDABLE and len(out) >= 3 and prev.addr not in leaders \
+                and prev.bytecode is ICONST and out[-3].bytecode is ICONST:
+            first = out[-3]
+            try:
+                value = self.ops[bytecode](first.operands[0], prev.operands[0])
+            except IntegerOverflowError:
+                return False
+            out[-3:] = [_Instruction(first.addr, ICONST, [value])]
+            self.stats['fold'] += 1
+            return True
+        if bytecode in (BRT, BRF) and prev.bytecode is ICONST:
+            taken = prev.operands[0] == (TRUE if bytecode is BRT else FALSE)
+            if taken:
+                out[-2:] = [_Instruction(prev.addr, BR, last.operands)]
+            else:
+                self._drop(out, leaders)
+            self.stats['branch'] += 1
+            return True
+        if bytecode is POP and prev.bytecode in (ICONST, GLOAD):
+            self._drop(out, leaders)
+            self.stats['dead'] += 1
+            return True
+        if forward and bytecode is GSTORE and prev.bytecode is GLOAD \
+                and prev.operands == last.operands:
+            self._drop(out, leaders)
+            self.stats['forward'] += 1
+            return True
+        return False
+
+    def _drop(self, out, leaders):
+        '''Delete the last two instructions of out.  When the first is a
+        leader, the next instruction kept becomes one instead, so that
+        nothing folds across the block boundary.'''
+        if out[-2].addr in leaders:
+            self.orphaned = True
+        del out[-2:]
+
+    def forward(self):
+        '''Replace GLOADs of cells holding a known constant in the block.'''
+        known = {}
+        changed = False
+        previous = None
+        for index, ins in enumerate(self.instructions):
+            if ins.addr in self.leaders:
+                known.clear()
+                previous = None
+            bytecode = ins.bytecode
+            if bytecode is GSTORE:
+                if previous is not None and previous.bytecode is ICONST:
+                    known[ins.operands[0]] = previous.operands[0]
+                else:
+                    known.pop(ins.operands[0], None)
+            elif bytecode is GLOAD and ins.operands[0] in known:
+                ins = self.instructions[index] = _Instruction(
+                    ins.addr, ICONST, [known[ins.operands[0]]])
+                self.stats['forward'] += 1
+                changed = True
+            elif bytecode in _CALLS or bytecode in BULK:
+                known.clear()
+            previous = ins
+        return changed
+
+    def thread(self):
+        '''Shorten branch chains and drop branches to the next instruction.'''
+        instructions = self.instructions
+        by_addr = self.by_addr
+        changed = False
+        out = []
+        for index, ins in enumerate(instructions):
+            if ins.bytecode in _JUMPS:
+                target = ins.operands[0]
+                seen = set([ins.addr])
+                while by_addr[target].bytecode is BR and target not in seen:
+                    seen.add(target)
+                    target = by_addr[target].operands[0]
+                if target != ins.operands[0]:
+                    ins.operands[0] = target
+                    self.stats['thread'] += 1
+                    changed = True
+                following = instructions[index + 1].addr if index + 1 < len(instructions) \
+                    else None
+                if target == following:
+                    self.stats['thread'] += 1
+                    changed = True
+                    if ins.bytecode is BR:
+                        continue
+                    ins = _Instruction(ins.addr, POP, [])
+                elif ins.bytecode is BR and by_addr[target].bytecode in (RET, HALT):
+                    self.stats['thread'] += 1
+                    changed = True
+                    ins = _Instruction(ins.addr, by_addr[target].bytecode, [])
+            out.append(ins)
+        self.instructions = out
+        return changed
+
+    def prune(self):
+        '''Remove instructions no longer reachable from the entries.'''
+        instructions = self.instructions
+        position = dict((ins.addr, index) for index, ins in enumerate(instructions))
+        reached = set()
+        work = [position[self.resolve(entry)] for entry in self.entries]
+        while work:
+            index = work.pop()
+            if index in reached or index >= len(instructions):
+                continue
+            reached.add(index)
+            ins = instructions[index]
+            if ins.bytecode in _JUMPS or ins.bytecode in _CALLS:
+                work.append(position[ins.operands[0]])
+            if ins.bytecode not in _ENDS:
+                work.append(index + 1)
+        if len(reached) == len(instructions):
+            return False
+        self.stats['unreachable'] += len(instructions) - len(reached)
+        self.instructions = [ins for index, ins in enumerate(instructions) if index in reached]
+        return True
+
+    def tail(self):
+        '''Turn CALL; RET into TCALL; RET outside the entry frame's code.'''
+        instructions = self.instructions
+        position = dict((ins.addr, index) for index, ins in enumerate(instructions))
+        entry_code = set()
+        work = [position[self.resolve(entry)] for entry in self.entries]
+        while work:
+            index = work.pop()
+            if index in entry_code or index >= len(instructions):
+                continue
+            entry_code.add(index)
+            ins = instructions[index]
+            if ins.bytecode in _JUMPS:
+                work.append(position[ins.operands[0]])
+            if ins.bytecode not in _ENDS:
+                work.append(index + 1)
+
+        changed = False
+        for index, ins in enumerate(instructions[:-1]):
+            if ins.bytecode is CALL and instructions[index + 1].bytecode is RET \
+                    and index not in entry_code:
+                instructions[index] = _Instruction(ins.addr, TCALL, ins.operands)
+                self.stats['tail'] += 1
+                changed = True
+        return changed
+
+    def run(self, level):
+        self.relink()
+        while True:
+            changed = False
+            if level >= 2:
+                changed |= self.forward()
+            for step in (lambda: self.peephole(level >= 2), self.thread, self.tail,
+                         self.prune):
+                changed |= step()
+                self.relink()
+            if level < 2 or not changed:
+                break
+
+    def emit(self):
+        new_addr = {}
+        addr = 0
+        for ins in self.instructions:
+            new_addr[ins.addr] = addr
+            addr += 1 + len(ins.operands)
+        code = []
+        for ins in self.instructions:
+            code.append(ins.bytecode)
+            operands = list(ins.operands)
+            if ins.bytecode in _JUMPS or ins.bytecode in _CALLS:
+                operands[0] = new_addr[operands[0]]
+            code.extend(operands)
+        remap = dict((addr, new_addr.get(self.alive[addr], len(code))) for addr in self.addrs)
+        return tuple(code), remap
+
+
+def optimize(code, entry=0, level=2, entries=(), integers='unbounded'):
+    '''Optimize code run from entry; returns an :class:`Optimized` result.
+
+    entries lists further addresses that must stay valid entry points,
+    e.g. functions called from outside.  integers is the integer model
+    constants are folded in.  Raises
+    :class:`~simplevirtualmachine.verifier.VerifyError` when the reachable
+    code cannot be decoded.
+    '''
+    if level not in LEVELS:
+        raise ValueError("unknown optimize level {!r}, expected one of {}".format(
+            level, ", ".join(str(known) for known in LEVELS)))
+    optimizer = _Optimizer(code, [entry] + list(entries), integers)
+    if level:
+        optimizer.run(level)
+    else:
+        optimizer.relink()
+    code, remap = optimizer.emit()
+    return Optimized(code, remap[entry], remap, dict(optimizer.stats))
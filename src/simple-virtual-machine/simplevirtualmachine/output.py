@@ -0,0 +1,136 @@
+'''
+simple-virtual-machine: where PUTS values go.
+
+Every PUTS hands its value to the VM's output sink, chosen with the
+``output`` setting (see :func:`make_sink`)::
+
+    VM(*code)                          # stdout, "OUTPUT: <value>" lines
+    VM(*code, output=values)           # append raw values to a list
+    VM(*code, output='null')           # discard
+    VM(*code, output=callback)         # callback(value) per PUTS
+    VM(*code, output=StreamSink(f, labelled=False, buffer_size=4096))
+
+Stream sinks keep raw values and format and write them in bulk, once
+``buffer_size`` values are held and when the run ends.
+'''
+
+import abc
+import sys
+
+# values a StreamSink holds before writing them out
+DEFAULT_BUFFER_SIZE = 512
+
+LABEL = "OUTPUT: "
+
+# abc.ABC for Python 2 and 3 alike
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+
+class OutputSink(_ABC):
+    """Receives PUTS values: ``write(value)`` per PUTS, ``flush()`` when a
+    run stops.  A subclass must define ``write``."""
+
+    @abc.abstractmethod
+    def write(self, value):
+        '''Called with the value of every PUTS.'''
+
+    def flush(self):
+        pass
+
+
+class ListSink(OutputSink):
+    """Append raw values to a list.
+
+    >>> sink = ListSink()
+    >>> sink.write(42)
+    >>> sink.values
+    [42]
+    """
+
+    def __init__(self, values=None):
+        self.values = [] if values is None else values
+        # bound list.append: one C call per PUTS
+        self.write = self.values.append
+
+    def write(self, value):
+        self.values.append(value)
+
+
+class CallbackSink(OutputSink):
+    """Call func(value) for every PUTS."""
+
+    def __init__(self, func):
+        self.func = func
+        self.write = func
+
+    def write(self, value):
+        self.func(value)
+
+
+class NullSink(OutputSink):
+    """Discard all output."""
+
+    def write(self, value):
+        pass
+
+
+class StreamSink(OutputSink):
+    """Write values as text lines to a file, buffered.
+
+    Lines are ``OUTPUT: <value>`` when labelled, else the bare value.
+    Values are written in one call once buffer_size of them are held, and
+    on flush(); with flush=True the stream is flushed after each write.
+    stream defaults to whatever ``sys.stdout`` is at write time.
+    """
+
+    def __init__(self, stream=None, labelled=True, buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush=False):
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1")
+        self.stream = stream
+        self.labelled = labelled
+        self.buffer_size = buffer_size
+        self.flush_stream = flush
+        self.buffer = []
+
+    def write(self, value):
+        buffer = self.buffer
+        buffer.append(value)
+        if len(buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        values = self.buffer
+        self.buffer = []
+        if self.labelled:
+            text = LABEL + ("\n" + LABEL).join(map(str, values)) + "\n"
+        else:
+            text = "\n".join(map(str, values)) + "\n"
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(text)
+        if self.flush_stream:
+            stream.flush()
+
+
+def make_sink(output):
+    '''Build the sink for an ``output`` setting.
+
+    None is labelled, buffered stdout; 'null' discards; a list collects
+    raw values; an object with ``write`` is a stream; any other callable
+    is called per value.  OutputSink instances are used as they are.
+    '''
+    if output is None:
+        return StreamSink()
+    if isinstance(output, OutputSink):
+        return output
+    if output == 'null':
+        return NullSink()
+    if isinstance(output, list):
+        return ListSink(output)
+    if hasattr(output, 'write'):
+        return StreamSink(output)
+    if callable(output):
+        return CallbackSink(output)
+    raise ValueError("unsupported output value {!r}".format(output))
@@ -0,0 +1,245 @@
+'''
+simple-virtual-machine: run many programs or inputs on a process pool.
+
+A :class:`VM` uses one core.  :class:`VMPool` keeps warm worker
+processes, each holding the decoded program, and fans jobs out to them
+in chunks::
+
+    with VMPool(workers=4, program=code) as pool:
+        for result in pool.run_many([[n] for n in range(10000)]):
+            print(result.index, result.output, result.globals)
+
+Without ``program`` every job is a code sequence of its own; workers
+keep the decodings of recently seen code.  With it, every job is a row
+of input integers, written to data cells ``0..k-1`` (``inputs_to='data'``)
+or pushed on the stack (``inputs_to='stack'``) before the run, as in
+:func:`simplevirtualmachine.batch.run_batch`.
+
+Results stream back as :class:`JobResult` records, in job order or as
+completed.  ``timeout`` limits each job's run time in its worker (Unix
+only); a job that runs over yields status ``'timeout'`` and the worker
+stays warm for the next job.
+
+:func:`scaling` measures throughput from 1 to N workers.
+'''
+
+import collections
+import multiprocessing
+import signal
+import time
+
+from simplevirtualmachine import memory
+from simplevirtualmachine.config import DEFAULT_CONFIG
+from simplevirtualmachine.output import ListSink
+from simplevirtualmachine.vm import VM
+
+# decoded programs a worker keeps when jobs are code sequences
+PROGRAM_CACHE_SIZE = 64
+
+
+class JobTimeout(Exception):
+    """A job ran longer than its timeout."""
+
+
+class JobResult(collections.namedtuple(
+        'JobResult', 'index status value output globals steps seconds error')):
+    """The outcome of one job.
+
+    status is ``'halt'``, ``'timeout'`` or ``'error'`` (error then holds
+    the message).  value is the top of the stack at HALT, or None when the
+    stack is empty; output lists the PUTS values and globals maps data
+    addresses to the values stored there.
+    """
+    __slots__ = ()
+
+
+# per-process worker state, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(program, config, inputs_to):
+    # the parent's SIGINT handling stays with the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker.clear()
+    _worker.update(program=program, config=config, inputs_to=inputs_to, decoded={})
+    if program is not None:
+        _decoded(program)
+
+
+def _decoded(code):
+    '''Return the decoded form of code, decoding it once per worker.'''
+    config = _worker['config']
+    if config.engine != 'decoded':
+        return None
+    cache = _worker['decoded']
+    program = cache.get(code)
+    if program is None:
+        if len(cache) >= PROGRAM_CACHE_SIZE:
+            cache.clear()
+        program = cache[code] = VM.from_code(code, config=config).program
+    return program
+
+
+def load_inputs(vm, row, inputs_to='data'):
+    '''Write row into vm's data cells 0..k-1 or push it on its stack.'''
+    vm.unshare()
+    if inputs_to == 'data':
+        cells, limit, written = vm.data, vm.data_size, vm.data_written
+    else:
+        cells, limit, written = vm.stack, vm.stack_size, None
+    if len(row) > len(cells):
+        # array memory starts empty; list memory already has limit cells,
+        # so this only raises MemoryOverflowError for it
+        memory.grow(cells, len(row) - 1, limit, inputs_to, written)
+
+    for addr, value in enumerate(row):
+        cells[addr] = value
+        if written is not None:
+            written[addr] = 1
+    if inputs_to == 'stack':
+        vm.sp = len(row) - 1
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _run_job(task):
+    index, job, timeout = task
+    program = _worker['program']
+    code = job if program is None else program
+
+    started = time.time()
+    output = ListSink()
+    vm = None
+    timer = timeout and hasattr(signal, 'setitimer')
+    try:
+        vm = VM.from_code(code, program=_decoded(code), config=_worker['config'])
+        vm.output = output
+        if program is not None:
+            load_inputs(vm, job, _worker['inputs_to'])
+        if timer:
+            signal.signal(signal.SIGALRM, _alarm)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            vm.run()
+        finally:
+            if timer:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        status, error = 'halt', None
+    except JobTimeout:
+        status, error = 'timeout', "job ran longer than {}s".format(timeout)
+    except Exception as e:
+        status, error = 'error', "{}: {}".format(type(e).__name__, e)
+
+    value = None
+    globals_ = {}
+    steps = 0
+    if vm is not None:
+        if status == 'halt' and vm.sp >= 0:
+            value = vm.stack[vm.sp]
+        globals_ = vm.written_data()
+        steps = vm.steps
+    return JobResult(index, status, value, output.values, globals_, steps,
+                     time.time() - started, error)
+
+
+class VMPool(object):
+    """A persistent pool of worker processes running VMs.
+
+    program, inputs_to and the remaining keyword arguments (VM settings,
+    e.g. ``engine='decoded'``) are fixed for the life of the pool.
+    """
+
+    def __init__(self, workers=None, program=None, inputs_to='data', **kwargs):
+        if inputs_to not in ('data', 'stack'):
+            raise ValueError("inputs_to must be 'data' or 'stack'")
+        config = kwargs.pop('config', DEFAULT_CONFIG)
+        if kwargs:
+            config = config.replace(**kwargs)
+        if program is not None:
+            program = tuple(program)
+
+        self.workers = workers or multiprocessing.cpu_count()
+        self.program = program
+        self.config = config
+        self._pool = multiprocessing.Pool(self.workers, _init_worker,
+                                          (program, config, inputs_to))
+
+    def run_many(self, jobs, ordered=True, chunksize=None, timeout=None):
+        '''Run jobs, yielding a :class:`JobResult` for each.
+
+        Results come in job order, or as they complete when ordered is
+        False.  chunksize is the number of jobs sent to a worker at once;
+        timeout is the limit in seconds for each job.
+        '''
+        if self.program is None:
+            tasks = [(index, tuple(job), timeout) for index, job in enumerate(jobs)]
+        else:
+            tasks = [(index, list(job), timeout) for index, job in enumerate(jobs)]
+        if chunksize is None:
+            chunksize = max(1, len(tasks) // (self.workers * 4))
+
+        imap = self._pool.imap if ordered else self._pool.imap_unordered
+        for result in imap(_run_job, tasks, chunksize):
+            yield result
+
+    def close(self):
+        '''Stop the workers once they finish their jobs.'''
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        '''Stop the workers now.'''
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def run_many(programs_or_inputs, workers=None, program=None, ordered=True,
+             chunksize=None, timeout=None, **kwargs):
+    '''Run jobs on a new :class:`VMPool`; returns the list of results.
+
+    Use a :class:`VMPool` directly to keep the workers warm between calls
+    or to stream results.
+    '''
+    with VMPool(workers, program, **kwargs) as pool:
+        return list(pool.run_many(programs_or_inputs, ordered, chunksize, timeout))
+
+
+def scaling(jobs, max_workers=None, program=None, **kwargs):
+    '''Time jobs on pools of 1..max_workers warm workers.
+
+    Returns rows of (workers, seconds, jobs per second, speedup over one
+    worker).
+    '''
+    jobs = list(jobs)
+    rows = []
+    for workers in range(1, (max_workers or multiprocessing.cpu_count()) + 1):
+        with VMPool(workers, program, **kwargs) as pool:
+            # warm every worker up before timing
+            list(pool.run_many(jobs[:workers], chunksize=1))
+            started = time.time()
+            for _ in pool.run_many(jobs):
+                pass
+            seconds = time.time() - started
+        rate = len(jobs) / seconds if seconds else float('inf')
+        rows.append((workers, seconds, rate, rate / rows[0][2] if rows else 1.0))
+    return rows
+
+
+def format_scaling(rows):
+    '''Return :func:`scaling` rows as a table.'''
+    lines = ["{:>7s} {:>10s} {:>12s} {:>8s}".format("WORKERS", "SECONDS", "JOBS/S", "SPEEDUP")]
+    for workers, seconds, rate, speedup in rows:
+        lines.append("{:>7d} {:>10.4f} {:>12,.0f} {:>7.2f}x".format(
+            workers, seconds, rate, speedup))
+    return "\n".join(lines)
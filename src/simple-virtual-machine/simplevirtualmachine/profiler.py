@@ -0,0 +1,191 @@
+'''
+simple-virtual-machine: execution profiling.
+
+:class:`Profiler` is a tracer, so it costs nothing unless it is passed as
+``VM(..., trace=profiler)``.  Each step's wall time is charged to the
+instruction that ran, and a shadow call stack built from CALL/RET gives
+per-function numbers::
+
+    profiler = Profiler()
+    vm = VM(*code, trace=profiler)
+    profiler.start()
+    vm.run()
+    print(profiler.report())
+    open("prog.folded", "w").write(profiler.folded())
+
+It collects
+
+* per-opcode dynamic counts and time,
+* per-address hit counts and time,
+* per-function (CALL target) calls, inclusive/exclusive instruction
+  counts and wall time, where recursive calls are counted once towards
+  inclusive totals,
+* per call-stack exclusive totals, exported by :meth:`Profiler.folded`
+  in the folded-stack format read by flamegraph.pl and speedscope.
+
+With fusion on, a step is one dispatch and is charged to the first
+instruction of the fused sequence.  With memoization on, a CALL answered
+from the cache is charged to its caller and does not count as a call.
+'''
+
+import time
+
+from simplevirtualmachine.bytecodes import CALL, RET, TCALL
+from simplevirtualmachine.trace import Tracer
+
+MAIN = None
+
+
+class FunctionStats(object):
+    """Totals for one function, keyed by its entry address."""
+    __slots__ = ('calls', 'exclusive_steps', 'exclusive_time',
+                 'inclusive_steps', 'inclusive_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.exclusive_steps = 0
+        self.exclusive_time = 0.0
+        self.inclusive_steps = 0
+        self.inclusive_time = 0.0
+
+
+class Profiler(Tracer):
+    """Per-opcode, per-address and per-function execution profile.
+
+    names optionally maps function entry addresses to names (e.g. the
+    ``labels`` of an assembled program, inverted); other functions are
+    shown as ``fn_<addr>`` and the code outside any CALL as ``main``.
+    """
+
+    def __init__(self, names=None, clock=time.time):
+        self.names = names or {}
+        self.clock = clock
+        self.steps = 0
+        self.elapsed = 0.0
+        self.opcode_counts = {}
+        self.opcode_times = {}
+        self.address_counts = {}
+        self.address_times = {}
+        self.functions = {MAIN: FunctionStats()}
+        self.functions[MAIN].calls = 1
+        self.stacks = {}
+        self._last = None
+        # shadow call stack of (function, path, steps, elapsed) at entry
+        self._frames = [(MAIN, (MAIN,), 0, 0.0)]
+        self._active = {MAIN: 1}
+
+    def start(self):
+        '''Start the clock; call right before VM.run().'''
+        self._last = self.clock()
+
+    def step(self, vm, ip):
+        now = self.clock()
+        spent = now - self._last if self._last is not None else 0.0
+        self._last = now
+        self.steps += 1
+        self.elapsed += spent
+
+        bytecode = vm.code[ip]
+        name = bytecode.name
+        self.opcode_counts[name] = self.opcode_counts.get(name, 0) + 1
+        self.opcode_times[name] = self.opcode_times.get(name, 0.0) + spent
+        self.address_counts[ip] = self.address_counts.get(ip, 0) + 1
+        self.address_times[ip] = self.address_times.get(ip, 0.0) + spent
+
+        function, path = self._frames[-1][:2]
+        stats = self.functions[function]
+        stats.exclusive_steps += 1
+        stats.exclusive_time += spent
+        totals = self.stacks.get(path)
+        if totals is None:
+            totals = self.stacks[path] = [0, 0.0]
+        totals[0] += 1
+        totals[1] += spent
+
+        if bytecode is CALL:
+            # a CALL answered from the memo cache builds no frame
+            if vm.fp == vm.sp:
+                self._enter(vm.code[ip + 1], path)
+        elif bytecode is TCALL:
+            # the callee replaces the current frame, outside main
+            if len(self._frames) > 1:
+                self._leave()
+            self._enter(vm.code[ip + 1], self._frames[-1][1])
+        elif bytecode is RET and len(self._frames) > 1:
+            self._leave()
+
+    def _enter(self, function, path):
+        if function not in self.functions:
+            self.functions[function] = FunctionStats()
+        self.functions[function].calls += 1
+        self._frames.append((function, path + (function,), self.steps, self.elapsed))
+        self._active[function] = self._active.get(function, 0) + 1
+
+    def _leave(self):
+        function, path, steps, elapsed = self._frames.pop()
+        self._active[function] -= 1
+        if not self._active[function]:
+            # outermost activation: count recursion only once
+            stats = self.functions[function]
+            stats.inclusive_steps += self.steps - steps
+            stats.inclusive_time += self.elapsed - elapsed
+
+    def finish(self):
+        '''Close frames still open (e.g. after HALT inside a call).'''
+        while len(self._frames) > 1:
+            self._leave()
+        main = self.functions[MAIN]
+        main.inclusive_steps = self.steps
+        main.inclusive_time = self.elapsed
+
+    def name(self, function):
+        '''Return the display name of a function entry address.'''
+        if function is MAIN:
+            return "main"
+        return self.names.get(function, "fn_{:04d}".format(function))
+
+    def report(self, top=10):
+        '''Return the profile as text, each table sorted by cost.'''
+        self.finish()
+        total = self.elapsed or 1.0
+
+        lines = ["{:10s} {:>10s} {:>10s} {:>6s}".format("OPCODE", "COUNT", "SECONDS", "%")]
+        for name in sorted(self.opcode_counts,
+                           key=lambda n: (-self.opcode_times[n], -self.opcode_counts[n], n)):
+            seconds = self.opcode_times[name]
+            lines.append("{:10s} {:>10d} {:>10.6f} {:>6.1f}".format(
+                name, self.opcode_counts[name], seconds, 100.0 * seconds / total))
+
+        lines.extend(["", "{:10s} {:>10s} {:>10s} {:>6s}".format(
+            "ADDRESS", "HITS", "SECONDS", "%")])
+        hot = sorted(self.address_counts,
+                     key=lambda a: (-self.address_times[a], -self.address_counts[a], a))
+        for addr in hot[:top]:
+            seconds = self.address_times[addr]
+            lines.append("{:<10d} {:>10d} {:>10.6f} {:>6.1f}".format(
+                addr, self.address_counts[addr], seconds, 100.0 * seconds / total))
+
+        lines.extend(["", "{:16s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+            "FUNCTION", "CALLS", "INCL", "EXCL", "INCL SEC", "EXCL SEC")])
+        for function in sorted(self.functions,
+                               key=lambda f: (-self.functions[f].inclusive_time,
+                                              -self.functions[f].inclusive_steps,
+                                              self.name(f))):
+            stats = self.functions[function]
+            lines.append("{:16s} {:>8d} {:>10d} {:>10d} {:>10.6f} {:>10.6f}".format(
+                self.name(function), stats.calls, stats.inclusive_steps,
+                stats.exclusive_steps, stats.inclusive_time, stats.exclusive_time))
+
+        return "\n".join(lines)
+
+    def folded(self, weight='steps'):
+        '''Return call stacks in folded format, one "a;b;c weight" per line.
+
+        weight is 'steps' (instructions) or 'time' (microseconds).
+        '''
+        lines = []
+        for path in sorted(self.stacks, key=lambda p: [self.name(f) for f in p]):
+            steps, seconds = self.stacks[path]
+            value = steps if weight == 'steps' else int(round(seconds * 1e6))
+            lines.append("{} {}".format(";".join(self.name(f) for f in path), value))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,262 @@
+'''
+simple-virtual-machine: green threads for many VMs in one process.
+
+A :class:`Scheduler` runs any number of tasks, each a VM forked from a
+template (see :meth:`VM.fork <simplevirtualmachine.vm.VM.fork>`), in time
+slices of ``quantum`` instructions from one loop.  Tasks share their
+code and its decoded form and by default use array memory, so a task
+costs its registers, a stack grown on demand and the data cells it
+writes::
+
+    scheduler = Scheduler(quantum=200)
+    results = Channel()
+    workers = [scheduler.spawn(code, inbox=Channel(), outbox=results)
+               for _ in range(1000)]
+    for value, worker in enumerate(workers):
+        worker.inbox.send(value)
+    scheduler.run()
+    results.drain()
+
+A task with an inbox is an actor: each message restarts it at its entry
+address with the message as the only stack value (``LOAD 1`` reads it)
+and the data cells left by earlier messages, and when it halts it blocks
+until the next message arrives.  A task without an inbox runs once to
+HALT.  PUTS values go to the task's outbox, which may be another task's
+inbox.
+
+``policy='round-robin'`` runs ready tasks in turn; ``'priority'`` always
+runs a ready task of the highest priority next, in turn among equals.
+:meth:`Scheduler.stats` gives the instructions run per second and
+:meth:`Task.latency` the time from a message being sent to the task
+halting after handling it.
+'''
+
+import collections
+import heapq
+import time
+
+from simplevirtualmachine import memory
+from simplevirtualmachine.bench import summarize
+from simplevirtualmachine.output import OutputSink
+from simplevirtualmachine.vm import DEFAULT_QUANTUM, VM
+
+POLICIES = ('round-robin', 'priority')
+
+# latencies each task keeps for Task.latency()
+LATENCY_SAMPLES = 1000
+
+# settings of the template VMs spawn() builds for code
+DEFAULT_SETTINGS = {'engine': 'decoded', 'memory': 'array', 'output': 'null'}
+
+
+class SchedulerStats(collections.namedtuple(
+        'SchedulerStats', 'tasks steps slices messages seconds')):
+    """Totals over every :meth:`Scheduler.run` so far.
+
+    steps counts instructions, slices the time slices run, messages the
+    inbox messages delivered and seconds the time spent in run().
+    """
+    __slots__ = ()
+
+    @property
+    def steps_per_second(self):
+        return self.steps / self.seconds if self.seconds else 0.0
+
+
+class Channel(OutputSink):
+    """A FIFO of values between the host and tasks.
+
+    As an output sink it takes a task's PUTS values.  A task blocked on
+    the channel as its inbox wakes up when a value is sent.
+
+    >>> channel = Channel()
+    >>> channel.send(1); channel.send(2)
+    >>> len(channel), channel.receive(), channel.drain()
+    (2, 1, [2])
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # (value, time sent)
+        self.items = collections.deque()
+        self.waiting = collections.deque()
+
+    def __len__(self):
+        return len(self.items)
+
+    def write(self, value):
+        self.items.append((value, self.clock()))
+        if self.waiting:
+            task = self.waiting.popleft()
+            task.scheduler._deliver(task)
+
+    send = write
+
+    def receive(self):
+        '''Remove and return the oldest value; IndexError when empty.'''
+        return self.items.popleft()[0]
+
+    def drain(self):
+        '''Remove and return all values, oldest first.'''
+        values = [value for value, sent in self.items]
+        self.items.clear()
+        return values
+
+
+class Task(object):
+    """A VM run by a :class:`Scheduler`.
+
+    state is 'ready', 'blocked' (waiting for a message), 'done' or 'error'
+    (error then holds the exception).
+    """
+
+    def __init__(self, scheduler, vm, inbox, priority, name):
+        self.scheduler = scheduler
+        self.vm = vm
+        self.inbox = inbox
+        self.priority = priority
+        self.name = name
+        self.entry = vm.ip
+        self.state = None
+        self.error = None
+        self.messages = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        # when the message being handled was sent
+        self.sent = None
+
+    def __repr__(self):
+        return "Task({!r}, {}, steps={})".format(self.name, self.state, self.vm.steps)
+
+    @property
+    def steps(self):
+        return self.vm.steps
+
+    def latency(self):
+        '''Return min/median/p99/max seconds over the last messages
+        handled, or None before the first one.'''
+        if not self.latencies:
+            return None
+        return summarize(self.latencies)
+
+
+class Scheduler(object):
+    """Runs many tasks in time slices of quantum instructions.
+
+    settings are VM settings for the templates :meth:`spawn` builds from
+    code; they default to :data:`DEFAULT_SETTINGS`.  clock is the time
+    source for the statistics.
+    """
+
+    def __init__(self, policy='round-robin', quantum=DEFAULT_QUANTUM, clock=time.time,
+                 **settings):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy {!r}, expected one of {}".format(
+                policy, ", ".join(POLICIES)))
+        if quantum < 1:
+            raise ValueError("quantum must be at least 1")
+        self.policy = policy
+        self.quantum = quantum
+        self.clock = clock
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.tasks = []
+        self._templates = {}
+        self._ready = collections.deque()
+        self._heap = []
+        self._order = 0
+        self.steps = 0
+        self.slices = 0
+        self.messages = 0
+        self.seconds = 0.0
+
+    def spawn(self, program, inbox=None, outbox=None, priority=0, name=None):
+        '''Start a task running program and return its :class:`Task`.
+
+        program is a VM, which the task forks in its current state, or a
+        code sequence, run by a fork of a template VM built once per
+        sequence.  outbox, when given, is the task's output setting.
+        '''
+        if not isinstance(program, VM):
+            key = id(program)
+            if key not in self._templates:
+                # keep the code alive so that its id stays unique
+                self._templates[key] = (program, VM.from_code(program, **self.settings))
+            program = self._templates[key][1]
+        vm = program.fork(output=outbox)
+        task = Task(self, vm, inbox, priority, len(self.tasks) if name is None else name)
+        self.tasks.append(task)
+        if inbox is None:
+            self._schedule(task)
+        else:
+            self._wait(task)
+        return task
+
+    def _schedule(self, task):
+        task.state = 'ready'
+        if self.policy == 'priority':
+            self._order += 1
+            heapq.heappush(self._heap, (-task.priority, self._order, task))
+        else:
+            self._ready.append(task)
+
+    def _next(self):
+        if self.policy == 'priority':
+            return heapq.heappop(self._heap)[2] if self._heap else None
+        return self._ready.popleft() if self._ready else None
+
+    def _wait(self, task):
+        '''Give task its next message, or block it on its inbox.'''
+        if task.inbox.items:
+            self._deliver(task)
+        else:
+            task.state = 'blocked'
+            task.inbox.waiting.append(task)
+
+    def _deliver(self, task):
+        '''Restart task at its entry with the next inbox message.'''
+        value, task.sent = task.inbox.items.popleft()
+        vm = task.vm
+        vm.unshare()
+        if not len(vm.stack):
+            memory.grow(vm.stack, 0, vm.stack_size, "stack")
+        vm.stack[0] = value
+        vm.ip, vm.sp, vm.fp = task.entry, 0, -1
+        del vm.memo_frames[:]
+        task.messages += 1
+        self.messages += 1
+        self._schedule(task)
+
+    def run(self):
+        '''Run tasks until none is ready; returns :meth:`stats`.
+
+        Blocked tasks stay blocked: send them messages and run() again.
+        '''
+        clock = self.clock
+        started = clock()
+        quantum = self.quantum
+        try:
+            task = self._next()
+            while task is not None:
+                result = task.vm.run(max_steps=quantum)
+                self.steps += result.steps
+                self.slices += 1
+                if result.status == 'budget':
+                    self._schedule(task)
+                elif result.status == 'error':
+                    task.state = 'error'
+                    task.error = result.error
+                else:
+                    if task.sent is not None:
+                        task.latencies.append(clock() - task.sent)
+                        task.sent = None
+                    if task.inbox is None:
+                        task.state = 'done'
+                    else:
+                        self._wait(task)
+                task = self._next()
+        finally:
+            self.seconds += clock() - started
+        return self.stats()
+
+    def stats(self):
+        return SchedulerStats(len(self.tasks), self.steps, self.slices, self.messages,
+                              self.seconds)
@@ -0,0 +1,130 @@
+'''
+simple-virtual-machine: VM snapshots for warm starts.
+
+:meth:`VM.snapshot() <simplevirtualmachine.vm.VM.snapshot>` captures the
+registers, the live part of the stack (cells ``0..sp``) and the data
+cells that were written as a :class:`Snapshot`.  :meth:`VM.restore`
+puts a VM running the same code back into that state, and
+:meth:`VM.from_snapshot` builds a new VM from one.  A program with an
+expensive initialization phase can run it once, save the image and
+serve every later request from it::
+
+    vm = VM(*code, engine='decoded')
+    for _ in vm.run_iter(1):
+        if vm.ip == ready:
+            break
+    snapshot.dump(vm.snapshot(), "warm.svms")
+    ...
+    vm = VM.from_snapshot(snapshot.load("warm.svms"))
+    vm.run()
+
+Image files are JSON, so loading one never runs code.  Output sinks,
+tracers and memo caches are not part of a snapshot; a VM built from one
+gets them from its own settings.
+
+For many runs from one state in the same process, :meth:`VM.fork` is
+cheaper still: see its documentation.
+'''
+
+import json
+import numbers
+
+from simplevirtualmachine.bytecodes import Bytecode, InvalidBytecodeError
+
+FORMAT = 'svm-snapshot'
+VERSION = 1
+
+# VMConfig fields that describe the program rather than the process
+SETTINGS = ('stack_size', 'data_size', 'start_ip', 'engine', 'memory', 'fuse', 'verify',
+            'integers')
+
+
+class SnapshotFormatError(InvalidBytecodeError):
+    """The file is not a valid snapshot image."""
+
+
+class Snapshot(object):
+    """A VM state: registers, step count, live stack and written data.
+
+    ``stack`` is a tuple of the cells ``0..sp``, ``data`` maps written
+    data addresses to values and ``memo_frames`` lists the memoizable
+    calls still running.  ``code`` is the code the VM ran (after
+    optimization) and ``settings`` the VMConfig fields of :data:`SETTINGS`,
+    with ``start_ip`` an address in that code.
+    """
+
+    def __init__(self, code, settings, ip, sp, fp, steps, stack, data, memo_frames=()):
+        self.code = code
+        self.settings = settings
+        self.ip = ip
+        self.sp = sp
+        self.fp = fp
+        self.steps = steps
+        self.stack = tuple(stack)
+        self.data = data
+        self.memo_frames = tuple(memo_frames)
+
+    def __repr__(self):
+        return "Snapshot(ip={}, sp={}, fp={}, steps={}, {} data cell(s))".format(
+            self.ip, self.sp, self.fp, self.steps, len(self.data))
+
+    def __eq__(self, other):
+        return isinstance(other, Snapshot) and self._state() == other._state()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def _state(self):
+        return (tuple(self.code), self.settings, self.ip, self.sp, self.fp, self.steps,
+                self.stack, self.data, self.memo_frames)
+
+
+def dump(snapshot, path):
+    '''Write snapshot to path as a JSON image.'''
+    code = [slot.name if isinstance(slot, Bytecode) else slot for slot in snapshot.code]
+    image = {
+        'format': FORMAT,
+        'version': VERSION,
+        'code': code,
+        'settings': snapshot.settings,
+        'registers': [snapshot.ip, snapshot.sp, snapshot.fp, snapshot.steps],
+        'stack': list(snapshot.stack),
+        'data': sorted(snapshot.data.items()),
+        'memo_frames': [[fp, target, list(args)]
+                        for fp, (target, args) in snapshot.memo_frames],
+    }
+    with open(path, 'w') as f:
+        json.dump(image, f, separators=(',', ':'))
+
+
+def load(path):
+    '''Read a snapshot image written by :func:`dump`.'''
+    with open(path) as f:
+        try:
+            image = json.load(f)
+        except ValueError as e:
+            raise SnapshotFormatError("{}: not a snapshot image ({})".format(path, e))
+    if not isinstance(image, dict) or image.get('format') != FORMAT:
+        raise SnapshotFormatError("{}: not a snapshot image".format(path))
+    if image.get('version') != VERSION:
+        raise SnapshotFormatError("{}: unsupported snapshot version {!r}".format(
+            path, image.get('version')))
+
+    bytecodes = dict((bytecode.name, bytecode) for bytecode in Bytecode.opcodes.values())
+    code = []
+    for addr, slot in enumerate(image['code']):
+        if not isinstance(slot, numbers.Integral):
+            if slot not in bytecodes:
+                raise SnapshotFormatError("{}: unknown bytecode {!r} at {}".format(
+                    path, slot, addr))
+            slot = bytecodes[slot]
+        code.append(slot)
+
+    ip, sp, fp, steps = image['registers']
+    return Snapshot(tuple(code), dict((str(k), v) for k, v in image['settings'].items()),
+                    ip, sp, fp, steps, image['stack'],
+                    dict((addr, value) for addr, value in image['data']),
+                    [(fp_, (target, tuple(args)))
+                     for fp_, target, args in image['memo_frames']])
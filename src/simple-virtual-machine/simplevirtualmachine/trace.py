@@ -0,0 +1,110 @@
+'''
+simple-virtual-machine: execution tracing.
+
+A tracer is handed to the VM with the ``trace`` keyword and is called once
+per executed instruction.  With tracing off the engines never call into
+this module, so nothing is formatted or allocated per instruction.
+
+``trace`` accepts:
+
+* ``None`` / ``False`` -- off (streams to ``logger.debug`` when the VM
+  logger is enabled for DEBUG, which was the old behaviour).
+* an ``int`` -- keep the last N steps in a :class:`RingTracer`.
+* a file-like object or a callable -- stream every step through a
+  :class:`StreamTracer`.
+* a :class:`Tracer` instance -- used as is.
+'''
+
+import abc
+import collections
+
+from simplevirtualmachine.bytecodes import Bytecode
+
+
+def format_instruction(code, ip):
+    '''Return "IP: BYTECODE OPERANDS" for the instruction at code[ip].
+
+    >>> from simplevirtualmachine.bytecodes import ICONST, HALT
+    >>> format_instruction((ICONST, 7, HALT), 0).split()
+    ['0000:', 'ICONST', '(1)', '7']
+    '''
+    opcode = code[ip]
+    if not isinstance(opcode, Bytecode):
+        return ""
+
+    operands = ", ".join(str(code[idx])
+                         for idx in range(ip + 1, ip + opcode.operands_read + 1))
+
+    return "{:04d}:\t{:10s}\t{:10s}".format(ip, opcode.dump_bytecode(), operands)
+
+
+def format_stack(stack, sp):
+    '''Return "STACK [...]" for the live part of stack, "" when empty.
+
+    >>> format_stack([1, 2, None], 1)
+    'STACK [1, 2]'
+    '''
+    if sp < 0:
+        return ""
+
+    return "STACK [{}]".format(", ".join(str(stack[idx]) for idx in range(sp + 1)))
+
+
+# abc.ABC for Python 2 and 3 alike
+_ABC = abc.ABCMeta('_ABC', (object,), {})
+
+
+class Tracer(_ABC):
+    """Receives one ``step`` call per executed instruction.
+
+    A subclass that does not define ``step`` cannot be instantiated.
+    """
+
+    @abc.abstractmethod
+    def step(self, vm, ip):
+        '''Called after the instruction that started at ip has executed.'''
+
+
+class RingTracer(Tracer):
+    """Keep the last ``size`` steps; format them only when asked."""
+
+    def __init__(self, size):
+        self.code = ()
+        self.entries = collections.deque(maxlen=size)
+
+    def step(self, vm, ip):
+        self.code = vm.code
+        self.entries.append((ip, tuple(vm.stack[:vm.sp + 1])))
+
+    def lines(self):
+        '''Return the buffered steps formatted as trace lines, oldest first.'''
+        return [format_instruction(self.code, ip) + format_stack(stack, len(stack) - 1)
+                for ip, stack in self.entries]
+
+
+class StreamTracer(Tracer):
+    """Format every step and send it to a file-like object or callable."""
+
+    def __init__(self, sink):
+        if hasattr(sink, 'write'):
+            self.emit = lambda line: sink.write(line + "\n")
+        else:
+            self.emit = sink
+
+    def step(self, vm, ip):
+        self.emit(format_instruction(vm.code, ip) + format_stack(vm.stack, vm.sp))
+
+
+def make_tracer(trace):
+    '''Build the tracer for a ``trace`` keyword value, or None for off.'''
+    if trace is None or trace is False:
+        return None
+    if isinstance(trace, Tracer):
+        return trace
+    if isinstance(trace, bool):
+        raise ValueError("trace=True is ambiguous, pass a ring size, file or callable")
+    if isinstance(trace, int):
+        return RingTracer(trace)
+    if hasattr(trace, 'write') or callable(trace):
+        return StreamTracer(trace)
+    raise ValueError("unsupported trace value {!r}".format(trace))
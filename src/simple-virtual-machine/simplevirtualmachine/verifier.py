@@ -0,0 +1,337 @@
+'''
+simple-virtual-machine: load-time verification and control-flow graph.
+
+:func:`verify` follows every path from the entry point and from each
+CALL target and checks, before anything runs, that
+
+* every reachable slot is an opcode with all its operands, and control
+  never runs off the end of the code,
+* BR/BRT/BRF/CALL/TCALL targets start an instruction, never land inside one,
+* the stack never underflows, and every address reached along several
+  paths is reached with the same stack depth,
+* LOAD/STORE offsets address an argument or a live stack cell of the
+  current frame, and each function is always called with the same
+  number of arguments,
+* GLOAD/GSTORE addresses, and the ranges of the bulk instructions
+  MEMSET, MEMCPY, VADD, VMUL and VSUM, are inside data memory.
+
+It returns a :class:`Verified` program with the basic blocks, the
+per-function stack depths and, when no function is recursive, the exact
+number of stack cells a run can use.  ``VM(..., verify=True)`` verifies
+at construction and sizes memory exactly, which lets the interpreter
+skip its per-step bounds check.
+'''
+
+from simplevirtualmachine.bulk import BULK, ranges
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, IEQ, BR, BRT, BRF, \
+    ICONST, LOAD, GLOAD, STORE, GSTORE, PUTS, POP, CALL, RET, HALT, TCALL, MEMSET, MEMCPY, \
+    VADD, VMUL, VSUM, Bytecode, InvalidBytecodeError
+
+# stack cells popped and pushed; CALL and TCALL are handled separately
+EFFECTS = {
+    IADD: (2, 1), ISUB: (2, 1), IMUL: (2, 1), ILT: (2, 1), IEQ: (2, 1),
+    BR: (0, 0), BRT: (1, 0), BRF: (1, 0),
+    ICONST: (0, 1), LOAD: (0, 1), GLOAD: (0, 1),
+    STORE: (1, 0), GSTORE: (1, 0), PUTS: (1, 0), POP: (1, 0),
+    RET: (1, 0), HALT: (0, 0),
+    MEMSET: (1, 0), MEMCPY: (0, 0), VADD: (0, 0), VMUL: (0, 0), VSUM: (0, 1),
+}
+
+# CALL pushes argument count, saved fp and return address
+FRAME_HEADER = 3
+
+_JUMPS = (BR, BRT, BRF)
+_ENDS = (BR, RET, HALT)
+_CALLS = (CALL, TCALL)
+
+
+class VerifyError(InvalidBytecodeError):
+    """The code fails verification; ``addr`` is the offending instruction."""
+
+    def __init__(self, message, addr=None):
+        super(VerifyError, self).__init__(
+            message if addr is None else "{:04d}: {}".format(addr, message))
+        self.addr = addr
+
+
+class BasicBlock(object):
+    """A straight-line run of instructions.
+
+    ``addrs`` are the instruction addresses, ``end`` the address after
+    the last one and ``successors`` the addresses control may go to next
+    (a CALL block's successor is its return address).
+    """
+    __slots__ = ('start', 'end', 'addrs', 'successors')
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.addrs = []
+        self.successors = []
+
+    def __repr__(self):
+        return "BasicBlock({}, {}, {})".format(self.start, self.end, self.successors)
+
+
+class Function(object):
+    """Stack facts for the code reachable from one entry point.
+
+    ``depths[addr]`` is the stack depth before the instruction at addr,
+    relative to fp (to the empty stack for the program entry);
+    ``max_depth`` counts the CALL frame headers this function pushes, and
+    ``calls`` lists (addr, depth before the CALL, target); ``tail_calls``
+    holds the addresses of the TCALLs among them.
+
+    Static analysis treats TCALL as a CALL followed by the next
+    instruction, which is exactly what it is in the entry frame.
+    """
+
+    def __init__(self, entry, nargs):
+        self.entry = entry
+        self.nargs = nargs
+        self.depths = {}
+        self.max_depth = 0
+        self.calls = []
+        self.tail_calls = set()
+
+
+class Verified(object):
+    """The result of :func:`verify`.
+
+    ``max_stack`` is the most stack cells a run can use, or None when a
+    function can call itself (directly or not); ``data_cells`` is one past
+    the highest data address used.
+    """
+
+    def __init__(self, code, entry, instructions, blocks, functions, max_stack, data_cells):
+        self.code = code
+        self.entry = entry
+        self.instructions = instructions
+        self.blocks = blocks
+        self.functions = functions
+        self.max_stack = max_stack
+        self.data_cells = data_cells
+
+    @property
+    def recursive(self):
+        return self.max_stack is None
+
+
+def decode_reachable(code, entries):
+    '''Decode every instruction reachable from entries.
+
+    Returns {addr: (bytecode, operands, next addr)}; raises VerifyError for
+    invalid opcodes, missing operands and jumps into operands.
+    '''
+    instructions = {}
+    owner = {}      # operand slot -> address of its instruction
+    work = list(entries)
+    while work:
+        addr = work.pop()
+        if addr in instructions:
+            continue
+        if not 0 <= addr < len(code):
+            raise VerifyError("control reaches address {} outside the code".format(addr))
+        if addr in owner:
+            raise VerifyError("jump into the operands of the instruction at {}".format(
+                owner[addr]), addr)
+        bytecode = code[addr]
+        if not isinstance(bytecode, Bytecode) or (bytecode not in EFFECTS and
+                                                  bytecode not in _CALLS):
+            raise VerifyError("invalid opcode {!r}".format(bytecode), addr)
+        width = bytecode.operands_read
+        if addr + width >= len(code) and width:
+            raise VerifyError("{} is missing operands".format(bytecode.name), addr)
+        for slot in range(addr + 1, addr + 1 + width):
+            if slot in instructions:
+                raise VerifyError("jump into the operands of the instruction at {}".format(
+                    addr), slot)
+            owner[slot] = addr
+        next_addr = addr + 1 + width
+        instructions[addr] = (bytecode, code[addr + 1:next_addr], next_addr)
+
+        if bytecode in _JUMPS or bytecode in _CALLS:
+            work.append(code[addr + 1])
+        if bytecode not in _ENDS:
+            work.append(next_addr)
+    return instructions
+
+
+def _successors(bytecode, operands, next_addr):
+    if bytecode is BR:
+        return [operands[0]]
+    if bytecode in (BRT, BRF):
+        return [operands[0], next_addr]
+    if bytecode in (RET, HALT):
+        return []
+    return [next_addr]
+
+
+def _blocks(instructions, entries):
+    '''Split the reachable instructions into basic blocks.'''
+    leaders = set(entries)
+    for addr, (bytecode, operands, next_addr) in instructions.items():
+        if bytecode in _JUMPS or bytecode in _CALLS:
+            leaders.add(operands[0])
+        if bytecode in _JUMPS or bytecode in _ENDS or bytecode in _CALLS:
+            leaders.add(next_addr)
+
+    blocks = {}
+    for start in sorted(leaders):
+        if start not in instructions:
+            continue
+        block = blocks[start] = BasicBlock(start)
+        addr = start
+        while True:
+            bytecode, operands, next_addr = instructions[addr]
+            block.addrs.append(addr)
+            block.end = next_addr
+            if next_addr in leaders or bytecode in _JUMPS or bytecode in _ENDS \
+                    or bytecode in _CALLS:
+                block.successors = _successors(bytecode, operands, next_addr)
+                break
+            addr = next_addr
+    return blocks
+
+
+def _frame_slot(function, offset, depth, addr):
+    '''Check a LOAD/STORE offset against the current frame.'''
+    if function.entry is None:
+        # the entry frame has fp = -1: offset n is stack cell n - 1
+        valid = 1 <= offset <= depth
+    else:
+        valid = -(FRAME_HEADER - 1 + function.nargs) <= offset <= -FRAME_HEADER \
+            or 1 <= offset <= depth
+    if not valid:
+        raise VerifyError("frame offset {} is outside the frame (depth {}, {} argument(s))".format(
+            offset, depth, function.nargs), addr)
+
+
+def _analyse(function, start, instructions, data_size, called):
+    '''Follow every path of function, recording depths and calls.'''
+    depths = function.depths
+    work = [(start, 0)]
+    while work:
+        addr, depth = work.pop()
+        if addr in depths:
+            if depths[addr] != depth:
+                raise VerifyError("stack depth {} here, {} along another path".format(
+                    depth, depths[addr]), addr)
+            continue
+        depths[addr] = depth
+        bytecode, operands, next_addr = instructions[addr]
+
+        if bytecode in _CALLS:
+            target, nargs = operands
+            if bytecode is TCALL:
+                function.tail_calls.add(addr)
+            if depth < nargs:
+                raise VerifyError("{} with {} argument(s) on a stack of {}".format(
+                    bytecode.name, nargs, depth), addr)
+            if called.setdefault(target, nargs) != nargs:
+                raise VerifyError("function {} called with {} argument(s), elsewhere {}".format(
+                    target, nargs, called[target]), addr)
+            function.calls.append((addr, depth, target))
+            function.max_depth = max(function.max_depth, depth + FRAME_HEADER)
+            work.append((next_addr, depth - nargs + 1))
+            continue
+
+        pops, pushes = EFFECTS[bytecode]
+        if depth < pops:
+            raise VerifyError("{} needs {} stack value(s), has {}".format(
+                bytecode.name, pops, depth), addr)
+        if bytecode is LOAD or bytecode is STORE:
+            _frame_slot(function, operands[0], depth, addr)
+        elif bytecode is GLOAD or bytecode is GSTORE:
+            if not 0 <= operands[0] < data_size:
+                raise VerifyError("data address {} outside data memory of {} cells".format(
+                    operands[0], data_size), addr)
+        elif bytecode in BULK:
+            for first, length in ranges(bytecode, operands):
+                if length < 0 or first < 0 or length and first + length > data_size:
+                    raise VerifyError("data range of {} cell(s) at {} outside data memory of "
+                                      "{} cells".format(length, first, data_size), addr)
+        depth += pushes - pops
+        function.max_depth = max(function.max_depth, depth)
+        for successor in _successors(bytecode, operands, next_addr):
+            work.append((successor, depth))
+
+
+def _max_stack(functions, entry):
+    '''Return the stack cells needed from entry, None if recursion is possible.'''
+    needs = {}
+    active = set()
+
+    def need(key):
+        if key in needs:
+            return needs[key]
+        if key in active:
+            return None
+        active.add(key)
+        function = functions[key]
+        total = function.max_depth
+        for addr, depth, target in function.calls:
+            tail = key is not None and addr in function.tail_calls
+            if tail and target == key:
+                # reuses this very frame
+                continue
+            inner = need(target)
+            if inner is None:
+                active.discard(key)
+                return None
+            if tail:
+                # the callee's frame replaces this one's arguments and header
+                total = max(total, functions[target].nargs - function.nargs + inner)
+            else:
+                total = max(total, depth + FRAME_HEADER + inner)
+        active.discard(key)
+        needs[key] = total
+        return total
+
+    return need(entry)
+
+
+def verify(code, entry=0, data_size=None, stack_size=None):
+    '''Verify code run from entry; returns a :class:`Verified` program.
+
+    data_size, when given, bounds GLOAD/GSTORE addresses; stack_size, when
+    given and no function is recursive, must cover the computed maximum.
+    Raises :class:`VerifyError` describing the first problem found.
+
+    >>> from simplevirtualmachine.bench import call_program
+    >>> verified = verify(call_program(5), entry=6)
+    >>> verified.max_stack, sorted(verified.blocks)
+    (6, [0, 6, 10, 17, 22, 26])
+    '''
+    instructions = decode_reachable(code, [entry])
+    if data_size is None:
+        data_size = float('inf')
+
+    called = {}
+    functions = {None: Function(None, 0)}
+    _analyse(functions[None], entry, instructions, data_size, called)
+    pending = [target for target in called if target not in functions]
+    while pending:
+        target = pending.pop()
+        if target in functions:
+            continue
+        functions[target] = Function(target, called[target])
+        _analyse(functions[target], target, instructions, data_size, called)
+        pending.extend(t for t in called if t not in functions)
+
+    max_stack = _max_stack(functions, None)
+    if stack_size is not None and max_stack is not None and max_stack > stack_size:
+        raise VerifyError("program needs {} stack cells, stack_size is {}".format(
+            max_stack, stack_size))
+
+    data_cells = 0
+    for bytecode, operands, next_addr in instructions.values():
+        if bytecode is GLOAD or bytecode is GSTORE:
+            data_cells = max(data_cells, operands[0] + 1)
+        elif bytecode in BULK:
+            for first, length in ranges(bytecode, operands):
+                if length:
+                    data_cells = max(data_cells, first + length)
+
+    blocks = _blocks(instructions, [entry] + [f for f in functions if f is not None])
+    return Verified(code, entry, instructions, blocks, functions, max_stack, data_cells)
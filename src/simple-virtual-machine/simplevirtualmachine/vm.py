@@ -1,39 +1,218 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import itertools
 import logging
 import operator
 
 from simplevirtualmachine.bytecodes import INVALID, IADD, ISUB, IMUL, \
     IEQ, ILT, BR, BRT, BRF, ICONST, LOAD, GLOAD, STORE, GSTORE, \
-    PUTS, POP, CALL, RET, HALT, Bytecode, InvalidBytecodeError
+    PUTS, POP, CALL, RET, HALT, TCALL, MEMSET, MEMCPY, VADD, VMUL, VSUM, TRUE, FALSE, \
+    Bytecode, InvalidBytecodeError
+from simplevirtualmachine import bulk, integers, memory
+from simplevirtualmachine.compiler import compiled_program
+from simplevirtualmachine.config import DEFAULT_CONFIG, DEFAULT_STACK_SIZE, \
+    ENGINES, INTEGERS, MEMORIES
+from simplevirtualmachine.decoder import decode
+from simplevirtualmachine.fusion import fuse
+from simplevirtualmachine.integers import INT64_MIN, INT64_MAX
+from simplevirtualmachine.memo import make_cache, pure_functions
+from simplevirtualmachine.optimizer import optimize
+from simplevirtualmachine.output import ListSink, make_sink
+from simplevirtualmachine.snapshot import SETTINGS, Snapshot
+from simplevirtualmachine.trace import format_instruction, format_stack, \
+    make_tracer, StreamTracer
+from simplevirtualmachine.verifier import verify
 
-TRUE = 1
-FALSE = 0
+# instructions run_iter() and run_async() execute between yields
+DEFAULT_QUANTUM = 1000
+
+_MISSING = object()
+
+
+class RunResult(collections.namedtuple('RunResult', 'status steps error')):
+    """The outcome of ``run(max_steps=...)`` or ``step()``.
+
+    status is ``'halt'``, ``'budget'`` when instructions remain or
+    ``'error'`` (error then holds the exception); steps is the number of
+    instructions this call ran.
+    """
+    __slots__ = ()
 
 
 class VM(object):
-    """Implemenation of a (very) simple virtual machine."""
+    """Implemenation of a (very) simple virtual machine.
+
+    Settings come from an immutable :class:`~simplevirtualmachine.config.VMConfig`
+    passed as ``config``; keyword arguments override single fields of it for
+    this VM only, and nothing is written back to the class.
+
+    The interpreter engine is chosen with the ``engine`` setting:
+
+    * ``'switch'`` (default) -- the reference if/elif fetch-decode loop.
+    * ``'table'`` -- dispatch through a table indexed by ``Bytecode.opcode``.
+    * ``'decoded'`` -- run the pre-decoded instruction records built by
+      :func:`simplevirtualmachine.decoder.decode` on first use.
+    * ``'compiled'`` -- run basic blocks compiled to Python functions, see
+      :mod:`simplevirtualmachine.compiler`.  With a tracer it runs as
+      'decoded'.
+
+    Per-instruction tracing is off unless ``trace`` is given, see
+    :mod:`simplevirtualmachine.trace`.
+
+    ``memory='array'`` replaces the preallocated stack and data lists with
+    integer arrays grown on demand (not with the switch engine), see
+    :mod:`simplevirtualmachine.memory`.
+
+    ``fuse=True`` runs common instruction sequences as superinstructions on
+    the decoded engine, see :mod:`simplevirtualmachine.fusion`.
+
+    ``verify=True`` verifies the code when the VM is built (raising
+    :class:`~simplevirtualmachine.verifier.VerifyError`), sizes stack and
+    data memory to exactly what the program can use, and lets the switch
+    engine skip its per-step ip bounds check.
+
+    ``optimize=1`` or ``2`` runs the VM on the code rewritten by
+    :func:`simplevirtualmachine.optimizer.optimize`; ``code`` and ``ip``
+    then refer to the optimized code and ``optimized.remap`` maps original
+    addresses to it.
+
+    ``TCALL target, nargs`` is a tail call: inside a function it moves the
+    arguments down over the current frame's and reuses its return address,
+    so a chain of tail calls runs in constant stack.  In the entry frame
+    it is a plain CALL.
+
+    ``memoize=size`` caches the results of pure functions in ``memo``, a
+    :class:`~simplevirtualmachine.memo.MemoCache`, and answers repeated
+    CALLs from it, see :mod:`simplevirtualmachine.memo`.
+
+    MEMSET, MEMCPY, VADD, VMUL and VSUM work on ranges of data memory in
+    one instruction, see :mod:`simplevirtualmachine.bulk`.
+
+    ``integers='wrap'`` or ``'trap'`` makes IADD, ISUB and IMUL int64
+    operations that wrap or raise on overflow instead of growing into
+    bignums, see :mod:`simplevirtualmachine.integers`.
+
+    PUTS values go to the sink given as ``output``, by default buffered
+    ``OUTPUT: <value>`` lines on stdout, see :mod:`simplevirtualmachine.output`.
+
+    :meth:`run_iter` and :meth:`run_async` run the program in quanta of a
+    fixed number of instructions, for embedding the VM in a scheduler or
+    an asyncio event loop.
+
+    :meth:`snapshot`, :meth:`restore` and :meth:`from_snapshot` save and
+    restore the VM's state, see :mod:`simplevirtualmachine.snapshot`, and
+    :meth:`fork` copies a VM cheaply.
+    """
+
+    DEFAULT_STACK_SIZE = DEFAULT_STACK_SIZE
+    ENGINES = ENGINES
+    MEMORIES = MEMORIES
+    INTEGERS = INTEGERS
 
     def __init__(self, *code, **kwargs):
         self.logger = logging.getLogger(__name__)
         self.logger.info("\n")
 
-        if 'stack_size' in kwargs:
-            VM.DEFAULT_STACK_SIZE = kwargs['stack_size']
-        else:
-            VM.DEFAULT_STACK_SIZE = 10000
+        # from_code() passes the code sequence as is
+        code = kwargs.pop('_code', code)
+        config = kwargs.pop('config', DEFAULT_CONFIG)
+        if kwargs:
+            config = config.replace(**kwargs)
+        self.config = config
 
-        if 'start_ip' in kwargs:
-            self.logger.debug("setting ip = {}".format(kwargs['start_ip']))
-            self.ip = kwargs['start_ip']
-        else:
-            self.ip = 0
+        self.engine = config.engine
+        self.memory = config.memory
+        self.stack_size = config.stack_size
+        self.data_size = config.data_size
+        self.integers = config.integers
+        # wraps or traps an out-of-range result; None when unbounded
+        self.int64 = integers.normalizer(config.integers)
+        if self.int64 is not None:
+            integers.check_constants(code)
+
+        self.tracer = self._make_tracer()
+        self.output = make_sink(config.output)
 
+        self.optimized = None
+        self.start_ip = config.start_ip
+        if config.optimize:
+            self.optimized = optimize(code, config.start_ip, config.optimize,
+                                      integers=config.integers)
+            code = self.optimized.code
+            self.start_ip = self.optimized.entry
+
+        self.ip = self.start_ip
         self.fp = -1
         self.sp = -1
+        self.steps = 0
         self.code = code
-        self.stack = [None for i in range(VM.DEFAULT_STACK_SIZE)]
-        self.data = [None for i in range(VM.DEFAULT_STACK_SIZE)]
+        self._program = None
+        self._compiled = None
+
+        # PUTS values not yet handed to a run_async sink
+        self.pending_output = []
+
+        self.verified = None
+        stack_cells, data_cells = self.stack_size, self.data_size
+        if self.memory == 'array':
+            # grown on demand
+            stack_cells = data_cells = 0
+        if config.verify:
+            self.verified = verify(code, self.start_ip, self.data_size, self.stack_size)
+            if self.verified.max_stack is not None:
+                stack_cells = self.verified.max_stack
+            data_cells = self.verified.data_cells
+
+        if self.memory == 'array':
+            self.stack = memory.allocate(stack_cells)
+            self.data = memory.allocate(data_cells)
+            self.data_written = bytearray(data_cells)
+        else:
+            self.stack = [None] * stack_cells
+            self.data = [None] * data_cells
+            self.data_written = None
+        # set while stack and data are shared with a fork
+        self._shared = None
+
+        self.memo = make_cache(config.memoize)
+        self.pure = frozenset()
+        # (fp, key) of memoizable calls still running, innermost last
+        self.memo_frames = []
+        if self.memo is not None:
+            self.pure = pure_functions(code, self.start_ip, self.verified)
+
+    @classmethod
+    def from_code(cls, code, program=None, **kwargs):
+        '''Build a VM that runs an existing code sequence without copying it.
+
+        code may be any sequence, e.g. the mapped code of a binary file.
+        program optionally is the decoded form of code, taken from another
+        VM with the same memory, fuse, integers and start_ip settings, so that many
+        VMs can share one decoding.
+        '''
+        vm = cls(_code=code, **kwargs)
+        vm._program = program
+        return vm
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **kwargs):
+        '''Build a VM in the state of a :class:`~simplevirtualmachine.snapshot.Snapshot`.
+
+        The VM runs the snapshot's code with its settings; keyword
+        arguments override them (and the config) as for ``VM``.
+        '''
+        settings = dict(snapshot.settings)
+        settings.update(kwargs)
+        vm = cls.from_code(snapshot.code, **settings)
+        vm.restore(snapshot)
+        return vm
+
+    def _make_tracer(self):
+        tracer = make_tracer(self.config.trace)
+        if tracer is None and self.logger.isEnabledFor(logging.DEBUG):
+            tracer = StreamTracer(self.logger.debug)
+        return tracer
 
     @classmethod
     def format_instr_or_object(cls, obj):
@@ -46,32 +225,222 @@ class VM(object):
         return ""
 
     def binopt(self, opr):
-        b = self.stack[self.sp]
-        self.sp -= 1
-        a = self.stack[self.sp]
-        self.sp -= 1
-
-        self.sp += 1
+        sp = self.sp
+        a = self.stack[sp - 1]
+        b = self.stack[sp]
         result = opr(a, b)
 
         # use 1 or 0 rather than True or False for booleans
         if opr == operator.lt or opr == operator.eq:
             result = TRUE if result else FALSE
+        elif self.int64 is not None and not INT64_MIN <= result <= INT64_MAX:
+            result = self.int64(result)
+
+        # sp last, so a failing operation leaves the registers alone
+        self.stack[sp - 1] = result
+        self.sp = sp - 1
+
+    def run(self, max_steps=None):
+        '''Run the program until HALT using the configured engine.
+
+        With max_steps, run at most that many instructions and return a
+        :class:`RunResult` instead of HALT, with exceptions reported in it
+        rather than raised.  After ``'budget'`` the registers are at an
+        instruction boundary and the next run() continues from there.
+        After ``'error'`` ip is the failing instruction with the 'table'
+        and 'decoded' engines and the start of its block with 'compiled';
+        the 'switch' engine leaves it part way through the instruction.
+        '''
+        if max_steps is None:
+            try:
+                rv = self._run_engine()
+            finally:
+                self.output.flush()
+            self._finish()
+            return rv
+
+        if max_steps < 0:
+            raise ValueError("max_steps must not be negative")
+        started = self.steps
+        error = None
+        try:
+            status = 'budget' if self._run_engine(max_steps) is None else 'halt'
+        except Exception as e:
+            status, error = 'error', e
+        finally:
+            self.output.flush()
+        if status == 'halt':
+            self._finish()
+        return RunResult(status, self.steps - started, error)
+
+    def step(self):
+        '''Run one instruction; returns a :class:`RunResult` as run() does.'''
+        return self.run(1)
+
+    def _run_engine(self, budget=None):
+        if self.engine == 'table':
+            return self.run_table(budget)
+        elif self.engine == 'decoded':
+            return self.run_decoded(budget)
+        elif self.engine == 'compiled':
+            return self.run_compiled(budget)
+        return self.run_switch(budget)
+
+    def _finish(self):
+        self.print_code_memory()
+        self.print_data_memory()
+        self.logger.info("returning")
+
+    def run_iter(self, quantum=DEFAULT_QUANTUM):
+        '''Run the program quantum instructions at a time.
+
+        A generator: each iteration executes at most quantum instructions
+        and yields the total step count; it stops at HALT.  Between
+        iterations the registers are at an instruction boundary, so the
+        generator may be abandoned and the VM resumed later with another
+        call to run(), run_iter() or run_async().
+        '''
+        if quantum < 1:
+            raise ValueError("quantum must be at least 1")
+        try:
+            while self._run_engine(quantum) is None:
+                self.output.flush()
+                yield self.steps
+        finally:
+            self.output.flush()
+        self._finish()
 
-        self.stack[self.sp] = result
-        self.logger.debug("binopt: a {} b {} result {} opr {} stack[{}]={}".format(
-            a, b, result, opr, self.sp, result))
+    def run_async(self, quantum=DEFAULT_QUANTUM, sink=None):
+        '''Return an awaitable that runs the program, yielding every quantum.
+
+        ``await vm.run_async()`` gives the event loop a turn after every
+        quantum instructions.  sink, when given, receives each PUTS value
+        instead of the output sink; it may be a plain function or return an
+        awaitable, which is awaited before the VM continues.  Values are
+        handed over at the end of each quantum, in order.
+
+        Cancelling the awaiting task stops the VM at an instruction
+        boundary; PUTS values the sink has not accepted stay in
+        ``pending_output`` and go first on the next run_async().
+        '''
+        if quantum < 1:
+            raise ValueError("quantum must be at least 1")
+        return _AsyncRun(self, quantum, sink)
+
+    def snapshot(self):
+        '''Return a :class:`~simplevirtualmachine.snapshot.Snapshot` of the
+        registers, the live part of the stack and the written data cells.'''
+        settings = dict((name, getattr(self.config, name)) for name in SETTINGS)
+        settings['start_ip'] = self.start_ip
+        return Snapshot(self.code, settings, self.ip, self.sp, self.fp, self.steps,
+                        self.stack[:self.sp + 1], self.written_data(), self.memo_frames)
+
+    def restore(self, snapshot):
+        '''Put the VM into the state of snapshot, taken from a VM running
+        the same code.  Data cells the snapshot does not list are cleared.'''
+        if snapshot.code is not self.code and tuple(snapshot.code) != tuple(self.code):
+            raise ValueError("snapshot was taken from a VM running different code")
+        share = self._shared
+        if share is not None:
+            # fresh memory below, so nothing to copy
+            self._shared = None
+            share.owners -= 1
+
+        data_cells = max(snapshot.data) + 1 if snapshot.data else 0
+        if self.memory == 'array':
+            stack_limit, data_limit = self.stack_size, self.data_size
+        else:
+            stack_limit, data_limit = len(self.stack), len(self.data)
+        if len(snapshot.stack) > stack_limit:
+            raise memory.MemoryOverflowError("snapshot stack of {} cells exceeds stack size {}".
+                                             format(len(snapshot.stack), stack_limit))
+        if data_cells > data_limit:
+            raise memory.MemoryOverflowError("snapshot data address {} exceeds data size {}".
+                                             format(data_cells - 1, data_limit))
+
+        if self.memory == 'array':
+            self.stack = memory.allocate()
+            self.stack.extend(snapshot.stack)
+            self.data = memory.allocate(data_cells)
+            self.data_written = bytearray(data_cells)
+            for addr in snapshot.data:
+                self.data_written[addr] = 1
+        else:
+            self.stack = [None] * stack_limit
+            self.stack[:len(snapshot.stack)] = snapshot.stack
+            self.data = [None] * data_limit
+        for addr, value in snapshot.data.items():
+            self.data[addr] = value
+
+        self.ip = snapshot.ip
+        self.sp = snapshot.sp
+        self.fp = snapshot.fp
+        self.steps = snapshot.steps
+        self.memo_frames = list(snapshot.memo_frames)
+        del self.pending_output[:]
+
+    def fork(self, output=None):
+        '''Return a copy of the VM that continues from its current state.
+
+        The copy shares the code, its decoded and compiled forms and the
+        memo cache, and shares the stack and data memory copy-on-write:
+        a VM copies them (shallowly) only when it next runs while another
+        VM still shares them, so a fork that is never run, and the last
+        VM to run, copy nothing.  Call :meth:`unshare` before writing
+        ``stack`` or ``data`` directly.  The copy gets its own tracer and
+        output sink, made from output when given, else from the settings.
+        '''
+        if self.engine in ('decoded', 'compiled'):
+            # decode once here rather than once per copy
+            self.program
+        vm = object.__new__(type(self))
+        vm.__dict__.update(self.__dict__)
+        vm.tracer = self._make_tracer()
+        vm.output = make_sink(self.config.output if output is None else output)
+        vm.pending_output = list(self.pending_output)
+        vm.memo_frames = list(self.memo_frames)
+        if self._shared is None:
+            self._shared = _SharedMemory()
+        self._shared.owners += 1
+        vm._shared = self._shared
+        return vm
+
+    def unshare(self):
+        '''Give the VM its own stack and data memory if a fork shares them.'''
+        share = self._shared
+        if share is None:
+            return
+        self._shared = None
+        share.owners -= 1
+        if share.owners:
+            self.stack = self.stack[:]
+            self.data = self.data[:]
+            if self.data_written is not None:
+                self.data_written = self.data_written[:]
+
+    def run_switch(self, budget=None):
+        '''Simulate the fetch-decode execute cycle.
+
+        With a budget, stop after that many instructions and return None.
+        '''
+        if self._shared is not None:
+            self.unshare()
+        tracer = self.tracer
+        memo = self.memo
+        # verified code cannot run off the end
+        unchecked = self.verified is not None
+        end = len(self.code)
 
-    def run(self):
-        '''Simulate the fetch-decode execute cycle.'''
         # fetch opcode
         opcode = self.code[self.ip]
         rv = HALT
 
-        while opcode != HALT and self.ip <= len(self.code):
-            trace = self.display_instruction()
-            self.logger.debug("IP {} OPCODE {}".format(self.ip, opcode))
+        for _ in _counter(0, budget):
+            if opcode == HALT or not (unchecked or self.ip <= end):
+                break
+            ip = self.ip
             self.ip += 1
+            self.steps += 1
 
             # decode
             if opcode == IADD:
@@ -125,12 +494,15 @@ class VM(object):
                 self.data[addr] = self.stack[self.sp]
                 self.sp -= 1
             elif opcode == PUTS:
-                msg = "OUTPUT: {}".format(self.stack[self.sp])
+                value = self.stack[self.sp]
                 self.sp -= 1
-                print msg
-                self.logger.info(msg)
+                self.output.write(value)
             elif opcode == POP:
                 self.sp -= 1
+            elif opcode == CALL and memo is not None and \
+                    self.memo_call(self.code[self.ip], self.code[self.ip + 1]):
+                # answered from the memo cache
+                self.ip += 2
             elif opcode == CALL:
                 # target addr of function
                 addr = self.code[self.ip]
@@ -159,10 +531,15 @@ class VM(object):
                 self.ip = addr
 
                 # self.stack = self.remove_none_from_array(self.stack)
+            elif opcode == TCALL:
+                self.ip += 2
+                self.tail_call(self.code[self.ip - 2], self.code[self.ip - 1])
             elif opcode == RET:
                 # pop return value
                 rvalue = self.stack[self.sp]
                 self.sp -= 1
+                if memo is not None:
+                    self.memo_return(rvalue)
 
                 # self.logger.debug("RET rvalue {}".format(rvalue))
                 # self.logger.debug("RET STACK {}".format(self.dump_stack()))
@@ -202,6 +579,8 @@ class VM(object):
 
                 # self.logger.debug("RET (end) sp {}".format(self.sp))
                 # self.logger.debug("RET (end) STACK {}".format(self.dump_stack()))
+            elif opcode in bulk.BULK:
+                self._op_bulk()
             elif opcode == HALT:
                 rv = HALT
             else:
@@ -209,72 +588,449 @@ class VM(object):
                 raise InvalidBytecodeError("Invalid opcode {opcode} at ip = {ip}".
                                            format(opcode=opcode, ip=self.ip - 1))
 
-            trace += self.dump_stack()
+            if tracer is not None:
+                tracer.step(self, ip)
 
             opcode = self.code[self.ip]
-            self.logger.debug("new opcode: {}".format(opcode))
+        else:
+            if opcode != HALT and (unchecked or self.ip <= end):
+                return None
 
-        self.print_code_memory()
-        self.print_data_memory()
-        self.logger.info("returning")
         return rv
 
-    def display_instruction(self):
-        '''Dislay instruction'''
-        opcode = self.code[self.ip]
-        self.logger.debug("opcode {}".format(opcode))
-        if not isinstance(opcode, Bytecode):
-            return ""
+    def run_table(self, budget=None):
+        '''Fetch-decode-execute cycle dispatching through DISPATCH_TABLE.
 
-        operands = ""
+        Each opcode is decoded with a single list index on its integer
+        ``Bytecode.opcode`` instead of walking the if/elif chain, so every
+        instruction costs the same to reach.  With a budget, stop after
+        that many instructions and return None.
+        '''
+        if self._shared is not None:
+            self.unshare()
+        code = self.code
+        table = [getattr(self, name) for name in DISPATCH_TABLE]
+        if self.data_written is not None:
+            table[GSTORE.opcode] = self._op_gstore_tracked
+        if self.memo is not None:
+            table[CALL.opcode] = self._op_call_memo
+            table[RET.opcode] = self._op_ret_memo
+        halt = HALT.opcode
+        tracer = self.tracer
+        steps = 0
+        ip = self.ip
 
-        self.logger.debug("self.sp {}".format(self.sp))
-        self.logger.debug("opcode.name {}".format(opcode.name))
-        self.logger.debug("opcode.operand_count {}".format(opcode.operand_count))
-        if opcode.operand_count > 0:
-            start_idx = self.ip + 1
-            end_idx = self.ip + opcode.operand_count
-            buf = []
-            self.logger.debug("start_idx {} end_idx {}".format(start_idx, end_idx))
-            for idx in range(start_idx, end_idx + 1):
-                self.logger.debug("INX {} OPERAND: {} ".format(idx, self.code[idx]))
-                buf.append(str(self.code[idx]))
+        try:
+            while True:
+                try:
+                    # steps counts the instruction being run
+                    for steps in _counter(steps, budget):
+                        ip = self.ip
+                        opcode = code[ip]
+                        try:
+                            op = opcode.opcode
+                        except AttributeError:
+                            op = INVALID.opcode
+                        if op == halt:
+                            steps -= 1
+                            return HALT
+                        self.ip = ip + 1
+                        table[op]()
+                        if tracer is not None:
+                            tracer.step(self, ip)
+                    # out of budget, unless only HALT is left
+                    ip = self.ip
+                    return HALT if code[ip] is HALT else None
+                except IndexError:
+                    # handlers commit registers last, so just rerun it
+                    self.ip = ip
+                    if ip >= len(code) or not self.grow_memory(ip):
+                        raise
+                    steps -= 1
+                except Exception:
+                    self.ip = ip
+                    raise
+        finally:
+            self.steps += steps
 
-            operands = ", ".join(buf)
+    @property
+    def program(self):
+        '''The decoded form of code, built on first access.'''
+        if self._program is None:
+            if self.data_written is None:
+                handlers = DECODED_HANDLERS
+            else:
+                handlers = TRACKED_DECODED_HANDLERS
+            if self.memo is not None:
+                handlers = list(handlers)
+                handlers[CALL.opcode] = _d_call_memo
+                handlers[RET.opcode] = _d_ret_memo
+            if self.int64 is not None:
+                handlers = list(handlers)
+                handlers[IADD.opcode] = _d_iadd_int64
+                handlers[ISUB.opcode] = _d_isub_int64
+                handlers[IMUL.opcode] = _d_imul_int64
+            program = decode(self.code, handlers)
+            if self.config.fuse:
+                program = fuse(program, self.start_ip, self.integers)
+            self._program = program
+        return self._program
 
-        self.logger.debug("IP {:04d}:\tBYTECODE {:10s}\tOPERAND COUNT {}\tOPERANDS {:10s}".format(
-            self.ip, opcode.dump_bytecode(), opcode.operand_count, operands))
+    @property
+    def compiled(self):
+        '''The compiled form of code, shared through the compiler's cache.'''
+        if self._compiled is None:
+            self._compiled = compiled_program(self.code, self.data_written is not None,
+                                              self.pure, self.integers)
+        return self._compiled
 
-        return "{:04d}:\t{:10s}\t{:10s}".format(self.ip, opcode.dump_bytecode(), operands)
+    def run_compiled(self, budget=None):
+        '''Run the program as compiled basic blocks.
 
-    def dump_stack(self):
-        '''Return the dump of the stack.'''
-        buf = []
+        Each step calls one block function, which returns the next ip.
+        With a budget, whole blocks run while they fit in it and the rest
+        is run one instruction at a time by run_decoded(), so the budget
+        is kept exactly.
+        '''
+        if self.tracer is not None:
+            return self.run_decoded(budget)
+        if self._shared is not None:
+            self.unshare()
+
+        blocks = self.compiled.blocks
+        ip = self.ip
+        steps = 0
+        try:
+            if budget is None:
+                while ip is not None:
+                    block = blocks[ip]
+                    ip = block(self)
+                    steps += block.steps
+                return HALT
+            while ip is not None:
+                block = blocks[ip]
+                if steps + block.steps > budget:
+                    break
+                ip = block(self)
+                steps += block.steps
+            else:
+                return HALT
+        finally:
+            self.steps += steps
+            if ip is not None:
+                self.ip = ip
+        return self.run_decoded(budget - steps)
+
+    def memo_call(self, target, nargs):
+        '''Answer a CALL from the memo cache; returns True if it was.
+
+        On a miss for a pure target, the frame the CALL is about to build
+        is remembered so that its RET stores the result.
+        '''
+        if target not in self.pure:
+            return False
+        stack = self.stack
+        sp = self.sp
+        base = sp - nargs + 1
+        key = (target, tuple(stack[base:sp + 1]))
+        value = self.memo.get(key, _MISSING)
+        if value is _MISSING:
+            frames = self.memo_frames
+            # a CALL rerun after grow_memory() replaces its own entry
+            if frames and frames[-1][0] == sp + 3:
+                frames.pop()
+            frames.append((sp + 3, key))
+            return False
+        stack[base] = value
+        self.sp = base
+        return True
+
+    def tail_call(self, target, nargs):
+        '''Replace the current frame with a call of target, or CALL it
+        from the entry frame; ip must already be past the TCALL.'''
+        stack = self.stack
+        sp = self.sp
+        fp = self.fp
+        if fp < 0:
+            stack[sp + 1] = nargs
+            stack[sp + 2] = fp
+            stack[sp + 3] = self.ip
+            self.sp = self.fp = sp + 3
+            self.ip = target
+            return
+        # the first argument slot of the current frame
+        base = fp - 2 - stack[fp - 2]
+        saved_fp = stack[fp - 1]
+        return_ip = stack[fp]
+        stack[base:base + nargs] = stack[sp - nargs + 1:sp + 1]
+        top = base + nargs
+        stack[top] = nargs
+        stack[top + 1] = saved_fp
+        stack[top + 2] = return_ip
+        self.sp = self.fp = top + 2
+        self.ip = target
+        if self.memo_frames:
+            self.memo_tail(fp, top + 2)
+
+    def memo_tail(self, fp, new_fp):
+        '''A tail call replaced the frame at fp with one at new_fp: its
+        result is the result of the memoizable call that built fp.'''
+        frames = self.memo_frames
+        if frames and frames[-1][0] == fp:
+            frames[-1] = (new_fp, frames[-1][1])
+
+    def memo_return(self, value):
+        '''Store value as the result of the returning frame if memoizable.'''
+        frames = self.memo_frames
+        if frames:
+            fp = self.fp
+            # drop frames left behind by a run that raised
+            while frames and frames[-1][0] > fp:
+                frames.pop()
+            if frames and frames[-1][0] == fp:
+                self.memo.put(frames.pop()[1], value)
+
+    def grow_memory(self, ip, end=None):
+        '''Grow array memory for the instruction at ip after an IndexError.
+
+        end is the code address past the faulting record when it covers
+        several instructions (a superinstruction).  Returns False when the
+        fault was not caused by array memory being too short, in which case
+        the IndexError is genuine.
+        '''
+        if self.data_written is None:
+            return False
+
+        code = self.code
+        addr = ip
+        while addr < (ip + 1 if end is None else end):
+            bytecode = code[addr]
+            if bytecode is GLOAD or bytecode is GSTORE:
+                cell = code[addr + 1]
+                if cell >= len(self.data):
+                    memory.grow(self.data, cell, self.data_size, "data", self.data_written)
+                    return True
+            addr += 1 + getattr(bytecode, 'operands_read', 0)
+
+        top = self.sp + (3 if code[ip] is CALL or code[ip] is TCALL else 1)
+        if top >= len(self.stack):
+            memory.grow(self.stack, top, self.stack_size, "stack")
+            return True
+
+        return False
+
+    def run_decoded(self, budget=None):
+        '''Run the pre-decoded instruction records.
+
+        Each step is one record fetch and one handler call; the handler
+        returns the index of the next record.  ip is kept as a code address
+        and written back when the loop exits.  With a budget, stop after
+        that many records and return None.
+        '''
+        if self._shared is not None:
+            self.unshare()
+        program = self.program
+        instrs = program.instructions
+        tracer = self.tracer
+        pc = program.index_of(self.ip)
+        instr = None
+        steps = 0
+
+        try:
+            while True:
+                try:
+                    # steps counts the record being run
+                    if tracer is None:
+                        for steps in _counter(steps, budget):
+                            instr = instrs[pc]
+                            pc = instr.handler(self, instr)
+                            if pc is None:
+                                break
+                    else:
+                        for steps in _counter(steps, budget):
+                            instr = instrs[pc]
+                            pc = instr.handler(self, instr)
+                            if pc is None:
+                                break
+                            tracer.step(self, instr.addr)
+                    break
+                except IndexError:
+                    # pc still indexes the faulting record unless the fetch itself failed
+                    if pc >= len(instrs) or \
+                            not self.grow_memory(instrs[pc].addr, program.end_of(pc)):
+                        raise
+                    steps -= 1
+            if pc is not None:
+                # out of budget, unless only HALT is left
+                return HALT if instrs[pc].bytecode is HALT else None
+            steps -= 1
+            return HALT
+        finally:
+            self.steps += steps
+            if instr is not None:
+                if pc is None:
+                    self.ip = instr.addr
+                elif pc < len(instrs):
+                    self.ip = instrs[pc].addr
+                else:
+                    self.ip = len(self.code)
+
+    def _op_iadd(self):
+        self.binopt(operator.add)
+
+    def _op_isub(self):
+        self.binopt(operator.sub)
+
+    def _op_imul(self):
+        self.binopt(operator.mul)
+
+    def _op_ilt(self):
+        self.binopt(operator.lt)
+
+    def _op_ieq(self):
+        self.binopt(operator.eq)
+
+    def _op_br(self):
+        self.ip = self.code[self.ip]
+
+    def _op_brt(self):
+        addr = self.code[self.ip]
+        self.ip += 1
+        if self.stack[self.sp] == TRUE:
+            self.ip = addr
+        self.sp -= 1
+
+    def _op_brf(self):
+        addr = self.code[self.ip]
+        self.ip += 1
+        if self.stack[self.sp] == FALSE:
+            self.ip = addr
+        self.sp -= 1
+
+    # Handlers below write memory before committing sp/fp so that an
+    # instruction can be rerun after grow_memory().
+
+    def _op_iconst(self):
+        self.stack[self.sp + 1] = self.code[self.ip]
+        self.sp += 1
+        self.ip += 1
+
+    def _op_load(self):
+        offset = self.code[self.ip]
+        self.ip += 1
+        self.stack[self.sp + 1] = self.stack[self.fp + offset]
+        self.sp += 1
+
+    def _op_gload(self):
+        addr = self.code[self.ip]
+        self.ip += 1
+        self.stack[self.sp + 1] = self.data[addr]
+        self.sp += 1
+
+    def _op_store(self):
+        offset = self.code[self.ip]
+        self.ip += 1
+        self.stack[self.fp + offset] = self.stack[self.sp]
+        self.sp -= 1
+
+    def _op_gstore(self):
+        addr = self.code[self.ip]
+        self.ip += 1
+        self.data[addr] = self.stack[self.sp]
+        self.sp -= 1
+
+    def _op_gstore_tracked(self):
+        addr = self.code[self.ip]
+        self.ip += 1
+        self.data[addr] = self.stack[self.sp]
+        self.data_written[addr] = 1
+        self.sp -= 1
+
+    def _op_puts(self):
+        value = self.stack[self.sp]
+        self.sp -= 1
+        self.output.write(value)
+
+    def _op_pop(self):
+        self.sp -= 1
 
-        if self.sp < 0:
-            return ""
+    def _op_call(self):
+        addr = self.code[self.ip]
+        number_args = self.code[self.ip + 1]
+        stack = self.stack
+        sp = self.sp
+        stack[sp + 1] = number_args
+        stack[sp + 2] = self.fp
+        stack[sp + 3] = self.ip + 2
+        self.sp = self.fp = sp + 3
+        self.ip = addr
 
-        for idx in range(self.sp + 1):
-            buf.append(str(self.stack[idx]))
+    def _op_tcall(self):
+        self.ip += 2
+        self.tail_call(self.code[self.ip - 2], self.code[self.ip - 1])
 
-        return "STACK [{}]".format(", ".join(buf))
+    def _op_call_memo(self):
+        if self.memo_call(self.code[self.ip], self.code[self.ip + 1]):
+            self.ip += 2
+        else:
+            self._op_call()
+
+    def _op_ret_memo(self):
+        self.memo_return(self.stack[self.sp])
+        self._op_ret()
+
+    def _op_ret(self):
+        stack = self.stack
+        rvalue = stack[self.sp]
+        sp = self.fp
+        self.ip = stack[sp]
+        self.fp = stack[sp - 1]
+        sp -= 3 + stack[sp - 2]
+        sp += 1
+        stack[sp] = rvalue
+        self.sp = sp
+
+    def _op_bulk(self):
+        bytecode = self.code[self.ip - 1]
+        end = self.ip + bytecode.operands_read
+        bulk.execute(self, bytecode, self.code[self.ip:end])
+        self.ip = end
+
+    def _op_invalid(self):
+        raise InvalidBytecodeError("Invalid opcode {opcode} at ip = {ip}".
+                                   format(opcode=self.code[self.ip - 1], ip=self.ip - 1))
+
+    def display_instruction(self, ip=None):
+        '''Return the instruction at ip (default: the current ip) formatted.'''
+        return format_instruction(self.code, self.ip if ip is None else ip)
+
+    def dump_stack(self):
+        '''Return the dump of the stack.'''
+        return format_stack(self.stack, self.sp)
 
     def print_stack(self):
-        self.logger.info(self.dump_stack())
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(self.dump_stack())
+
+    def written_data(self):
+        '''Return {address: value} for every data cell that was stored to.'''
+        if self.data_written is not None:
+            return dict((addr, self.data[addr])
+                        for addr, written in enumerate(self.data_written) if written)
+        return dict((addr, d) for addr, d in enumerate(self.data) if d is not None)
 
     def dump_data_memory(self):
         '''Return the dump of the data memory.'''
-        addr = 0
         buf = ["\nData memory:\n"]
-        for d in self.data:
-            if d is not None:
-                buf.append("{0:>4d} {1}".format(addr, d))
-            addr += 1
+        cells = self.written_data()
+        for addr in sorted(cells):
+            buf.append("{0:>4d} {1}".format(addr, cells[addr]))
 
         return "\n".join(buf)
 
     def print_data_memory(self):
-        self.logger.info(self.dump_data_memory())
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(self.dump_data_memory())
 
     def dump_code_memory(self):
         '''Return the dump of the code memory.'''
@@ -287,4 +1043,318 @@ class VM(object):
         return "\n".join(buf)
 
     def print_code_memory(self):
-        self.logger.info(self.dump_code_memory())
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(self.dump_code_memory())
+
+
+class _SharedMemory(object):
+    """Counts the VMs sharing one stack and data memory after fork()."""
+    __slots__ = ('owners',)
+
+    def __init__(self):
+        self.owners = 1
+
+
+class _AsyncRun(object):
+    """The awaitable returned by :meth:`VM.run_async`.
+
+    ``__await__`` is a plain generator: a bare yield hands the event loop
+    a turn, and sink awaitables are driven by iterating their own
+    ``__await__``.  Awaiting it gives None; the results are on the VM.
+    """
+
+    def __init__(self, vm, quantum, sink):
+        self.vm = vm
+        self.quantum = quantum
+        self.sink = sink
+
+    def __await__(self):
+        vm = self.vm
+        output = vm.output
+        if self.sink is None:
+            # left over from a cancelled run with a sink
+            for value in vm.pending_output:
+                output.write(value)
+            del vm.pending_output[:]
+        else:
+            vm.output = ListSink(vm.pending_output)
+        try:
+            while True:
+                rv = vm._run_engine(self.quantum)
+                pending = vm.pending_output
+                while pending:
+                    awaitable = self.sink(pending[0])
+                    if awaitable is not None:
+                        for item in awaitable.__await__():
+                            yield item
+                    # only drop the value once the sink has taken it
+                    del pending[0]
+                if rv is not None:
+                    break
+                vm.output.flush()
+                yield
+        finally:
+            vm.output = output
+            output.flush()
+        vm._finish()
+
+    __iter__ = __await__
+
+
+def _build_dispatch_table():
+    '''Map every integer opcode to the name of its VM handler method.'''
+    handlers = {
+        IADD: '_op_iadd', ISUB: '_op_isub', IMUL: '_op_imul',
+        ILT: '_op_ilt', IEQ: '_op_ieq',
+        BR: '_op_br', BRT: '_op_brt', BRF: '_op_brf',
+        ICONST: '_op_iconst', LOAD: '_op_load', GLOAD: '_op_gload',
+        STORE: '_op_store', GSTORE: '_op_gstore',
+        PUTS: '_op_puts', POP: '_op_pop',
+        CALL: '_op_call', RET: '_op_ret', TCALL: '_op_tcall',
+        MEMSET: '_op_bulk', MEMCPY: '_op_bulk', VADD: '_op_bulk', VMUL: '_op_bulk',
+        VSUM: '_op_bulk',
+    }
+    table = ['_op_invalid'] * (max(Bytecode.opcodes) + 1)
+    for bytecode, name in handlers.items():
+        table[bytecode.opcode] = name
+    return table
+
+
+DISPATCH_TABLE = _build_dispatch_table()
+
+
+def _counter(done, budget=None):
+    '''Iterate over the step numbers after done, up to budget if given.
+
+    The engines loop over this rather than testing a step count per
+    instruction, so a budget costs nothing on the way.
+
+    >>> list(_counter(2, 5))
+    [3, 4, 5]
+    '''
+    steps = itertools.count(done + 1)
+    if budget is None:
+        return steps
+    return itertools.islice(steps, max(budget - done, 0))
+
+
+def _d_iadd(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    stack[sp] = stack[sp] + stack[sp + 1]
+    vm.sp = sp
+    return ins.next
+
+
+def _d_isub(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    stack[sp] = stack[sp] - stack[sp + 1]
+    vm.sp = sp
+    return ins.next
+
+
+def _d_imul(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    stack[sp] = stack[sp] * stack[sp + 1]
+    vm.sp = sp
+    return ins.next
+
+
+# int64 models: results out of range go through vm.int64
+
+
+def _d_iadd_int64(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    value = stack[sp] + stack[sp + 1]
+    if not INT64_MIN <= value <= INT64_MAX:
+        value = vm.int64(value)
+    stack[sp] = value
+    vm.sp = sp
+    return ins.next
+
+
+def _d_isub_int64(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    value = stack[sp] - stack[sp + 1]
+    if not INT64_MIN <= value <= INT64_MAX:
+        value = vm.int64(value)
+    stack[sp] = value
+    vm.sp = sp
+    return ins.next
+
+
+def _d_imul_int64(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    value = stack[sp] * stack[sp + 1]
+    if not INT64_MIN <= value <= INT64_MAX:
+        value = vm.int64(value)
+    stack[sp] = value
+    vm.sp = sp
+    return ins.next
+
+
+def _d_ilt(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    stack[sp] = TRUE if stack[sp] < stack[sp + 1] else FALSE
+    vm.sp = sp
+    return ins.next
+
+
+def _d_ieq(vm, ins):
+    stack = vm.stack
+    sp = vm.sp - 1
+    stack[sp] = TRUE if stack[sp] == stack[sp + 1] else FALSE
+    vm.sp = sp
+    return ins.next
+
+
+def _d_br(vm, ins):
+    return ins.op1
+
+
+def _d_brt(vm, ins):
+    value = vm.stack[vm.sp]
+    vm.sp -= 1
+    return ins.op1 if value == TRUE else ins.next
+
+
+def _d_brf(vm, ins):
+    value = vm.stack[vm.sp]
+    vm.sp -= 1
+    return ins.op1 if value == FALSE else ins.next
+
+
+def _d_iconst(vm, ins):
+    sp = vm.sp + 1
+    vm.stack[sp] = ins.op1
+    vm.sp = sp
+    return ins.next
+
+
+def _d_load(vm, ins):
+    stack = vm.stack
+    sp = vm.sp + 1
+    stack[sp] = stack[vm.fp + ins.op1]
+    vm.sp = sp
+    return ins.next
+
+
+def _d_gload(vm, ins):
+    sp = vm.sp + 1
+    vm.stack[sp] = vm.data[ins.op1]
+    vm.sp = sp
+    return ins.next
+
+
+def _d_store(vm, ins):
+    stack = vm.stack
+    stack[vm.fp + ins.op1] = stack[vm.sp]
+    vm.sp -= 1
+    return ins.next
+
+
+def _d_gstore(vm, ins):
+    vm.data[ins.op1] = vm.stack[vm.sp]
+    vm.sp -= 1
+    return ins.next
+
+
+def _d_gstore_tracked(vm, ins):
+    vm.data[ins.op1] = vm.stack[vm.sp]
+    vm.data_written[ins.op1] = 1
+    vm.sp -= 1
+    return ins.next
+
+
+def _d_puts(vm, ins):
+    vm._op_puts()
+    return ins.next
+
+
+def _d_pop(vm, ins):
+    vm.sp -= 1
+    return ins.next
+
+
+def _d_call(vm, ins):
+    stack = vm.stack
+    sp = vm.sp
+    stack[sp + 1] = ins.op2
+    stack[sp + 2] = vm.fp
+    stack[sp + 3] = ins.addr + 3
+    vm.sp = vm.fp = sp + 3
+    return ins.op1
+
+
+def _d_ret(vm, ins):
+    stack = vm.stack
+    rvalue = stack[vm.sp]
+    sp = vm.fp
+    ip = stack[sp]
+    vm.fp = stack[sp - 1]
+    sp -= 2 + stack[sp - 2]
+    stack[sp] = rvalue
+    vm.sp = sp
+    return vm.program.index_of(ip)
+
+
+def _d_tcall(vm, ins):
+    vm.ip = ins.addr + 3
+    vm.tail_call(vm.code[ins.addr + 1], ins.op2)
+    return ins.op1
+
+
+def _d_call_memo(vm, ins):
+    if vm.memo_call(vm.code[ins.addr + 1], ins.op2):
+        return ins.next
+    return _d_call(vm, ins)
+
+
+def _d_ret_memo(vm, ins):
+    vm.memo_return(vm.stack[vm.sp])
+    return _d_ret(vm, ins)
+
+
+def _d_bulk(vm, ins):
+    addr = ins.addr + 1
+    bulk.execute(vm, ins.bytecode, vm.code[addr:addr + ins.bytecode.operands_read])
+    return ins.next
+
+
+def _d_halt(vm, ins):
+    return None
+
+
+def _d_invalid(vm, ins):
+    raise InvalidBytecodeError("Invalid opcode {opcode} at ip = {ip}".
+                               format(opcode=vm.code[ins.addr], ip=ins.addr))
+
+
+def _build_decoded_handlers():
+    '''Map every integer opcode to its pre-decoded instruction handler.'''
+    handlers = {
+        IADD: _d_iadd, ISUB: _d_isub, IMUL: _d_imul,
+        ILT: _d_ilt, IEQ: _d_ieq,
+        BR: _d_br, BRT: _d_brt, BRF: _d_brf,
+        ICONST: _d_iconst, LOAD: _d_load, GLOAD: _d_gload,
+        STORE: _d_store, GSTORE: _d_gstore,
+        PUTS: _d_puts, POP: _d_pop,
+        CALL: _d_call, RET: _d_ret, HALT: _d_halt, TCALL: _d_tcall,
+        MEMSET: _d_bulk, MEMCPY: _d_bulk, VADD: _d_bulk, VMUL: _d_bulk, VSUM: _d_bulk,
+    }
+    table = [_d_invalid] * (max(Bytecode.opcodes) + 1)
+    for bytecode, handler in handlers.items():
+        table[bytecode.opcode] = handler
+    return table
+
+
+DECODED_HANDLERS = _build_decoded_handlers()
+
+TRACKED_DECODED_HANDLERS = list(DECODED_HANDLERS)
+TRACKED_DECODED_HANDLERS[GSTORE.opcode] = _d_gstore_tracked
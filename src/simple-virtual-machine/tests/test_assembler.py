@@ -0,0 +1,115 @@
+import os
+
+from simplevirtualmachine import assembler, binfile
+from simplevirtualmachine.assembler import assemble, disassemble, assemble_file, \
+    cache_path, AssemblyError
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import BR, ICONST, GLOAD, PUTS, POP, HALT
+
+LOOP = """
+; count to 13
+.globals n, i
+        ICONST 13
+        GSTORE n
+        ICONST 0
+        GSTORE i
+start:  GLOAD i             # while i < n
+        GLOAD n
+        ILT
+        BRF done
+        GLOAD i
+        ICONST 1
+        IADD
+        GSTORE i
+        BR start
+done:   GLOAD i
+        puts
+        HALT
+"""
+
+FACTORIAL = """
+.entry main
+fact:   LOAD -3
+        ICONST 2
+        ILT
+        BRF recurse
+        ICONST 1
+        RET
+recurse:
+        LOAD -3
+        LOAD -3
+        ICONST 1
+        ISUB
+        CALL fact, 1
+        IMUL
+        RET
+main:   ICONST 0x0a
+        CALL fact 1
+        PUTS
+        HALT
+"""
+
+
+def test_assemble_labels_and_globals():
+    program = assemble(LOOP)
+    assert program.code == loop_program(13)[:24] + (GLOAD, 1, PUTS, HALT)
+    assert program.globals == {'n': 0, 'i': 1}
+    assert program.labels == {'start': 8, 'done': 24}
+
+
+def test_assemble_entry_and_run(capsys):
+    program = assemble(FACTORIAL)
+    assert program.entry == 22
+    assert program.vm(engine='decoded').run() == HALT
+    out, err = capsys.readouterr()
+    assert out == "OUTPUT: 3628800\n"
+
+
+def test_assembler_errors():
+    for source, message in (("FOO 1", "unknown instruction"),
+                            ("ICONST", "takes 1 operand"),
+                            ("POP 1", "takes 0 operand"),
+                            ("BR nowhere", "undefined label"),
+                            ("x: HALT\nx: HALT", "duplicate label"),
+                            ("ICONST x", "bad operand")):
+        try:
+            assemble(source)
+        except AssemblyError as e:
+            assert message in str(e)
+        else:
+            assert False, source
+
+
+def test_disassemble_round_trips():
+    for code, entry in ((loop_program(7), 0), (call_program(7), 6),
+                        (assemble(FACTORIAL).code, 22),
+                        ((ICONST, 1, POP, 99, BR, 1, HALT), 0)):
+        program = assemble(disassemble(code, entry))
+        assert program.code == code
+        assert program.entry == entry
+
+
+def test_assemble_file_uses_cache(tmpdir, capsys, monkeypatch):
+    source = tmpdir.join("fact.svm")
+    source.write(FACTORIAL)
+    cached = cache_path(str(source), FACTORIAL.encode())
+
+    program = assemble_file(str(source))
+    assert isinstance(program, binfile.BinaryProgram)
+    assert os.path.exists(cached)
+    program.close()
+
+    # a cache hit must not assemble again
+    monkeypatch.setattr(assembler, 'assemble', None)
+    with assemble_file(str(source)) as program:
+        assert program.entry == 22
+        program.vm(engine='decoded').run()
+    out, err = capsys.readouterr()
+    assert out == "OUTPUT: 3628800\n"
+
+
+def test_assemble_file_falls_back_for_big_constants(tmpdir):
+    source = tmpdir.join("big.svm")
+    source.write("ICONST {}\nHALT\n".format(2 ** 70))
+    program = assemble_file(str(source))
+    assert program.code == (ICONST, 2 ** 70, HALT)
@@ -0,0 +1,171 @@
+import pytest
+
+from simplevirtualmachine.assembler import assemble
+from simplevirtualmachine.batch import run_batch, numpy
+from simplevirtualmachine.bench import loop_program
+from simplevirtualmachine.bytecodes import ICONST, GLOAD, GSTORE, ILT, BRF, BR, \
+    IADD, PUTS, HALT, CALL, BRT, VMUL, VSUM, InvalidBytecodeError
+from simplevirtualmachine.memory import MemoryOverflowError
+from simplevirtualmachine.vm import VM
+
+pytestmark = pytest.mark.skipif(numpy is None, reason="run_batch needs numpy")
+
+FACTORIAL = """
+.entry main
+fact:   LOAD -3
+        ICONST 2
+        ILT
+        BRF recurse
+        ICONST 1
+        RET
+recurse:
+        LOAD -3
+        LOAD -3
+        ICONST 1
+        ISUB
+        CALL fact, 1
+        IMUL
+        RET
+main:   CALL fact, 1
+        PUTS
+        HALT
+"""
+
+# data[1] = sum(range(data[0])), counting with data[2]
+SUM = (ICONST, 0, GSTORE, 1,
+       ICONST, 0, GSTORE, 2,
+       GLOAD, 2, GLOAD, 0, ILT, BRF, 32,
+       GLOAD, 1, GLOAD, 2, IADD, GSTORE, 1,
+       GLOAD, 2, ICONST, 1, IADD, GSTORE, 2,
+       BR, 8, HALT,
+       HALT)
+
+
+def factorial(n):
+    return 1 if n < 2 else n * factorial(n - 1)
+
+
+# tail-recursive factorial with an accumulator; lanes reach the base case apart
+TAIL_FACTORIAL = """
+.entry main
+fact:   LOAD -4
+        ICONST 2
+        ILT
+        BRF recurse
+        LOAD -3
+        RET
+recurse:
+        LOAD -4
+        ICONST 1
+        ISUB
+        LOAD -3
+        LOAD -4
+        IMUL
+        TCALL fact, 2
+        RET
+main:   ICONST 1
+        CALL fact, 2
+        PUTS
+        HALT
+"""
+
+
+def test_factorial_lanes():
+    program = assemble(FACTORIAL)
+    inputs = list(range(1, 16))
+    result = run_batch(program.code, [[n] for n in inputs],
+                       start_ip=program.entry, inputs_to='stack')
+    assert result.outputs == [[factorial(n)] for n in inputs]
+    assert not result.has_value.any()
+
+
+def test_tail_call_lanes():
+    program = assemble(TAIL_FACTORIAL)
+    inputs = list(range(1, 16))
+    result = run_batch(program.code, [[n] for n in inputs],
+                       start_ip=program.entry, inputs_to='stack', stack_size=16)
+    assert result.outputs == [[factorial(n)] for n in inputs]
+
+
+def test_divergent_trip_counts():
+    inputs = [0, 1, 5, 17, 3]
+    result = run_batch(SUM, inputs)
+    assert result.data[:, 1].tolist() == [sum(range(n)) for n in inputs]
+    assert result.data[:, 0].tolist() == inputs
+
+    for lane, n in enumerate(inputs):
+        vm = VM(*SUM)
+        vm.data[0] = n
+        vm.run()
+        assert result.steps[lane] == vm.steps
+    # lanes share sweeps while they agree, so fewer sweeps than total steps
+    assert result.sweeps < result.steps.sum()
+
+
+def test_matches_vm_on_loop():
+    code = loop_program(50)
+    result = run_batch(code, numpy.zeros((4, 0)))
+    vm = VM(*code)
+    vm.run()
+    assert result.data[:, 0].tolist() == [vm.data[0]] * 4
+    assert result.data[:, 1].tolist() == [vm.data[1]] * 4
+
+
+def test_values():
+    result = run_batch((GLOAD, 0, ICONST, 2, IADD, HALT), [[1], [2], [40]])
+    assert result.values.tolist() == [3, 4, 42]
+    assert result.has_value.all()
+
+
+def test_branches_on_non_boolean_values():
+    # BRT jumps only on TRUE and BRF only on FALSE, as in the VM
+    rows = [[0], [1], [2], [-1]]
+    for branch in (BRT, BRF):
+        code = (GLOAD, 0, branch, 9, ICONST, 1, PUTS, HALT, 0, ICONST, 0, PUTS, HALT)
+        result = run_batch(code, rows)
+        for lane, row in enumerate(rows):
+            vm = VM(*code, data_size=1, output=[])
+            vm.data[0] = row[0]
+            vm.run()
+            assert result.outputs[lane] == vm.output.values, (branch.name, row)
+
+
+def test_invalid_opcode():
+    try:
+        run_batch((ICONST, 1, 99), [[0]])
+    except InvalidBytecodeError:
+        pass
+    else:
+        assert False
+
+
+def test_stack_overflow():
+    recurse = (CALL, 0, 0, HALT)
+    try:
+        run_batch(recurse, [[0], [1]], stack_size=32)
+    except MemoryOverflowError:
+        pass
+    else:
+        assert False
+
+
+def test_inputs_to():
+    try:
+        run_batch((HALT,), [[0]], inputs_to='registers')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_bulk_instructions():
+    # data[4:8] = data[0:4] * data[0:4]; push sum(data[4:8]) + data[0]
+    code = (VMUL, 4, 0, 0, 4, VSUM, 4, 4, GLOAD, 0, IADD, PUTS, HALT)
+    rows = [[1, 2, 3, 4], [0, 0, 0, 5], [-1, 7, 2, 2]]
+    result = run_batch(code, rows)
+    for lane, row in enumerate(rows):
+        vm = VM(*code, data_size=8, output=[])
+        vm.data[:4] = row
+        vm.run()
+        assert result.outputs[lane] == vm.output.values
+        assert result.data[lane].tolist() == vm.data
@@ -0,0 +1,83 @@
+from simplevirtualmachine import bench
+from simplevirtualmachine.vm import VM
+
+
+def test_workloads_agree_across_engines():
+    for name, program, kwargs in bench.WORKLOADS:
+        code = program(25)
+        results = []
+        for engine in VM.ENGINES:
+            vm = VM(*code, engine=engine, **kwargs)
+            vm.run()
+            results.append((vm.sp, vm.data[0], vm.data[1]))
+        assert len(set(results)) == 1, name
+
+
+def test_bench_rows():
+    rows = bench.bench(iterations=5, repeat=1)
+    assert len(rows) == len(bench.WORKLOADS) * len(VM.ENGINES)
+    for name, engine, instructions, seconds, ips in rows:
+        assert instructions > 0 and ips > 0
+
+
+def test_corpus_agrees_across_engines():
+    from simplevirtualmachine.bench.corpus import corpus
+
+    workloads = corpus(scale=0.0001)
+    assert [w.name for w in workloads] == \
+        ['loop', 'factorial', 'fib', 'call', 'globals', 'output']
+    for workload in workloads:
+        results = []
+        for engine in VM.ENGINES:
+            output = []
+            vm = VM(*workload.code, start_ip=workload.start_ip, engine=engine, output=output,
+                    verify=True)
+            vm.run()
+            results.append((vm.steps, vm.written_data(), output))
+        assert all(result == results[0] for result in results), workload.name
+        if workload.name == 'fib':
+            assert results[0][1][0] == 6765
+
+
+def test_suite_results_and_baseline(tmpdir):
+    from simplevirtualmachine.bench import suite
+    from simplevirtualmachine.bench.corpus import corpus
+
+    workloads = corpus(scale=0.0001)[:2]
+    results = suite.run_suite(repeat=1, engines=('table', 'decoded'), workloads=workloads)
+    assert [(r.workload, r.engine) for r in results] == [
+        ('loop', 'table'), ('loop', 'decoded'), ('factorial', 'table'), ('factorial', 'decoded')]
+    for result in results:
+        assert result.instructions > 0 and result.ips > 0
+        assert result.construct_seconds > 0
+        if suite.PEAK_MEMORY is None:
+            assert result.peak_bytes is None
+        else:
+            assert result.peak_bytes >= 0
+
+    path = str(tmpdir.join("results.json"))
+    suite.save(results, path, scale=0.0001)
+    assert suite.load(path) == results
+    assert suite.compare(results, results) == []
+
+    slower = [result._replace(seconds=result.seconds * 2) for result in results]
+    regressions = suite.compare(slower, results, threshold=0.5)
+    assert [r.metric for r in regressions] == ['seconds'] * 4
+    assert abs(regressions[0].change - 1.0) < 1e-9
+    assert suite.compare(slower, results, threshold=1.5) == []
+    # a workload missing from the baseline is not compared
+    assert suite.compare(slower, results[:1]) == regressions[:1]
+    assert "REGRESSION loop table seconds" in suite.format_regressions(regressions)
+
+
+def test_peak_memory():
+    from simplevirtualmachine.bench import suite
+    from simplevirtualmachine.bench.corpus import Workload
+    from simplevirtualmachine.bytecodes import HALT
+
+    if suite.PEAK_MEMORY is None:
+        return
+    # VM(*code) copies the 16 MB of slot pointers
+    small = suite.peak_memory(Workload('small', (HALT,), 0, ""), 'table')
+    big = suite.peak_memory(Workload('big', (HALT,) * 2 ** 21, 0, ""), 'table')
+    assert big > 8 * 2 ** 20 > small
@@ -0,0 +1,80 @@
+import struct
+
+from simplevirtualmachine import binfile
+from simplevirtualmachine.bench import loop_program
+from simplevirtualmachine.binfile import dump, load, BinaryFormatError
+from simplevirtualmachine.bytecodes import ISUB, IMUL, ILT, BRF, \
+    ICONST, LOAD, PUTS, POP, CALL, RET, HALT
+
+FACTORIAL = (
+    LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+    LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+    ICONST, 15, CALL, 0, 1, PUTS, HALT,
+)
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join("fact.svmb"))
+    dump(FACTORIAL, path, entry=22)
+    with load(path) as program:
+        assert program.entry == 22
+        assert tuple(program.code) == FACTORIAL
+        assert program.code[3:5] == (2, ILT)
+
+
+def test_constants_are_pooled(tmpdir):
+    path = str(tmpdir.join("consts.svmb"))
+    dump((ICONST, 2 ** 40, ICONST, 2 ** 40, ICONST, 1, POP, HALT), path)
+    header = binfile.HEADER.unpack(open(path, 'rb').read(binfile.HEADER.size))
+    assert header[4:] == (2, 8)
+
+
+def test_run_from_mapping(tmpdir, capsys):
+    path = str(tmpdir.join("fact.svmb"))
+    dump(FACTORIAL, path, entry=22)
+    for engine in ('table', 'decoded'):
+        with load(path) as program:
+            assert program.vm(engine=engine).run() == HALT
+        out, err = capsys.readouterr()
+        assert out == "OUTPUT: 1307674368000\n"
+
+
+def test_loop_from_mapping(tmpdir):
+    path = str(tmpdir.join("loop.svmb"))
+    dump(loop_program(30), path)
+    with load(path) as program:
+        vm = program.vm(engine='decoded', fuse=True)
+        vm.run()
+        assert vm.data[1] == 30
+
+
+def test_rejects_invalid_opcode(tmpdir):
+    path = tmpdir.join("bad.svmb")
+    path.write_binary(binfile.HEADER.pack(binfile.MAGIC, binfile.VERSION, 0, 0, 0, 1) +
+                      struct.pack('<i', 99))
+    try:
+        load(str(path))
+    except BinaryFormatError as e:
+        assert "invalid opcode 99" in str(e)
+    else:
+        assert False, "unknown opcode should be rejected at load time"
+
+
+def test_rejects_bad_magic_and_entry(tmpdir):
+    path = tmpdir.join("magic.svmb")
+    path.write_binary(b"NOPE" + b"\0" * 16)
+    try:
+        load(str(path))
+    except BinaryFormatError:
+        pass
+    else:
+        assert False, "bad magic should be rejected"
+
+    path = str(tmpdir.join("entry.svmb"))
+    dump((ICONST, 1, HALT), path, entry=1)
+    try:
+        load(path)
+    except BinaryFormatError as e:
+        assert "entry 1" in str(e)
+    else:
+        assert False, "entry inside an instruction should be rejected"
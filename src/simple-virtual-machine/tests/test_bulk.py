@@ -0,0 +1,141 @@
+from simplevirtualmachine import memory
+from simplevirtualmachine.assembler import assemble, disassemble
+from simplevirtualmachine.bytecodes import IADD, ICONST, GSTORE, PUTS, HALT, CALL, RET, \
+    LOAD, MEMSET, MEMCPY, VADD, VMUL, VSUM
+from simplevirtualmachine.integers import IntegerOverflowError, wrap
+from simplevirtualmachine.memo import pure_functions
+from simplevirtualmachine.memory import MemoryOverflowError
+from simplevirtualmachine.verifier import verify, VerifyError
+from simplevirtualmachine.vm import VM
+
+VECTORS = (ICONST, 2, MEMSET, 0, 4,             # data[0:4] = 2
+           ICONST, 5, GSTORE, 1,                # data[1] = 5
+           MEMCPY, 4, 0, 4,                     # data[4:8] = data[0:4]
+           VADD, 8, 0, 4, 4,                    # data[8:12] = data[0:4] + data[4:8]
+           VMUL, 12, 4, 8, 4,                   # data[12:16] = data[4:8] * data[8:12]
+           VSUM, 8, 8,                          # push sum(data[8:16])
+           PUTS, HALT)
+
+SETTINGS = ({'engine': 'switch'},
+            {'engine': 'table'},
+            {'engine': 'table', 'memory': 'array'},
+            {'engine': 'decoded', 'memory': 'array', 'fuse': True},
+            {'engine': 'decoded', 'verify': True},
+            {'engine': 'compiled'},
+            {'engine': 'compiled', 'memory': 'array', 'integers': 'trap'},
+            {'engine': 'decoded', 'optimize': 2})
+
+
+def test_vector_program():
+    for kwargs in SETTINGS:
+        vm = VM(*VECTORS, output=[], data_size=16, **kwargs)
+        vm.run()
+        assert vm.output.values == [96], kwargs
+        assert [vm.written_data()[addr] for addr in range(16)] == \
+            [2, 5, 2, 2, 2, 5, 2, 2, 4, 10, 4, 4, 8, 50, 8, 8], kwargs
+        assert vm.steps == 9, kwargs
+
+
+def test_overlapping_ranges():
+    for kwargs in SETTINGS[:6]:
+        vm = VM(MEMCPY, 1, 0, 5, VADD, 0, 0, 1, 5, HALT, output=[], **kwargs)
+        if vm.data_written is not None:
+            memory.grow(vm.data, 5, vm.data_size, "data", vm.data_written)
+        for addr in range(6):
+            vm.data[addr] = addr + 1
+            if vm.data_written is not None:
+                vm.data_written[addr] = 1
+        vm.run()
+        assert list(vm.data[:6]) == [2, 3, 5, 7, 9, 5], kwargs
+
+
+def test_large_ranges():
+    # long enough for NumPy on array memory; the squares need 67 bits
+    n = 200
+    code = (ICONST, 3, MEMSET, 0, n, ICONST, 2 ** 31, MEMSET, n, n,
+            VMUL, 2 * n, 0, n, n, VSUM, 2 * n, n, PUTS,
+            VMUL, 3 * n, 2 * n, 2 * n, n, VSUM, 3 * n, n, PUTS, HALT)
+    square = (3 * 2 ** 31) ** 2
+    for kind in ('list', 'array'):
+        vm = VM(*code, engine='decoded', memory=kind, integers='wrap', output=[])
+        vm.run()
+        assert vm.output.values == [n * 3 * 2 ** 31, wrap(n * wrap(square))], kind
+        assert vm.data[3 * n] == wrap(square)
+
+        vm = VM(*code, engine='decoded', memory=kind, integers='trap', output=[])
+        result = vm.run(max_steps=100)
+        assert isinstance(result.error, IntegerOverflowError), kind
+        assert vm.ip == 19 and vm.output.values == [n * 3 * 2 ** 31]
+
+    vm = VM(*code, engine='decoded', output=[])
+    vm.run()
+    assert vm.output.values[1] == n * square
+    result = VM(*code, engine='decoded', memory='array').run(max_steps=100)
+    assert isinstance(result.error, OverflowError)
+
+
+def test_out_of_range():
+    try:
+        VM(ICONST, 1, MEMSET, 8, 4, HALT, data_size=10, output=[]).run()
+    except IndexError:
+        pass
+    else:
+        assert False, "MEMSET past the end of list memory should fail"
+
+    vm = VM(VSUM, 0, 100, PUTS, HALT, engine='decoded', memory='array', data_size=100,
+            output=[])
+    vm.run()
+    assert vm.output.values == [0] and len(vm.data) == 100
+    try:
+        VM(VSUM, 50, 51, HALT, engine='table', memory='array', data_size=100).run()
+    except MemoryOverflowError:
+        pass
+    else:
+        assert False, "VSUM past data_size should fail"
+
+
+def test_verifier():
+    assert verify(VECTORS).data_cells == 16
+    for code in ((MEMCPY, 0, 8, 10, HALT), (VSUM, -1, 2, PUTS, HALT),
+                 (ICONST, 1, MEMSET, 0, -1, HALT)):
+        try:
+            verify(code, data_size=16)
+        except VerifyError:
+            pass
+        else:
+            assert False, "{} should fail verification".format(code)
+    try:
+        verify((ICONST, 0, PUTS, MEMCPY, 0, 8, 10, HALT), data_size=16)
+    except VerifyError as e:
+        assert "10 cell(s) at 8 " in str(e)
+    else:
+        assert False, "MEMCPY past data_size should fail verification"
+
+
+def test_functions_using_data_are_impure():
+    # def f(n): return n + sum(data[0:4])
+    code = (LOAD, -3, VSUM, 0, 4, IADD, RET,
+            ICONST, 1, CALL, 0, 1, PUTS, HALT)
+    assert pure_functions(code, entry=7) == frozenset()
+
+
+def test_assembler():
+    program = assemble("""
+        .globals xs, ys, sum
+        ICONST 7
+        MEMSET xs, 1
+        MEMCPY ys, xs, 1
+        VADD sum, xs, ys, 1
+        vmul sum, sum, sum, 1
+        VSUM sum, 1
+        PUTS
+        HALT
+    """)
+    assert program.code[:5] == (ICONST, 7, MEMSET, 0, 1)
+    assert program.code[14:19] == (VMUL, 2, 2, 2, 1)
+    assert assemble(disassemble(program.code)).code == program.code
+    vm = program.vm(output=[])
+    vm.run()
+    assert vm.output.values == [196]
+
+    assert vm.display_instruction(9).split() == ['0009:', 'VADD', '(4)', '2,', '0,', '1,', '1']
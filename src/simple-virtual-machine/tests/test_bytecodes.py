@@ -79,3 +79,10 @@ def test_halt():
     assert HALT.opcode == 18 and HALT.operand_count == 0 and HALT.name == "HALT"
     
     
+def test_pickle_keeps_identity():
+    import pickle
+
+    code = (ICONST, 1, PUTS, HALT)
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        copy = pickle.loads(pickle.dumps(code, protocol))
+        assert copy[0] is ICONST and copy[2] is PUTS and copy[3] is HALT
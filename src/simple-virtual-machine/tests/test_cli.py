@@ -0,0 +1,84 @@
+import subprocess
+import sys
+
+from simplevirtualmachine import main
+from simplevirtualmachine.binfile import dump
+from simplevirtualmachine.bench import loop_program
+
+PROGRAM = """
+.globals n
+        ICONST 6
+        ICONST 7
+        IMUL
+        PUTS
+        HALT
+"""
+
+
+def test_import_does_not_configure_logging():
+    handlers = subprocess.check_output([
+        sys.executable, '-c',
+        'import logging, simplevirtualmachine, simplevirtualmachine.vm; '
+        'print(len(logging.getLogger().handlers))'])
+    assert handlers.strip() == b'0'
+
+
+def test_run_assembly(tmpdir, capsys):
+    source = tmpdir.join("prog.svm")
+    source.write(PROGRAM)
+    for engine in ('switch', 'table', 'decoded'):
+        assert main(['run', str(source), '--engine', engine]) == 0
+        out, err = capsys.readouterr()
+        assert out == "OUTPUT: 42\n"
+
+
+def test_run_binary_with_profile(tmpdir, capsys):
+    path = str(tmpdir.join("loop.svmb"))
+    dump(loop_program(10), path)
+    main(['run', path, '--profile'])
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0].split() == ['OPCODE', 'COUNT', 'SECONDS', '%']
+    opcodes = lines[1:lines.index('')]
+    counts = dict((line.split()[0], int(line.split()[1])) for line in opcodes)
+    assert counts['ILT'] == 11 and counts['BR'] == 10
+    assert any(line.startswith('main ') for line in lines)
+
+
+def test_profile_folded(tmpdir, capsys):
+    path = str(tmpdir.join("loop.svmb"))
+    folded = tmpdir.join("loop.folded")
+    dump(loop_program(10), path)
+    main(['run', path, '--profile', '--folded', str(folded)])
+    assert folded.read() == "main 98\n"
+
+
+def test_bench(tmpdir, capsys):
+    source = tmpdir.join("prog.svm")
+    source.write(PROGRAM)
+    main(['run', str(source), '--bench', '5', '--memory', 'array'])
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0] == "5 runs, 4 instructions per run"
+    assert [line.split()[0] for line in lines[1:]] == ['min', 'median', 'p99']
+
+
+def test_bench_suite(tmpdir, capsys):
+    from simplevirtualmachine.bench import suite
+
+    path = str(tmpdir.join("bench.json"))
+    args = ['bench', '--scale', '0.0001', '--repeat', '1', '--engines', 'decoded']
+    assert main(args + ['--json', path]) == 0
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0].split()[:3] == ['WORKLOAD', 'ENGINE', 'INSTR']
+    assert [line.split()[0] for line in lines[1:-1]] == \
+        ['loop', 'factorial', 'fib', 'call', 'globals', 'output']
+    assert lines[-1] == suite.describe_peak_memory()
+
+    # a baseline a hundred times faster
+    faster = [result._replace(seconds=result.seconds / 100) for result in suite.load(path)]
+    suite.save(faster, path)
+    assert main(args + ['--baseline', path]) == 1
+    out, err = capsys.readouterr()
+    assert "REGRESSION loop decoded seconds" in out
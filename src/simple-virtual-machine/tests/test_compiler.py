@@ -0,0 +1,115 @@
+from simplevirtualmachine import compiler
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import INVALID, IADD, ISUB, IMUL, IEQ, ILT, \
+    BRT, BRF, ICONST, LOAD, STORE, PUTS, POP, CALL, RET, HALT, MEMSET, VSUM, \
+    InvalidBytecodeError
+from simplevirtualmachine.compiler import block_source, compiled_program, cache_info, \
+    clear_cache
+from simplevirtualmachine.vm import VM
+
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+             ICONST, 20, CALL, 0, 1, PUTS, HALT)
+
+# f(a, b) keeps a local at fp + 1: returns a * b + (a == b), then prints it
+LOCALS = (ICONST, 0, LOAD, -4, LOAD, -3, IMUL, STORE, 1,
+          LOAD, -4, LOAD, -3, IEQ, LOAD, 1, IADD, RET,
+          ICONST, 6, ICONST, 7, CALL, 0, 2, PUTS,
+          ICONST, 5, ICONST, 5, CALL, 0, 2, PUTS,
+          ICONST, 1, BRT, 43, ICONST, 99, PUTS, POP, 0, ICONST, 3, HALT)
+
+PROGRAMS = [
+    (loop_program(100), {}),
+    (call_program(50), {'start_ip': 6}),
+    (FACTORIAL, {'start_ip': 22}),
+    (LOCALS, {'start_ip': 18}),
+]
+
+
+def run(code, **kwargs):
+    values = []
+    vm = VM(*code, output=values, **kwargs)
+    vm.run()
+    return vm, values
+
+
+def test_matches_reference():
+    for code, kwargs in PROGRAMS:
+        reference, expected = run(code, **kwargs)
+        for memory in ('list', 'array'):
+            vm, values = run(code, engine='compiled', memory=memory, **kwargs)
+            assert values == expected
+            assert vm.written_data() == reference.written_data()
+            assert (vm.ip, vm.sp, vm.fp, vm.steps) == \
+                (reference.ip, reference.sp, reference.fp, reference.steps)
+            assert list(vm.stack[:vm.sp + 1]) == reference.stack[:reference.sp + 1]
+
+
+def test_big_integers():
+    vm, values = run(FACTORIAL[:23] + (100,) + FACTORIAL[24:], engine='compiled', start_ip=22)
+    reference, expected = run(FACTORIAL[:23] + (100,) + FACTORIAL[24:], start_ip=22)
+    assert values == expected
+    assert values[0] > 2 ** 64
+
+
+def test_array_cells_overflow():
+    # values too big for a 64-bit cell, printed before anything stores them
+    big = 2 ** 62
+    for code in ((ICONST, big, ICONST, big, IADD, ICONST, big, IADD, PUTS, HALT),
+                 (ICONST, big, MEMSET, 0, 4, VSUM, 0, 4, PUTS, HALT),
+                 (ICONST, 2 ** 64, PUTS, HALT)):
+        assert run(code)[1][0] > 2 ** 63
+        for kwargs in ({'engine': 'table'}, {'engine': 'decoded', 'fuse': True},
+                       {'engine': 'compiled'}):
+            try:
+                run(code, memory='array', **kwargs)
+            except OverflowError:
+                pass
+            else:
+                assert False, "{} should overflow an array cell".format(kwargs)
+
+
+def test_stack_kept_in_locals():
+    source = block_source(loop_program(10), 8)
+    assert "stack" not in source
+    assert "return 24 if t2 == 0 else 15" in source
+
+
+def test_invalid_opcode():
+    vm = VM(ICONST, 1, INVALID, engine='compiled')
+    try:
+        vm.run()
+    except InvalidBytecodeError as e:
+        assert "ip = 2" in str(e)
+        assert vm.ip == 2 and vm.sp == 0
+    else:
+        assert False, "INVALID should raise"
+
+
+def test_budget_is_exact():
+    code, kwargs = PROGRAMS[2]
+    reference, expected = run(code, **kwargs)
+    vm = VM(*code, engine='compiled', output=[], **kwargs)
+    assert list(vm.run_iter(quantum=7)) == list(range(7, reference.steps, 7))
+    assert vm.steps == reference.steps
+
+
+def test_tracer_falls_back():
+    vm = VM(*loop_program(3), engine='compiled', trace=100)
+    vm.run()
+    assert len(vm.tracer.lines()) == vm.steps
+
+
+def test_cache():
+    clear_cache()
+    code = loop_program(5)
+    first = compiled_program(code)
+    assert compiled_program(list(code)) is first
+    assert compiled_program(code, tracked=True) is not first
+    assert cache_info()[:3] == (1, 2, 2)
+
+    for n in range(compiler.CACHE_SIZE):
+        compiled_program(loop_program(1000 + n))
+    assert cache_info().size == compiler.CACHE_SIZE
+    assert compiled_program(code) is not first
+    clear_cache()
@@ -0,0 +1,55 @@
+from simplevirtualmachine.bytecodes import ICONST, GSTORE, HALT
+from simplevirtualmachine.config import VMConfig, DEFAULT_CONFIG, DEFAULT_STACK_SIZE
+from simplevirtualmachine.vm import VM
+
+
+def test_config_is_immutable():
+    config = VMConfig()
+    try:
+        config.stack_size = 5
+    except AttributeError:
+        pass
+    else:
+        assert False, "VMConfig fields should be read-only"
+
+
+def test_stack_size_does_not_leak_between_vms():
+    small = VM(HALT, stack_size=16)
+    default = VM(HALT)
+    assert len(small.stack) == 16 and len(small.data) == 16
+    assert len(default.stack) == DEFAULT_STACK_SIZE
+    assert VM.DEFAULT_STACK_SIZE == DEFAULT_STACK_SIZE
+
+
+def test_shared_config():
+    config = VMConfig(stack_size=32, data_size=8, engine='decoded', memory='array')
+    vms = [VM(ICONST, n, GSTORE, 0, HALT, config=config) for n in range(3)]
+    for vm in vms:
+        vm.run()
+        assert vm.config is config
+    assert [vm.data[0] for vm in vms] == [0, 1, 2]
+
+
+def test_keyword_overrides_config():
+    config = VMConfig(stack_size=32, engine='table')
+    vm = VM(HALT, config=config, start_ip=0, engine='decoded')
+    assert vm.engine == 'decoded' and vm.stack_size == 32
+    assert config.engine == 'table'
+
+
+def test_unknown_setting():
+    try:
+        VM(HALT, stack_sise=10)
+    except TypeError:
+        pass
+    else:
+        assert False, "misspelt settings should be rejected"
+
+
+def test_invalid_combination():
+    try:
+        DEFAULT_CONFIG.replace(memory='array')
+    except ValueError:
+        pass
+    else:
+        assert False, "array memory needs a table or decoded engine"
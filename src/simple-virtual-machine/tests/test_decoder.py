@@ -0,0 +1,71 @@
+from simplevirtualmachine.bytecodes import INVALID, IADD, ISUB, IMUL, \
+    ILT, ICONST, LOAD, GLOAD, GSTORE, PUTS, POP, CALL, RET, HALT, BR, BRF
+from simplevirtualmachine.decoder import decode, DecodeError
+from simplevirtualmachine.vm import VM, DECODED_HANDLERS
+
+FACTORIAL = (
+    LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+    LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+    ICONST, 10, CALL, 0, 1, PUTS, HALT,
+)
+
+
+def test_decode_remaps_branch_targets():
+    program = decode(FACTORIAL, DECODED_HANDLERS)
+    brf = program.instructions[3]
+    assert brf.bytecode == BRF and program.instructions[brf.op1].addr == 10
+    call = program.instructions[program.index[17]]
+    assert call.bytecode == CALL and call.op1 == 0 and call.op2 == 1
+
+
+def test_decode_pop_reads_no_operand():
+    program = decode((ICONST, 1, POP, HALT), DECODED_HANDLERS)
+    assert [i.bytecode for i in program.instructions] == [ICONST, POP, HALT]
+
+
+def test_decode_rejects_jump_into_instruction():
+    try:
+        decode((ICONST, 1, BR, 1, HALT), DECODED_HANDLERS)
+    except DecodeError as e:
+        assert "target 1" in str(e)
+    else:
+        assert False, "jump into an operand should be rejected"
+
+
+def test_decode_rejects_missing_operands():
+    try:
+        decode((ICONST,), DECODED_HANDLERS)
+    except DecodeError:
+        pass
+    else:
+        assert False, "truncated instruction should be rejected"
+
+
+def test_decoded_engine_factorial(capsys):
+    vm = VM(*FACTORIAL, start_ip=22, engine='decoded')
+    assert vm.run() == HALT
+    out, err = capsys.readouterr()
+    assert out == "OUTPUT: 3628800\n"
+    assert vm.ip == 28 and vm.sp == -1
+
+
+def test_decoded_engine_matches_table_engine():
+    code = (ICONST, 5, GSTORE, 0, GLOAD, 0, ICONST, 3, IADD, GSTORE, 1, HALT)
+    states = []
+    for engine in ('table', 'decoded'):
+        vm = VM(*code, engine=engine)
+        vm.run()
+        states.append((vm.ip, vm.sp, vm.steps, vm.data[:2]))
+    assert states[0] == states[1]
+
+
+def test_decoded_engine_invalid_at_runtime():
+    vm = VM(ICONST, 1, INVALID, HALT, engine='decoded')
+    try:
+        vm.run()
+    except DecodeError:
+        assert False, "INVALID should only fail when executed"
+    except Exception as e:
+        assert "ip = 2" in str(e)
+    else:
+        assert False, "INVALID should raise"
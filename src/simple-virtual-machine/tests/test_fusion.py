@@ -0,0 +1,63 @@
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BRF, BR, \
+    ICONST, LOAD, GSTORE, PUTS, CALL, RET, HALT
+from simplevirtualmachine.decoder import decode
+from simplevirtualmachine.fusion import fuse, report
+from simplevirtualmachine.vm import VM, DECODED_HANDLERS
+
+FACTORIAL = (
+    LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+    LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+    ICONST, 12, CALL, 0, 1, PUTS, HALT,
+)
+
+
+def test_fuse_loop_program():
+    program = fuse(decode(loop_program(10), DECODED_HANDLERS))
+    assert program.fusions == {'GLOAD_GLOAD_CMP_BRANCH': 1, 'GLOAD_ICONST_OP_GSTORE': 1}
+    # BR 8 now targets the fused compare-and-branch record
+    br = program.instructions[program.index[22]]
+    assert br.bytecode is BR and program.instructions[br.op1].addr == 8
+
+
+def test_fuse_keeps_branch_targets_as_boundaries():
+    # BR 2 lands on the IADD, so ICONST; IADD must not be fused
+    code = (ICONST, 1, ICONST, 2, IADD, GSTORE, 0, HALT)
+    assert fuse(decode(code, DECODED_HANDLERS)).fusions == {'ICONST_OP': 1}
+    code = (ICONST, 1, ICONST, 2, IADD, GSTORE, 0, BR, 4, HALT)
+    assert fuse(decode(code, DECODED_HANDLERS)).fusions == {}
+
+
+def test_fused_factorial_matches(capsys):
+    for memory in ('list', 'array'):
+        vm = VM(*FACTORIAL, start_ip=22, engine='decoded', fuse=True, memory=memory)
+        assert vm.run() == HALT
+        out, err = capsys.readouterr()
+        assert out == "OUTPUT: 479001600\n"
+        assert vm.program.fusions == {'LOAD_ICONST_CMP_BRANCH': 1, 'ICONST_OP': 1}
+
+
+def test_fused_loop_matches_plain():
+    for memory in ('list', 'array'):
+        states = []
+        for fused in (False, True):
+            vm = VM(*loop_program(50), engine='decoded', fuse=fused, memory=memory)
+            vm.run()
+            states.append((vm.ip, vm.sp, vm.data[0], vm.data[1]))
+        assert states[0] == states[1]
+
+
+def test_report():
+    result = report(call_program(100), start_ip=6)
+    assert result['fusions'] == {'CMP_BRANCH': 1, 'ICONST_OP': 1}
+    assert result['dispatches'] < result['instructions']
+    assert 0.0 < result['reduction'] < 1.0
+
+
+def test_fuse_needs_decoded_engine():
+    try:
+        VM(HALT, engine='table', fuse=True)
+    except ValueError:
+        pass
+    else:
+        assert False, "fusion only exists for the decoded engine"
@@ -0,0 +1,108 @@
+from simplevirtualmachine import snapshot
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BR, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, CALL, RET, HALT, TRUE
+from simplevirtualmachine.config import VMConfig
+from simplevirtualmachine.integers import INT64_MIN, INT64_MAX, IntegerOverflowError, \
+    check_constants, wrap
+from simplevirtualmachine.optimizer import optimize
+from simplevirtualmachine.vm import VM
+
+# factorial(25) overflows int64
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+             ICONST, 25, CALL, 0, 1, PUTS, HALT)
+
+# x = 1; for i in range(70): x = x * 3; print x
+POWER = (ICONST, 1, GSTORE, 0, ICONST, 0, GSTORE, 1,
+         GLOAD, 1, ICONST, 70, ILT, BRF, 31,                   # 8
+         GLOAD, 0, ICONST, 3, IMUL, GSTORE, 0,                 # 15
+         GLOAD, 1, ICONST, 1, IADD, GSTORE, 1, BR, 8,          # 22
+         GLOAD, 0, PUTS, HALT)                                 # 31
+
+SETTINGS = ({'engine': 'switch'},
+            {'engine': 'table', 'memory': 'array'},
+            {'engine': 'decoded'},
+            {'engine': 'decoded', 'memory': 'array', 'fuse': True},
+            {'engine': 'compiled', 'memory': 'array'},
+            {'engine': 'decoded', 'optimize': 2, 'memoize': 10})
+
+
+def factorial(n):
+    return 1 if n < 2 else n * factorial(n - 1)
+
+
+def run(code, start_ip, **kwargs):
+    vm = VM(*code, start_ip=start_ip, output=[], **kwargs)
+    vm.run()
+    return vm.output.values
+
+
+def test_models():
+    for code, start_ip, exact in ((FACTORIAL, 22, factorial(25)), (POWER, 0, 3 ** 70)):
+        assert exact > INT64_MAX
+        for kwargs in SETTINGS:
+            if 'memory' not in kwargs:
+                assert run(code, start_ip, **kwargs) == [exact], kwargs
+            assert run(code, start_ip, integers='wrap', **kwargs) == [wrap(exact)], kwargs
+            try:
+                run(code, start_ip, integers='trap', **kwargs)
+            except IntegerOverflowError:
+                pass
+            else:
+                assert False, "{} should trap".format(kwargs)
+
+
+def test_wrap_compares_in_range():
+    # INT64_MAX + 1 wraps to INT64_MIN, which is less than 0
+    code = (ICONST, INT64_MAX, ICONST, 1, IADD, ICONST, 0, ILT, PUTS, HALT)
+    for kwargs in SETTINGS:
+        assert run(code, 0, integers='wrap', **kwargs) == [TRUE], kwargs
+        if 'memory' not in kwargs:
+            assert run(code, 0, **kwargs) != [TRUE], kwargs
+
+
+def test_trap_at_run_time():
+    vm = VM(ICONST, INT64_MIN, ICONST, 1, ISUB, HALT, integers='trap', engine='decoded')
+    result = vm.run(max_steps=10)
+    assert result.status == 'error'
+    assert isinstance(result.error, IntegerOverflowError)
+    # stopped on the ISUB with its operands on the stack
+    assert vm.ip == 4 and vm.sp == 1
+
+
+def test_constants_must_fit():
+    for model in ('wrap', 'trap'):
+        try:
+            VM(ICONST, INT64_MAX + 1, PUTS, HALT, integers=model)
+        except IntegerOverflowError:
+            pass
+        else:
+            assert False, "ICONST 2**63 does not fit in 64 bits"
+    check_constants((ICONST, INT64_MIN, PUTS, HALT))
+    VM(ICONST, INT64_MAX + 1, PUTS, HALT)
+
+
+def test_constant_folding():
+    code = (ICONST, INT64_MAX, ICONST, 1, IADD, PUTS, HALT)
+    assert optimize(code).code[1] == INT64_MAX + 1
+    assert optimize(code, integers='wrap').code[1] == INT64_MIN
+    # left for run time to trap
+    assert optimize(code, integers='trap').code == code
+
+
+def test_settings():
+    try:
+        VMConfig(integers='int32')
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown integer models should be rejected"
+
+    vm = VM(*POWER, integers='wrap', output=[])
+    assert vm.integers == 'wrap'
+    state = vm.snapshot()
+    assert state.settings['integers'] == 'wrap'
+    copy = VM.from_snapshot(state, output=[])
+    copy.run()
+    assert copy.output.values == [wrap(3 ** 70)]
+    assert snapshot.SETTINGS[-1] == 'integers'
@@ -0,0 +1,161 @@
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, CALL, RET, HALT, TCALL
+from simplevirtualmachine.compiler import block_source
+from simplevirtualmachine.memo import MemoCache, make_cache, pure_functions
+from simplevirtualmachine.vm import VM
+
+# def FIB(n): if n < 2: return n; return FIB(n - 1) + FIB(n - 2)
+FIB = (LOAD, -3, ICONST, 2, ILT, BRF, 10, LOAD, -3, RET,    # 0
+       LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1,                 # 10
+       LOAD, -3, ICONST, 2, ISUB, CALL, 0, 1,                 # 18
+       IADD, RET,                                             # 26
+       ICONST, 20, CALL, 0, 1, PUTS, HALT)                    # 28
+
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+             ICONST, 10, CALL, 0, 1, PUTS, ICONST, 12, CALL, 0, 1, PUTS, HALT)
+
+# SCALE(n) reads a global, COUNT(n) writes one, TWICE(n) calls SCALE
+IMPURE = (LOAD, -3, GLOAD, 0, IMUL, RET,                     # 0 SCALE
+          LOAD, -3, GSTORE, 1, ICONST, 0, RET,                # 6 COUNT
+          LOAD, -3, CALL, 0, 1, ICONST, 2, IMUL, RET,         # 13 TWICE
+          ICONST, 3, GSTORE, 0,                               # 22
+          ICONST, 5, CALL, 13, 1, PUTS,                       # 26
+          ICONST, 4, GSTORE, 0,                               # 32
+          ICONST, 5, CALL, 13, 1, PUTS,                       # 36
+          ICONST, 7, CALL, 6, 1, PUTS, HALT)                  # 42
+
+
+def run(code, **kwargs):
+    output = []
+    vm = VM.from_code(code, output=output, **kwargs)
+    vm.run()
+    return vm, output
+
+
+def test_pure_functions():
+    assert pure_functions(FIB, entry=28) == frozenset([0])
+    assert pure_functions(FACTORIAL, entry=22) == frozenset([0])
+    assert pure_functions(call_program(3), entry=6) == frozenset([0])
+    assert pure_functions(IMPURE, entry=22) == frozenset()
+    # no CALLs, and code the verifier rejects, have none
+    assert pure_functions(loop_program(3)) == frozenset()
+    assert pure_functions((ICONST, 1, CALL, 7, 1, PUTS, HALT, GLOAD, 0)) == frozenset()
+
+
+def test_fib_every_engine():
+    plain, expected = run(FIB, start_ip=28)
+    assert expected == [6765]
+    for engine in VM.ENGINES:
+        vm, output = run(FIB, start_ip=28, engine=engine, memoize=100)
+        assert output == expected, engine
+        assert (vm.memo.hits, vm.memo.misses) == (18, 21), engine
+        assert vm.steps < plain.steps / 50, engine
+        assert vm.memo_frames == []
+
+
+def test_array_memory_and_fusion():
+    for kwargs in ({'engine': 'table', 'memory': 'array'},
+                   {'engine': 'decoded', 'memory': 'array', 'fuse': True},
+                   {'engine': 'compiled', 'memory': 'array'}):
+        vm, output = run(FACTORIAL, start_ip=22, memoize=True, **kwargs)
+        assert output == [3628800, 479001600], kwargs
+        # 12! reuses 10!
+        assert vm.memo.hits == 1, kwargs
+
+
+def test_impure_functions_run_every_time():
+    expected = run(IMPURE, start_ip=22)[1]
+    assert expected == [30, 40, 0]
+    for engine in VM.ENGINES:
+        vm, output = run(IMPURE, start_ip=22, engine=engine, memoize=10)
+        assert output == expected, engine
+        assert vm.memo.info().misses == 0
+        assert vm.written_data() == {0: 4, 1: 7}
+
+
+def test_tail_call_results_are_cached():
+    # SUM(n, acc) returns acc + n + ... + 1 through TCALLs
+    code = (LOAD, -4, ICONST, 1, ILT, BRF, 10, LOAD, -3, RET,
+            LOAD, -4, ICONST, 1, ISUB, LOAD, -3, LOAD, -4, IADD,
+            TCALL, 0, 2, RET,
+            ICONST, 100, ICONST, 0, CALL, 0, 2, PUTS,
+            ICONST, 100, ICONST, 0, CALL, 0, 2, PUTS, HALT)
+    for engine in VM.ENGINES:
+        vm, output = run(code, start_ip=24, engine=engine, memoize=10)
+        assert output == [5050, 5050], engine
+        assert vm.memo.info()[:2] == (1, 1), engine
+        assert vm.memo.entries == {(0, (100, 0)): 5050}
+
+
+def test_budgeted_runs():
+    expected = run(FIB, start_ip=28, memoize=100)[0].steps
+    for engine in VM.ENGINES:
+        vm = VM(*FIB, start_ip=28, engine=engine, memoize=100, output='null')
+        quanta = list(vm.run_iter(7))
+        assert vm.steps == expected, engine
+        assert len(quanta) == (expected - 1) // 7, engine
+
+
+def test_shared_cache():
+    cache = MemoCache(100)
+    run(FIB, start_ip=28, memoize=cache)
+    vm, output = run(FIB, start_ip=28, memoize=cache)
+    assert output == [6765]
+    # the second run is ICONST, one CALL answered from the cache, PUTS
+    assert vm.steps == 3
+    assert cache.info() == (19, 21, 0, 21, 100)
+
+
+def test_eviction():
+    lru = MemoCache(2)
+    fifo = MemoCache(2, policy='fifo')
+    for cache in (lru, fifo):
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+    assert list(lru.entries) == ['a', 'c']
+    assert list(fifo.entries) == ['b', 'c']
+    assert lru.get('b', 'missing') == 'missing'
+    assert lru.info() == (1, 1, 1, 2, 2)
+    lru.clear()
+    assert lru.info() == (0, 0, 0, 0, 2)
+
+    # a tiny cache still gives the right answers
+    vm, output = run(FIB, start_ip=28, memoize=1)
+    assert output == [6765]
+    assert vm.memo.evictions > 0
+
+
+def test_settings():
+    assert make_cache(None) is None
+    assert make_cache(0) is None
+    assert make_cache(True).maxsize == 1024
+    assert make_cache(5).maxsize == 5
+    for bad in ('lru', 1.5):
+        try:
+            make_cache(bad)
+        except ValueError:
+            pass
+        else:
+            assert False, "{!r} should be rejected".format(bad)
+    try:
+        MemoCache(10, policy='random')
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown policy should be rejected"
+
+    # an int gives every VM its own cache
+    first = VM(*FIB, start_ip=28, memoize=10)
+    second = VM(*FIB, start_ip=28, config=first.config)
+    assert first.memo is not second.memo
+
+
+def test_compiled_source():
+    source = block_source(FIB, 10, pure=frozenset([0]))
+    assert "if vm.memo_call(0, 1):" in source
+    assert "memo" not in block_source(FIB, 10)
+    assert "vm.memo_return(" in block_source(FIB, 26, pure=frozenset([0]))
@@ -0,0 +1,64 @@
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, CALL, RET, HALT
+from simplevirtualmachine.memory import MemoryOverflowError, CHUNK
+from simplevirtualmachine.vm import VM
+
+FACTORIAL = (
+    LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+    LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+    ICONST, 20, CALL, 0, 1, PUTS, HALT,
+)
+
+
+def test_array_memory_starts_empty():
+    vm = VM(HALT, memory='array', engine='table')
+    assert len(vm.stack) == 0 and len(vm.data) == 0
+    assert vm.run() == HALT
+
+
+def test_array_memory_rejects_switch_engine():
+    try:
+        VM(HALT, memory='array')
+    except ValueError:
+        pass
+    else:
+        assert False, "switch engine has no array memory support"
+
+
+def test_array_memory_grows_on_demand(capsys):
+    for engine in ('table', 'decoded'):
+        vm = VM(*FACTORIAL, start_ip=22, memory='array', engine=engine)
+        assert vm.run() == HALT
+        out, err = capsys.readouterr()
+        assert out == "OUTPUT: 2432902008176640000\n"
+        assert len(vm.stack) == 2 * CHUNK
+
+
+def test_array_memory_stack_overflow():
+    for engine in ('table', 'decoded'):
+        vm = VM(*FACTORIAL, start_ip=22, memory='array', engine=engine, stack_size=40)
+        try:
+            vm.run()
+        except MemoryOverflowError as e:
+            assert "stack size 40" in str(e)
+        else:
+            assert False, "deep recursion should overflow a 40 cell stack"
+
+
+def test_array_memory_data_overflow():
+    vm = VM(ICONST, 1, GSTORE, 500, HALT, memory='array', engine='decoded', data_size=100)
+    try:
+        vm.run()
+    except MemoryOverflowError as e:
+        assert "data address 500" in str(e)
+    else:
+        assert False, "GSTORE past data_size should overflow"
+
+
+def test_array_memory_tracks_written_cells():
+    vm = VM(ICONST, 0, GSTORE, 3, ICONST, 7, GSTORE, 70, GLOAD, 5,
+            ICONST, 1, IADD, HALT, memory='array', engine='table')
+    vm.run()
+    assert vm.stack[vm.sp] == 1
+    dump = vm.dump_data_memory().splitlines()
+    assert dump[-2:] == ["   3 0", "  70 7"]
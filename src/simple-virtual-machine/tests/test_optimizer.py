@@ -0,0 +1,204 @@
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, IEQ, BR, BRT, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, POP, CALL, RET, HALT, TCALL
+from simplevirtualmachine.optimizer import optimize
+from simplevirtualmachine.verifier import VerifyError
+from simplevirtualmachine.vm import VM
+
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+             ICONST, 10, CALL, 0, 1, PUTS, HALT)
+
+# every pass has something to do
+FOLDABLE = (
+    ICONST, 4, GSTORE, 0,          # 0
+    GLOAD, 0, ICONST, 2, IMUL,     # 4
+    GSTORE, 1,                     # 9
+    ICONST, 1, BRT, 20,            # 11
+    ICONST, 99, PUTS, HALT, HALT,  # 15 (dead)
+    BR, 22,                        # 20
+    BR, 26,                        # 22
+    ICONST, 7,                     # 24 (dead)
+    GLOAD, 1, PUTS,                # 26
+    GLOAD, 1, GSTORE, 1,           # 29
+    ICONST, 3, POP,                # 33
+    HALT,                          # 36
+)
+
+# the loop head at 4 is a branch target: 2 + 3 must not fold into it
+LOOP_HEAD = (
+    ICONST, 2,                     # 0
+    GSTORE, 0,                     # 2
+    GLOAD, 0, ICONST, 3, IADD,     # 4
+    GSTORE, 0,                     # 9
+    GLOAD, 0, ICONST, 10, ILT,     # 11
+    BRT, 4,                        # 16
+    GLOAD, 0, PUTS, HALT,          # 18
+)
+
+# the pushes at 10 and 18 are branch targets: ICONST 99; POP must stay
+# and ICONST 10; ICONST 5; IADD must not fold over the target at 10
+DEAD_LEADER = (
+    ICONST, 1, GSTORE, 0,          # 0
+    GLOAD, 0, BRT, 18,             # 4
+    ICONST, 10,                    # 8
+    ICONST, 99, POP,               # 10
+    ICONST, 5, IADD, PUTS, HALT,   # 13
+    ICONST, 20, ICONST, 77, BR, 10,  # 18
+)
+
+
+def outcome(code, **kwargs):
+    output = []
+    vm = VM.from_code(code, output=output, **kwargs)
+    vm.run()
+    top = vm.stack[vm.sp] if vm.sp >= 0 else None
+    return output, vm.written_data(), top
+
+
+def test_same_results():
+    programs = [(loop_program(10), 0), (call_program(7), 6), (FACTORIAL, 22),
+                (FOLDABLE, 0), (LOOP_HEAD, 0), (DEAD_LEADER, 0)]
+    for code, start_ip in programs:
+        expected = outcome(code, start_ip=start_ip)
+        for level in (1, 2):
+            for engine in VM.ENGINES:
+                assert outcome(code, start_ip=start_ip, engine=engine,
+                               optimize=level) == expected, (code, level, engine)
+
+
+def test_passes():
+    result = optimize(FOLDABLE)
+    assert result.code == (ICONST, 4, GSTORE, 0, ICONST, 8, GSTORE, 1, ICONST, 8, PUTS, HALT)
+    assert result.entry == 0
+    assert result.stats['fold'] == 1
+    assert result.stats['branch'] == 1
+    assert result.stats['unreachable'] == 4
+    # GLOAD 0 became ICONST 4 at the same address, folded with ICONST 2
+    assert result.remap[4] == 4
+    assert result.remap[26] == 8
+    assert result.remap[36] == 11
+
+
+def test_level_one_does_not_forward():
+    result = optimize(FOLDABLE, level=1)
+    assert 'forward' not in result.stats
+    assert GLOAD in result.code
+    assert len(result.code) < len(FOLDABLE)
+
+
+def test_level_zero_only_drops_unreachable_code():
+    result = optimize(FOLDABLE, level=0)
+    # 19 and 24 cannot be reached whatever the data
+    assert len(result.code) == len(FOLDABLE) - 3
+    assert result.code[:19] == FOLDABLE[:13] + (BRT, 19) + FOLDABLE[15:19]
+    assert result.remap[26] == 23
+    assert result.stats == {}
+
+
+def test_leaders_are_kept():
+    result = optimize(LOOP_HEAD)
+    assert result.code[:4] == (ICONST, 2, GSTORE, 0)
+    assert result.code[result.remap[4]] is GLOAD
+    assert result.code[result.code.index(BRT) + 1] == result.remap[4]
+
+
+def test_deleted_pushes_keep_leaders():
+    assert outcome(DEAD_LEADER)[0] == [82]
+    for level in (1, 2):
+        assert outcome(DEAD_LEADER, optimize=level)[0] == [82], level
+    # likewise a not-taken branch and a GLOAD x; GSTORE x at the target 10
+    for deleted in ((ICONST, 1, BRF, 17), (GLOAD, 1, GSTORE, 1)):
+        code = (ICONST, 1, GSTORE, 0, GLOAD, 0, BRT, 19, ICONST, 10) + deleted + \
+            (ICONST, 5, IADD, PUTS, HALT, ICONST, 20, BR, 10)
+        assert outcome(code)[0] == [25]
+        for level in (1, 2):
+            assert outcome(code, optimize=level)[0] == [25], (deleted, level)
+    assert IADD in optimize(DEAD_LEADER).code
+
+
+def test_constant_branches():
+    code = (ICONST, 0, BRT, 7, ICONST, 1, PUTS, ICONST, 2, PUTS, HALT)
+    assert optimize(code).code == (ICONST, 1, PUTS, ICONST, 2, PUTS, HALT)
+    code = (ICONST, 0, BRF, 7, ICONST, 1, PUTS, ICONST, 2, PUTS, HALT)
+    assert optimize(code).code == (ICONST, 2, PUTS, HALT)
+    code = (ICONST, 1, ICONST, 1, IEQ, BRF, 8, HALT, ICONST, 3, PUTS, HALT)
+    assert optimize(code).code == (HALT,)
+
+
+def test_jump_threading():
+    code = (GLOAD, 0, BRT, 6, HALT, HALT, BR, 8, BR, 10, ICONST, 1, PUTS, HALT)
+    result = optimize(code)
+    assert result.code == (GLOAD, 0, BRT, 5, HALT, ICONST, 1, PUTS, HALT)
+    # BR to HALT is a HALT
+    assert optimize((BR, 3, PUTS, HALT)).code == (HALT,)
+    # a branch to the next instruction still pops its condition
+    assert optimize((GLOAD, 0, BRF, 4, HALT)).code == (HALT,)
+
+
+def test_call_return_address_is_a_leader():
+    # the function result must not fold with the ICONST before the CALL
+    code = (LOAD, -3, RET,
+            ICONST, 5, ICONST, 6, CALL, 0, 1, IADD, PUTS, HALT)
+    result = optimize(code, entry=3)
+    assert IADD in result.code
+    assert outcome(code, start_ip=3, optimize=2) == ([11], {}, None)
+
+
+def test_tail_calls():
+    # F(n) = G(n + 1), G(n) = n * 2; main prints F(4) and CALLs G last
+    code = (LOAD, -3, ICONST, 1, IADD, CALL, 9, 1, RET,
+            LOAD, -3, ICONST, 2, IMUL, RET,
+            ICONST, 4, CALL, 0, 1, PUTS, ICONST, 1, CALL, 9, 1, RET)
+    result = optimize(code, entry=15)
+    assert result.stats['tail'] == 1
+    assert result.code[result.remap[5]] is TCALL
+    # the entry frame's CALL; RET stays a CALL
+    assert result.code[result.remap[23]] is CALL
+    vm = VM(*code[:-1] + (HALT,), start_ip=15, optimize=1, output=[])
+    vm.run()
+    assert vm.output.values == [10]
+    assert vm.code[vm.optimized.remap[5]] is TCALL
+
+
+def test_extra_entries_are_kept():
+    code = (ICONST, 1, PUTS, HALT, ICONST, 2, PUTS, HALT)
+    assert optimize(code).code == code[:4]
+    result = optimize(code, entries=[4])
+    assert result.code == code
+    assert result.remap[4] == 4
+
+
+def test_vm_runs_optimized_code():
+    vm = VM(*call_program(5), start_ip=6, optimize=2, verify=True, output='null')
+    assert vm.optimized is not None
+    assert vm.ip == vm.optimized.entry
+    vm.run()
+    assert vm.written_data() == {0: 0}
+
+    vm = VM(*FOLDABLE, optimize=2, output='null')
+    vm.run()
+    assert vm.steps < 8
+
+
+def test_bad_input():
+    try:
+        optimize((ICONST, 1, 99, HALT))
+    except VerifyError as e:
+        assert "invalid opcode" in str(e)
+    else:
+        assert False, "optimize should reject undecodable code"
+
+    try:
+        optimize(loop_program(3), level=3)
+    except ValueError:
+        pass
+    else:
+        assert False, "level 3 should be rejected"
+
+    try:
+        VM(ICONST, 1, HALT, optimize=5)
+    except ValueError:
+        pass
+    else:
+        assert False, "optimize=5 should be rejected"
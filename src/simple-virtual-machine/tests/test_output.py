@@ -0,0 +1,92 @@
+from simplevirtualmachine.bytecodes import ICONST, GLOAD, GSTORE, ILT, BRF, BR, \
+    IADD, PUTS, HALT
+from simplevirtualmachine.output import OutputSink, StreamSink, ListSink, CallbackSink, \
+    NullSink, make_sink
+from simplevirtualmachine.vm import VM
+
+# PUTS 0..9
+COUNT = (ICONST, 0, GSTORE, 0,
+         GLOAD, 0, ICONST, 10, ILT, BRF, 23,
+         GLOAD, 0, PUTS,
+         GLOAD, 0, ICONST, 1, IADD, GSTORE, 0, BR, 4,
+         HALT)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.writes = []
+        self.flushes = 0
+
+    def write(self, text):
+        self.writes.append(text)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def test_list_output():
+    for engine in VM.ENGINES:
+        values = []
+        VM(*COUNT, engine=engine, output=values).run()
+        assert values == list(range(10))
+
+
+def test_default_output_is_labelled_stdout(capsys):
+    VM(*COUNT, engine='decoded').run()
+    out, err = capsys.readouterr()
+    assert out == "".join("OUTPUT: {}\n".format(n) for n in range(10))
+
+
+def test_stream_buffering():
+    stream = Recorder()
+    sink = StreamSink(stream, labelled=False, buffer_size=4, flush=True)
+    VM(*COUNT, engine='table', output=sink).run()
+    # two full buffers, then the rest when the run ends
+    assert stream.writes == ["0\n1\n2\n3\n", "4\n5\n6\n7\n", "8\n9\n"]
+    assert stream.flushes == 3
+
+
+def test_stream_flushed_on_error():
+    stream = Recorder()
+    try:
+        VM(ICONST, 7, PUTS, ICONST, 1, 99, output=StreamSink(stream), engine='table').run()
+    except Exception:
+        pass
+    assert stream.writes == ["OUTPUT: 7\n"]
+
+
+def test_callback_and_null():
+    seen = []
+    VM(*COUNT, output=seen.append).run()
+    assert seen == list(range(10))
+    assert isinstance(make_sink('null'), NullSink)
+    assert isinstance(make_sink(seen.append), CallbackSink)
+    assert isinstance(make_sink([]), ListSink)
+
+
+def test_bad_output():
+    try:
+        make_sink(42)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    try:
+        StreamSink(buffer_size=0)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_sink_must_define_write():
+    class Deaf(OutputSink):
+        pass
+
+    try:
+        Deaf()
+    except TypeError:
+        pass
+    else:
+        assert False, "an OutputSink without write() should not be created"
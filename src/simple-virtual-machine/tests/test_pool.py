@@ -0,0 +1,72 @@
+from simplevirtualmachine.bench import loop_program
+from simplevirtualmachine.bytecodes import ICONST, GLOAD, GSTORE, IADD, IMUL, \
+    PUTS, HALT, BR
+from simplevirtualmachine.pool import VMPool, run_many, scaling, format_scaling, \
+    load_inputs
+from simplevirtualmachine.vm import VM
+
+# data[1] = data[0] * data[0] + 1, printed
+SQUARE = (GLOAD, 0, GLOAD, 0, IMUL, ICONST, 1, IADD,
+          GSTORE, 1, GLOAD, 1, PUTS, GLOAD, 1, HALT)
+
+
+def test_inputs_in_order():
+    inputs = [[n] for n in range(20)]
+    results = run_many(inputs, workers=2, program=SQUARE, chunksize=3)
+    assert [r.index for r in results] == list(range(20))
+    for n, result in enumerate(results):
+        assert result.status == 'halt'
+        assert result.output == [n * n + 1]
+        assert result.value == n * n + 1
+        assert result.globals == {0: n, 1: n * n + 1}
+        assert result.steps == 9
+
+
+def test_programs_as_completed():
+    programs = [loop_program(n) for n in (5, 50, 500)] * 2
+    with VMPool(workers=2, engine='decoded', memory='array') as pool:
+        results = list(pool.run_many(programs, ordered=False))
+        # the pool stays warm for another batch
+        again = list(pool.run_many(programs[:1]))
+    assert sorted(r.index for r in results) == list(range(6))
+    for result in results:
+        vm = VM(*programs[result.index])
+        vm.run()
+        assert result.globals == vm.written_data()
+        assert result.steps == vm.steps
+    assert again[0].status == 'halt'
+
+
+def test_stack_inputs():
+    add = (IADD, PUTS, HALT)
+    results = run_many([[1, 2], [30, 12]], workers=1, program=add, inputs_to='stack')
+    assert [r.output for r in results] == [[3], [42]]
+
+
+def test_timeout_keeps_worker():
+    forever = (BR, 0)
+    with VMPool(workers=1) as pool:
+        results = list(pool.run_many([forever, loop_program(3)], timeout=0.2))
+    assert results[0].status == 'timeout'
+    assert results[1].status == 'halt'
+
+
+def test_error():
+    results = run_many([(ICONST, 1, 99)], workers=1, engine='table')
+    assert results[0].status == 'error'
+    assert 'InvalidBytecodeError' in results[0].error
+
+
+def test_load_inputs_array_memory():
+    vm = VM(*SQUARE, memory='array', engine='decoded')
+    load_inputs(vm, [7])
+    vm.run()
+    assert vm.written_data() == {0: 7, 1: 50}
+
+
+def test_scaling():
+    rows = scaling([[n] for n in range(8)], max_workers=2, program=SQUARE)
+    assert [row[0] for row in rows] == [1, 2]
+    assert rows[0][3] == 1.0
+    assert format_scaling(rows).splitlines()[0].split() == \
+        ['WORKERS', 'SECONDS', 'JOBS/S', 'SPEEDUP']
@@ -0,0 +1,164 @@
+from simplevirtualmachine.assembler import assemble
+from simplevirtualmachine.bench import loop_program
+from simplevirtualmachine.profiler import Profiler, MAIN
+from simplevirtualmachine.vm import VM
+
+FACTORIAL = """
+.entry main
+fact:   LOAD -3
+        ICONST 2
+        ILT
+        BRF recurse
+        ICONST 1
+        RET
+recurse:
+        LOAD -3
+        LOAD -3
+        ICONST 1
+        ISUB
+        CALL fact, 1
+        IMUL
+        RET
+main:   ICONST 4
+        CALL fact, 1
+        GSTORE 0
+        HALT
+"""
+
+TAIL_FACTORIAL = """
+.entry main
+fact:   LOAD -4
+        ICONST 2
+        ILT
+        BRF recurse
+        LOAD -3
+        RET
+recurse:
+        LOAD -4
+        ICONST 1
+        ISUB
+        LOAD -3
+        LOAD -4
+        IMUL
+        TCALL fact, 2
+        RET
+main:   ICONST 4
+        ICONST 1
+        CALL fact, 2
+        GSTORE 0
+        HALT
+"""
+
+FIB = """
+.entry main
+fib:    LOAD -3
+        ICONST 2
+        ILT
+        BRF recurse
+        LOAD -3
+        RET
+recurse:
+        LOAD -3
+        ICONST 1
+        ISUB
+        CALL fib, 1
+        LOAD -3
+        ICONST 2
+        ISUB
+        CALL fib, 1
+        IADD
+        RET
+main:   ICONST 15
+        CALL fib, 1
+        PUTS
+        HALT
+"""
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1.0
+        return self.now
+
+
+def profile(code, **kwargs):
+    profiler = Profiler(clock=FakeClock())
+    vm = VM(*code, trace=profiler, **kwargs)
+    profiler.start()
+    vm.run()
+    profiler.finish()
+    return vm, profiler
+
+
+def test_opcode_and_address_counts():
+    vm, profiler = profile(loop_program(10), engine='table')
+    assert profiler.steps == vm.steps == sum(profiler.opcode_counts.values())
+    assert profiler.opcode_counts['BRF'] == 11
+    assert profiler.address_counts[8] == 11 and profiler.address_counts[22] == 10
+    assert profiler.functions.keys() == [MAIN]
+
+
+def test_function_inclusive_exclusive():
+    program = assemble(FACTORIAL)
+    vm, profiler = profile(program.code, start_ip=program.entry, engine='decoded')
+    fact = profiler.functions[0]
+    main = profiler.functions[MAIN]
+    assert fact.calls == 4
+    # 3 recursive calls of 11 instructions plus the base case of 6
+    assert fact.exclusive_steps == fact.inclusive_steps == 3 * 11 + 6
+    assert main.exclusive_steps == 3 and main.inclusive_steps == vm.steps
+    # every step takes one tick of the fake clock
+    assert fact.inclusive_time == fact.inclusive_steps
+
+
+def test_folded_stacks():
+    program = assemble(FACTORIAL)
+    vm, profiler = profile(program.code, start_ip=program.entry, engine='decoded')
+    profiler.names = {0: 'fact'}
+    assert profiler.folded().splitlines() == [
+        "main 3",
+        "main;fact 11",
+        "main;fact;fact 11",
+        "main;fact;fact;fact 11",
+        "main;fact;fact;fact;fact 6",
+    ]
+
+
+def test_tail_calls_replace_the_frame():
+    program = assemble(TAIL_FACTORIAL)
+    vm, profiler = profile(program.code, start_ip=program.entry, engine='table')
+    assert vm.data[0] == 24
+    assert profiler.functions[0].calls == 4
+    # one frame deep however many calls
+    assert profiler.folded().splitlines() == ["main 4", "main;fn_0000 {}".format(vm.steps - 4)]
+
+
+def test_report_sorted_by_cost():
+    program = assemble(FACTORIAL)
+    vm, profiler = profile(program.code, start_ip=program.entry)
+    lines = profiler.report().splitlines()
+    assert lines[0].split()[0] == 'OPCODE'
+    assert lines[1].split()[0] == 'LOAD'
+    header = [line for line in lines if line.startswith('FUNCTION')][0]
+    functions = lines[lines.index(header) + 1:]
+    assert [line.split()[0] for line in functions] == ['main', 'fn_0000']
+
+
+def test_memo_hits_build_no_frame():
+    # fib(n) = fib(n - 1) + fib(n - 2), printed for 15
+    program = assemble(FIB)
+    for engine in ('switch', 'table', 'decoded'):
+        vm, profiler = profile(program.code, start_ip=program.entry, engine=engine,
+                               memoize=100, output=[])
+        assert vm.output.values == [610], engine
+        # fib(15) down to fib(0) each run once, every other call is a hit
+        assert profiler.functions[0].calls == 16, engine
+        # no frame is left open, so the PUTS after the call is main's
+        assert profiler.folded().splitlines()[0] == "main 3", engine
+
+
+def test_profiling_off_by_default():
+    assert VM(*loop_program(3), engine='decoded').tracer is None
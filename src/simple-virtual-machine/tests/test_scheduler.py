@@ -0,0 +1,140 @@
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BRF, BR, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, HALT
+from simplevirtualmachine.scheduler import Channel, Scheduler
+from simplevirtualmachine.vm import VM
+
+DOUBLE = (LOAD, 1, ICONST, 2, IMUL, PUTS, HALT)
+
+# the running total of the messages so far
+TOTAL = (GLOAD, 0, LOAD, 1, IADD, GSTORE, 0, GLOAD, 0, PUTS, HALT)
+
+
+def counter(n, label):
+    '''PUTS label n times.'''
+    return (ICONST, n, GSTORE, 0,                  # 0
+            ICONST, 0, GLOAD, 0, ILT, BRF, 23,     # 4
+            ICONST, label, PUTS,                   # 11
+            GLOAD, 0, ICONST, 1, ISUB, GSTORE, 0,  # 14
+            BR, 4,                                 # 21
+            HALT)                                  # 23
+
+
+def test_many_actors():
+    scheduler = Scheduler(quantum=50)
+    results = Channel()
+    tasks = [scheduler.spawn(DOUBLE, inbox=Channel(), outbox=results) for _ in range(2000)]
+    assert set(task.state for task in tasks) == set(['blocked'])
+    for value, task in enumerate(tasks):
+        task.inbox.send(value)
+    stats = scheduler.run()
+    assert sorted(results.drain()) == [value * 2 for value in range(2000)]
+    assert (stats.tasks, stats.messages, stats.steps) == (2000, 2000, 2000 * 4)
+    assert stats.steps_per_second > 0
+    assert tasks[0].vm.program is tasks[1].vm.program
+    for task in tasks:
+        assert task.state == 'blocked'
+        assert task.messages == 1
+        assert task.latency()['max'] >= 0
+
+    # a second message wakes a blocked task
+    tasks[7].inbox.send(100)
+    scheduler.run()
+    assert results.drain() == [200]
+    assert tasks[7].messages == 2
+
+
+def test_actors_keep_their_globals():
+    scheduler = Scheduler()
+    results = Channel()
+    total = scheduler.spawn(TOTAL, inbox=Channel(), outbox=results)
+    other = scheduler.spawn(TOTAL, inbox=Channel(), outbox=results)
+    for value in (1, 2, 3):
+        total.inbox.send(value)
+    other.inbox.send(10)
+    scheduler.run()
+    assert sorted(results.drain()) == [1, 3, 6, 10]
+    assert total.vm.written_data() == {0: 6}
+    assert len(total.latencies) == 3
+
+
+def test_pipeline():
+    # doubled values go to a summing task
+    scheduler = Scheduler(quantum=1)
+    results = Channel()
+    summing = scheduler.spawn(TOTAL, inbox=Channel(), outbox=results)
+    doubling = scheduler.spawn(DOUBLE, inbox=Channel(), outbox=summing.inbox)
+    for value in range(5):
+        doubling.inbox.send(value)
+    scheduler.run()
+    assert results.drain() == [0, 2, 6, 12, 20]
+
+
+def test_round_robin_time_slices():
+    output = []
+    scheduler = Scheduler(quantum=20, output=output)
+    scheduler.spawn(counter(5, 1))
+    scheduler.spawn(counter(5, 2))
+    stats = scheduler.run()
+    # the tasks take turns
+    assert sorted(output) == [1] * 5 + [2] * 5
+    assert output[:4] == [1, 1, 2, 2]
+    assert stats.slices > 2
+    assert [task.state for task in scheduler.tasks] == ['done', 'done']
+
+
+def test_priority():
+    output = []
+    scheduler = Scheduler(policy='priority', quantum=5, output=output)
+    scheduler.spawn(counter(3, 1), priority=0)
+    scheduler.spawn(counter(3, 2), priority=5)
+    scheduler.spawn(counter(3, 3), priority=5)
+    scheduler.run()
+    assert output[:6] in ([2, 3, 2, 3, 2, 3], [3, 2, 3, 2, 3, 2])
+    assert output[6:] == [1, 1, 1]
+
+
+def test_spawn_from_a_vm():
+    # a warm VM: the task starts where it stopped, with its data
+    code = (ICONST, 40, GSTORE, 0, GLOAD, 0, LOAD, 1, IADD, PUTS, HALT)
+    warm = VM(*code, engine='decoded', memory='array', output='null')
+    warm.run(max_steps=2)
+    scheduler = Scheduler()
+    results = Channel()
+    task = scheduler.spawn(warm, inbox=Channel(), outbox=results, name='adder')
+    assert task.entry == 4
+    task.inbox.send(2)
+    task.inbox.send(3)
+    scheduler.run()
+    assert results.drain() == [42, 43]
+    assert repr(task) == "Task('adder', blocked, steps=10)"
+    assert warm.steps == 2
+
+
+def test_errors_stop_only_their_task():
+    scheduler = Scheduler(engine='table', memory='list', stack_size=64)
+    results = Channel()
+    # IADD of 1 and an unset data cell
+    broken = scheduler.spawn((ICONST, 1, GLOAD, 0, IADD, PUTS, HALT))
+    fine = scheduler.spawn(DOUBLE, inbox=Channel(), outbox=results)
+    fine.inbox.send(4)
+    scheduler.run()
+    assert broken.state == 'error'
+    assert isinstance(broken.error, TypeError)
+    assert results.drain() == [8]
+
+
+def test_settings():
+    for kwargs in ({'policy': 'random'}, {'quantum': 0}):
+        try:
+            Scheduler(**kwargs)
+        except ValueError:
+            pass
+        else:
+            assert False, "{} should be rejected".format(kwargs)
+    channel = Channel()
+    try:
+        channel.receive()
+    except IndexError:
+        pass
+    else:
+        assert False, "an empty channel has nothing to receive"
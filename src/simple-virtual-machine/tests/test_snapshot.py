@@ -0,0 +1,156 @@
+import os
+
+from simplevirtualmachine import snapshot
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BRF, \
+    ICONST, LOAD, GLOAD, GSTORE, PUTS, CALL, RET, HALT
+from simplevirtualmachine.memory import MemoryOverflowError
+from simplevirtualmachine.vm import VM
+
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+             ICONST, 7, GSTORE, 3, ICONST, 10, CALL, 0, 1, PUTS, HALT)
+
+# initialization fills cells 0 and 1, each request reads cell 2
+WARM = (ICONST, 6, GSTORE, 0, ICONST, 7, GSTORE, 1,          # 0
+        GLOAD, 2, GLOAD, 0, IMUL, GLOAD, 1, IADD, PUTS, HALT)  # 8
+
+SETTINGS = ({'engine': 'switch'},
+            {'engine': 'table', 'memory': 'array'},
+            {'engine': 'decoded', 'memoize': 10},
+            {'engine': 'decoded', 'fuse': True, 'verify': True},
+            {'engine': 'compiled', 'memory': 'array'})
+
+
+def warm_vm(**kwargs):
+    vm = VM(*WARM, output=[], **kwargs)
+    for _ in vm.run_iter(1):
+        if vm.ip == 8:
+            break
+    return vm
+
+
+def test_restore_mid_call():
+    for kwargs in SETTINGS:
+        vm = VM(*FACTORIAL, start_ip=22, output=[], **kwargs)
+        next(vm.run_iter(25))
+        # inside the recursion
+        assert vm.fp > 0, kwargs
+        state = vm.snapshot()
+        assert state.stack == tuple(vm.stack[:vm.sp + 1])
+        assert state.data == {3: 7}
+        vm.run()
+        assert vm.output.values == [3628800], kwargs
+        steps = vm.steps
+
+        vm.restore(state)
+        assert (vm.ip, vm.sp, vm.fp) == (state.ip, state.sp, state.fp)
+        vm.run()
+        assert vm.output.values == [3628800] * 2, kwargs
+        # unless the memo cache answers the calls this time
+        assert vm.steps == steps or vm.memo.hits, kwargs
+
+        other = VM.from_snapshot(state, output=[])
+        assert other.config.engine == kwargs['engine']
+        other.run()
+        assert other.output.values == [3628800], kwargs
+        assert other.written_data() == {3: 7}
+
+
+def test_restore_clears_data():
+    vm = warm_vm()
+    state = vm.snapshot()
+    vm.unshare()
+    vm.data[2] = 5
+    vm.run()
+    assert vm.output.values == [37]
+    vm.restore(state)
+    assert vm.written_data() == {0: 6, 1: 7}
+    assert vm.stack[:3] == [None] * 3
+
+
+def test_dump_and_load(tmpdir):
+    vm = warm_vm(engine='decoded')
+    path = str(tmpdir.join("warm.svms"))
+    snapshot.dump(vm.snapshot(), path)
+    loaded = snapshot.load(path)
+    assert loaded == vm.snapshot()
+    assert loaded.code[8] is GLOAD
+    assert loaded.settings['engine'] == 'decoded'
+
+    started = VM.from_snapshot(loaded, output=[])
+    assert started.steps == 4
+    started.data[2] = 3
+    started.run()
+    assert started.output.values == [25]
+
+    for text in ("not json", '{"format": "svm-snapshot", "version": 99}', '[1, 2]'):
+        with open(path, 'w') as f:
+            f.write(text)
+        try:
+            snapshot.load(path)
+        except snapshot.SnapshotFormatError:
+            pass
+        else:
+            assert False, "{!r} should be rejected".format(text)
+    os.remove(path)
+
+
+def test_restore_checks():
+    state = warm_vm().snapshot()
+    try:
+        VM(*FACTORIAL).restore(state)
+    except ValueError:
+        pass
+    else:
+        assert False, "a snapshot of other code should be rejected"
+
+    try:
+        VM.from_snapshot(state, data_size=1)
+    except MemoryOverflowError:
+        pass
+    else:
+        assert False, "data cell 1 does not fit in one cell"
+
+
+def test_fork_shares_memory_until_run():
+    for kwargs in ({}, {'engine': 'decoded', 'memory': 'array'}):
+        parent = warm_vm(**kwargs)
+        stack, data = parent.stack, parent.data
+        children = [parent.fork(output=[]) for _ in range(3)]
+        for child in children:
+            assert child.stack is stack and child.data is data
+            assert child.output is not parent.output
+            assert child.steps == parent.steps
+
+        for value, child in enumerate(children):
+            child.unshare()
+            child.data[2] = value
+            if child.data_written is not None:
+                child.data_written[2] = 1
+            child.run()
+            assert child.output.values == [value * 6 + 7], kwargs
+            assert child.data is not data
+        assert parent.written_data() == {0: 6, 1: 7}
+
+        # the last VM sharing the memory keeps it
+        parent.unshare()
+        parent.data[2] = 10
+        parent.run()
+        assert parent.data is data
+        assert parent.output.values == [67]
+
+
+def test_fork_mid_call():
+    for kwargs in SETTINGS:
+        vm = VM(*FACTORIAL, start_ip=22, output=[], **kwargs)
+        next(vm.run_iter(30))
+        child = vm.fork(output=[])
+        child.run()
+        vm.run()
+        assert vm.output.values == child.output.values == [3628800], kwargs
+        if vm.memo is None:
+            assert vm.steps == child.steps, kwargs
+        else:
+            # the child filled the cache they share
+            assert child.memo is vm.memo
+            assert vm.steps < child.steps
@@ -0,0 +1,59 @@
+from StringIO import StringIO
+
+from simplevirtualmachine.bytecodes import ICONST, IADD, GSTORE, HALT
+from simplevirtualmachine.trace import Tracer, RingTracer, StreamTracer, make_tracer
+from simplevirtualmachine.vm import VM
+
+CODE = (ICONST, 1, ICONST, 2, IADD, GSTORE, 0, HALT)
+
+
+def test_trace_off_by_default():
+    assert VM(*CODE).tracer is None
+    assert make_tracer(None) is None and make_tracer(False) is None
+
+
+def test_make_tracer_rejects_true():
+    try:
+        make_tracer(True)
+    except ValueError:
+        pass
+    else:
+        assert False, "trace=True should be rejected"
+
+
+def test_tracer_must_define_step():
+    class Silent(Tracer):
+        pass
+
+    try:
+        Silent()
+    except TypeError:
+        pass
+    else:
+        assert False, "a Tracer without step() should not be created"
+
+
+def test_ring_keeps_last_steps():
+    for engine in VM.ENGINES:
+        vm = VM(*CODE, trace=2, engine=engine)
+        vm.run()
+        assert isinstance(vm.tracer, RingTracer)
+        lines = vm.tracer.lines()
+        assert len(lines) == 2
+        assert "IADD" in lines[0] and lines[0].endswith("STACK [3]")
+        assert "GSTORE" in lines[1] and "STACK" not in lines[1]
+
+
+def test_stream_to_callback():
+    lines = []
+    vm = VM(*CODE, trace=lines.append)
+    vm.run()
+    assert isinstance(vm.tracer, StreamTracer)
+    assert len(lines) == 4
+    assert lines[1].endswith("STACK [1, 2]")
+
+
+def test_stream_to_file():
+    out = StringIO()
+    VM(*CODE, trace=out, engine='table').run()
+    assert out.getvalue().count("\n") == 4
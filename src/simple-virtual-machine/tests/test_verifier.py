@@ -0,0 +1,105 @@
+from simplevirtualmachine.bench import loop_program, call_program
+from simplevirtualmachine.bytecodes import IADD, ISUB, IMUL, ILT, BR, BRT, BRF, \
+    ICONST, LOAD, GLOAD, STORE, PUTS, CALL, RET, HALT, TCALL
+from simplevirtualmachine.verifier import verify, VerifyError
+from simplevirtualmachine.vm import VM
+
+FACTORIAL = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+             LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+             ICONST, 10, CALL, 0, 1, PUTS, HALT)
+
+
+def rejects(code, message, **kwargs):
+    try:
+        verify(code, **kwargs)
+    except VerifyError as e:
+        assert message in str(e), str(e)
+        return e
+    else:
+        assert False, "verify should reject the code"
+
+
+def test_loop_cfg():
+    verified = verify(loop_program(10))
+    assert verified.max_stack == 2
+    assert verified.data_cells == 2
+    assert [(b.start, b.end, b.successors) for _, b in sorted(verified.blocks.items())] == \
+        [(0, 8, [8]), (8, 15, [24, 15]), (15, 24, [8]), (24, 25, [])]
+    assert verified.functions[None].depths[13] == 1
+
+
+def test_call_depths():
+    verified = verify(call_program(5), entry=6)
+    assert verified.functions[0].nargs == 1
+    assert verified.functions[0].max_depth == 2
+    # GLOAD, CALL header, then DEC's two cells
+    assert verified.max_stack == 6
+
+
+def test_recursion_has_no_bound():
+    verified = verify(FACTORIAL, entry=22)
+    assert verified.recursive
+    assert verified.functions[0].max_depth == 5
+
+
+def test_tail_recursion_is_bounded():
+    # FACT(n, acc): if n < 2: return acc; return FACT(n - 1, acc * n)
+    code = (LOAD, -4, ICONST, 2, ILT, BRF, 10, LOAD, -3, RET,
+            LOAD, -4, ICONST, 1, ISUB, LOAD, -3, LOAD, -4, IMUL,
+            TCALL, 0, 2, RET,
+            ICONST, 10, ICONST, 1, CALL, 0, 2, PUTS, HALT)
+    verified = verify(code, entry=24)
+    assert verified.functions[0].tail_calls == set([20])
+    assert not verified.recursive
+    assert verified.max_stack == 2 + 3 + 5
+    vm = VM(*code, start_ip=24, verify=True, output=[])
+    assert len(vm.stack) == 10
+    vm.run()
+    assert vm.output.values == [3628800]
+
+    # with CALL the depth is unbounded
+    code = code[:20] + (CALL,) + code[21:]
+    assert verify(code, entry=24).recursive
+
+
+def test_bad_programs():
+    rejects((BR, 1, HALT), "jump into the operands", entry=0)
+    rejects((ICONST, 1, BRT, 7, HALT), "outside the code")
+    rejects((IADD, HALT), "IADD needs 2 stack value(s), has 0")
+    rejects((ICONST, 0, BRF, 4, PUTS, HALT), "0004: PUTS needs 1 stack value(s), has 0")
+    rejects((ICONST, 1, BRT, 6, ICONST, 5, HALT), "stack depth")
+    rejects((ICONST, 1, PUTS), "outside the code")
+    rejects((GLOAD, 10, HALT), "data address 10", data_size=10)
+    rejects((ICONST, 1, STORE, 0, HALT), "frame offset 0")
+    rejects((ICONST, 1, CALL, 6, 1, HALT, LOAD, -4, RET), "frame offset -4")
+    rejects((ICONST, 1, CALL, 11, 1, ICONST, 2, CALL, 11, 2, HALT, LOAD, -3, RET),
+            "called with 2 argument(s), elsewhere 1")
+    rejects((ICONST, 1, 99, HALT), "invalid opcode")
+    rejects((ICONST,), "missing operands")
+    rejects(call_program(5), "needs 6 stack cells", entry=6, stack_size=5)
+
+
+def test_verified_vm_sizes_memory():
+    for memory, engine in (('list', 'switch'), ('array', 'decoded'), ('array', 'compiled')):
+        values = []
+        vm = VM(*call_program(5), start_ip=6, verify=True, memory=memory,
+                engine=engine, output=values)
+        assert (len(vm.stack), len(vm.data)) == (6, 1)
+        vm.run()
+        assert vm.written_data() == {0: 0}
+
+
+def test_verified_recursion_keeps_stack_size(capsys):
+    vm = VM(*FACTORIAL, start_ip=22, verify=True, stack_size=500)
+    assert len(vm.stack) == 500
+    vm.run()
+    assert capsys.readouterr()[0] == "OUTPUT: 3628800\n"
+
+
+def test_verify_error_at_construction():
+    try:
+        VM(ICONST, 1, STORE, 0, HALT, verify=True)
+    except VerifyError as e:
+        assert e.addr == 2
+    else:
+        assert False
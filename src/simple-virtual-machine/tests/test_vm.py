@@ -4,7 +4,7 @@ import logging
 
 from simplevirtualmachine.bytecodes import INVALID, IADD, ISUB, IMUL, \
     IEQ, ILT, ICONST, LOAD, GLOAD, STORE, GSTORE, \
-    PUTS, POP, CALL, RET, HALT, BR, BRT, BRF, InvalidBytecodeError
+    PUTS, POP, CALL, RET, HALT, BR, BRT, BRF, TCALL, InvalidBytecodeError
 from simplevirtualmachine.vm import VM
 
 logger = logging.getLogger(__name__)
@@ -282,3 +282,238 @@ def __test_factorial(capsys, n):
 
     # should halt
     assert rv == HALT
+
+
+def test_unknown_engine():
+    try:
+        VM(HALT, engine='bogus')
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown engine should be rejected"
+
+
+def test_table_engine_halt():
+    assert VM(HALT, engine='table').run() == HALT
+
+
+def test_table_engine_invalid():
+    try:
+        vm_test_helper(ICONST, 1, INVALID, engine='table')
+    except InvalidBytecodeError as e:
+        assert "ip = 2" in str(e)
+    else:
+        assert False, "INVALID should raise"
+
+
+def test_table_engine_loop(capsys):
+    (rv, out, err) = vm_test_helper(
+        ICONST, 13, GSTORE, 0, ICONST, 0, GSTORE, 1,
+        GLOAD, 1, GLOAD, 0, ILT, BRF, 24,
+        GLOAD, 1, ICONST, 1, IADD, GSTORE, 1, BR, 8,
+        GLOAD, 1, PUTS, HALT,
+        engine='table', capsys=capsys)
+
+    assert out == "OUTPUT: 13\n"
+    assert rv == HALT
+
+
+def test_table_engine_factorial(capsys):
+    (rv, out, err) = vm_test_helper(
+        LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+        LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+        ICONST, 10, CALL, 0, 1, PUTS, HALT,
+        start_ip=22, engine='table', capsys=capsys)
+
+    assert out == "OUTPUT: 3628800\n"
+    assert rv == HALT
+
+
+FACTORIAL_10 = (LOAD, -3, ICONST, 2, ILT, BRF, 10, ICONST, 1, RET,
+                LOAD, -3, LOAD, -3, ICONST, 1, ISUB, CALL, 0, 1, IMUL, RET,
+                ICONST, 10, CALL, 0, 1, PUTS, ICONST, 2, PUTS, HALT)
+
+
+def test_run_iter_quanta():
+    for engine in VM.ENGINES:
+        vm = VM(*FACTORIAL_10, start_ip=22, engine=engine)
+        quanta = list(vm.run_iter(quantum=10))
+        reference = VM(*FACTORIAL_10, start_ip=22, engine=engine)
+        reference.run()
+        assert quanta == list(range(10, reference.steps, 10))
+        assert vm.steps == reference.steps
+        assert vm.ip == reference.ip
+
+
+def test_run_iter_resume(capsys):
+    vm = VM(*FACTORIAL_10, start_ip=22, engine='decoded')
+    steps = vm.run_iter(quantum=7)
+    next(steps)
+    steps.close()
+    assert vm.steps == 7
+    vm.run()
+    out, err = capsys.readouterr()
+    assert out == "OUTPUT: 3628800\nOUTPUT: 2\n"
+
+
+def test_run_max_steps():
+    reference = VM(*FACTORIAL_10, start_ip=22, output=[])
+    reference.run()
+    for engine in VM.ENGINES:
+        vm = VM(*FACTORIAL_10, start_ip=22, engine=engine, output=[])
+        results = []
+        while not results or results[-1].status == 'budget':
+            results.append(vm.run(max_steps=13))
+        assert results[0] == ('budget', 13, None), engine
+        assert results[-1] == ('halt', reference.steps % 13, None), engine
+        assert len(results) == reference.steps // 13 + 1
+        assert vm.output.values == [3628800, 2]
+        assert (vm.steps, vm.ip, vm.sp) == (reference.steps, reference.ip, reference.sp)
+        # nothing left to run
+        assert vm.run(max_steps=5) == ('halt', 0, None)
+    assert VM(*FACTORIAL_10, start_ip=22).run(max_steps=0) == ('budget', 0, None)
+
+
+def test_step():
+    addresses = {}
+    for engine in VM.ENGINES:
+        vm = VM(*FACTORIAL_10, start_ip=22, engine=engine, output='null')
+        seen = addresses[engine] = []
+        result = None
+        while result is None or result.status == 'budget':
+            seen.append(vm.ip)
+            result = vm.step()
+            assert result.steps == 1, engine
+        assert vm.code[vm.ip] is HALT
+    assert len(addresses['switch']) == 110
+    for engine in VM.ENGINES:
+        assert addresses[engine] == addresses['switch'], engine
+
+
+def test_run_max_steps_error():
+    # IADD of 1 and an unset data cell
+    code = (ICONST, 1, GLOAD, 0, IADD, PUTS, HALT)
+    for engine in VM.ENGINES:
+        vm = VM(*code, engine=engine, output='null')
+        result = vm.run(max_steps=100)
+        assert result.status == 'error', engine
+        assert isinstance(result.error, TypeError)
+        if engine in ('table', 'decoded'):
+            assert (vm.ip, vm.sp) == (4, 1), engine
+        if engine != 'switch':
+            # the error is reported again, not skipped
+            assert vm.run(max_steps=100).status == 'error', engine
+
+    try:
+        VM(*code).run(max_steps=-1)
+    except ValueError:
+        pass
+    else:
+        assert False, "a negative budget should be rejected"
+
+
+class Ready(object):
+    """An awaitable that completes after one bare yield."""
+
+    def __init__(self, log, value):
+        self.log = log
+        self.value = value
+
+    def __await__(self):
+        yield
+        self.log.append(self.value)
+
+
+def test_run_async_driven_by_hand(capsys):
+    received = []
+    vm = VM(*FACTORIAL_10, start_ip=22, engine='table')
+    turns = len(list(vm.run_async(quantum=5, sink=lambda v: Ready(received, v))))
+    assert received == [3628800, 2]
+    # 110 steps: 21 full quanta, the 22nd ends at HALT; one turn per sink value
+    assert vm.steps == 110
+    assert turns == 21 + 2
+    assert capsys.readouterr()[0] == ""
+
+
+def test_run_async_cancel_keeps_output():
+    received = []
+    vm = VM(*FACTORIAL_10, start_ip=22, engine='decoded')
+    run = iter(vm.run_async(quantum=1000, sink=lambda v: Ready(received, v)))
+    next(run)
+    # cancelled while the sink holds the first value
+    run.close()
+    assert vm.pending_output == [3628800, 2]
+    list(vm.run_async(sink=received.append))
+    assert received == [3628800, 2]
+    assert vm.pending_output == []
+
+
+def test_run_async_asyncio():
+    import pytest
+
+    asyncio = pytest.importorskip('asyncio')
+    received = []
+
+    def sink(value):
+        received.append(value)
+        return asyncio.sleep(0)
+
+    vm = VM(*FACTORIAL_10, start_ip=22, engine='decoded')
+    loop = asyncio.new_event_loop()
+    try:
+        run = vm.run_async(quantum=3, sink=sink)
+        loop.run_until_complete(asyncio.ensure_future(run, loop=loop))
+    finally:
+        loop.close()
+    assert received == [3628800, 2]
+
+
+# SUM(n, acc): if n < 1: return acc; return SUM(n - 1, acc + n)
+TAIL_SUM = (LOAD, -4, ICONST, 1, ILT, BRF, 10, LOAD, -3, RET,
+            LOAD, -4, ICONST, 1, ISUB, LOAD, -3, LOAD, -4, IADD,
+            TCALL, 0, 2, RET,
+            ICONST, 1000, ICONST, 0, CALL, 0, 2, PUTS, HALT)
+
+# F(x) = G(x, 10), G(a, b) = a * b; main prints 100 + F(6)
+TAIL_WIDER = (LOAD, -3, ICONST, 10, TCALL, 7, 2,
+              LOAD, -4, LOAD, -3, IMUL, RET,
+              ICONST, 100, ICONST, 6, CALL, 0, 1, IADD, PUTS, HALT)
+
+
+def test_tail_calls_run_in_constant_stack():
+    for engine in VM.ENGINES:
+        for memory in ('list', 'array'):
+            if engine == 'switch' and memory == 'array':
+                continue
+            output = []
+            vm = VM(*TAIL_SUM, start_ip=24, engine=engine, memory=memory,
+                    stack_size=16, output=output)
+            vm.run()
+            assert output == [500500], (engine, memory)
+
+    # the same recursion with CALL needs a frame per level
+    code = TAIL_SUM[:20] + (CALL,) + TAIL_SUM[21:]
+    try:
+        VM(*code, start_ip=24, stack_size=16, output='null').run()
+    except IndexError:
+        pass
+    else:
+        assert False, "CALL recursion should overflow a 16 cell stack"
+
+
+def test_tail_call_changes_argument_count():
+    for engine in VM.ENGINES:
+        output = []
+        vm = VM(*TAIL_WIDER, start_ip=13, engine=engine, output=output)
+        vm.run()
+        assert output == [160], engine
+        assert (vm.sp, vm.fp) == (-1, -1), engine
+
+
+def test_tail_call_from_entry_frame_is_a_call():
+    for engine in VM.ENGINES:
+        output = []
+        VM(LOAD, -3, ICONST, 2, IMUL, RET,
+           ICONST, 21, TCALL, 0, 1, PUTS, HALT,
+           start_ip=6, engine=engine, output=output).run()
+        assert output == [42], engine